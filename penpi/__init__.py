@@ -1 +1,6 @@
-from .screen import Screen
\ No newline at end of file
+def __getattr__(name):
+    # Importing the package stays cheap, Screen is only loaded when used.
+    if name == 'Screen':
+        from .screen import Screen
+        return Screen
+    raise AttributeError("module 'penpi' has no attribute '%s'" % name)
@@ -1,4 +1,11 @@
 #!/usr/bin/env python3
+import sys
+
+from penpi import profile
+
+if '--profile' in sys.argv[1:]:
+    profile.enable()
+
 from penpi.main import Main
 
 Main.run()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for the hot paths, runnable off-device.
+
+Usage:
+    python3 -m penpi.bench [name ...]
+
+Each benchmark checks that the fast path produces the same result as the
+reference implementation before timing it, and exits non-zero otherwise.
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+import timeit
+
+from PIL import Image
+from PIL import ImageDraw
+from PIL import ImageFont
+
+
+def _sample_images(width, height, count=16):
+    """Summary
+
+    Returns:
+        list: Blank, full, random noise and menu-like mode '1' images
+    """
+    images = [Image.new('1', (width, height), 0), Image.new('1', (width, height), 1)]
+
+    rnd = random.Random(0)
+    for _ in range(count):
+        noise = bytes(rnd.getrandbits(8) for _ in range(width * height // 8))
+        images.append(Image.frombytes('1', (width, height), noise))
+
+    menu = Image.new('1', (width, height))
+    draw = ImageDraw.Draw(menu)
+    font = ImageFont.load_default()
+    for row in range(6):
+        if row == 2:
+            draw.rectangle((0, row*10, width, row*10+10), outline=0, fill=255)
+        draw.text((0, row*10), "{}. Menu entry".format(row+1), font=font, fill=0 if row == 2 else 255)
+    images.append(menu)
+
+    return images
+
+
+def bench_display(number=200):
+    """Page buffer conversion, pure python against numpy.
+    """
+    from penpi import display
+
+    width, pages = 128, 8
+    images = _sample_images(width, pages * 8)
+
+    if display.numpy is None:
+        print('display: numpy not installed, only the reference path is available')
+        converters = [('py', display.image_to_pages_py)]
+    else:
+        for image in images:
+            golden = display.image_to_pages_py(image, width, pages)
+            if display.image_to_pages_np(image, width, pages) != golden:
+                print('display: numpy conversion differs from the reference')
+                return False
+        converters = [('py', display.image_to_pages_py), ('np', display.image_to_pages_np)]
+
+    image = images[-1]
+    for name, func in converters:
+        seconds = timeit.timeit(lambda: func(image, width, pages), number=number)
+        print('display: image_to_pages_{:<3} {:8.1f} us/frame'.format(name, seconds / number * 1e6))
+    return True
+
+
+def _pipe_throughput(payload, consume):
+    """Summary
+
+    Args:
+        payload (bytes): Written into a fresh pipe from a thread
+        consume (callable): Called with the read end, returns what it read
+
+    Returns:
+        tuple: (bytes read, seconds taken)
+    """
+    read_fd, write_fd = os.pipe()
+
+    def write():
+        with os.fdopen(write_fd, 'wb') as pipe:
+            pipe.write(payload)
+
+    writer = threading.Thread(target=write)
+    started = time.perf_counter()
+    writer.start()
+    data = consume(read_fd)
+    seconds = time.perf_counter() - started
+    writer.join()
+    os.close(read_fd)
+    return data, seconds
+
+
+def bench_stream(size=1 << 20):
+    """Shell pipe readers, per character queue against the chunked ring.
+    """
+    from penpi.gatt.NonBlockingStream import NonBlockingStreamReader, StreamReader, UnexpectedEndOfStream
+
+    rnd = random.Random(0)
+    text = ''.join(rnd.choice('abcdefghij klmnop\n') for _ in range(size)).encode()
+    binary = bytes(rnd.getrandbits(8) for _ in range(size))
+
+    def ring(fd):
+        done = threading.Event()
+        reader = StreamReader(fd, on_data=lambda r: r.eof and done.set())
+        chunks = []
+        while not done.is_set() or len(reader):
+            reader.wait(0.01)
+            chunks.append(reader.read())
+        return b''.join(chunks)
+
+    def chars(fd):
+        stream = os.fdopen(os.dup(fd), 'r', encoding='utf-8', newline='')
+        reader = NonBlockingStreamReader(stream)
+        chunks = bytearray()
+        while len(chunks) < size:
+            chunks += reader.readchar(1.0).encode()
+        return bytes(chunks)
+
+    # The old reader ends its thread by raising at the end of the pipe.
+    excepthook = threading.excepthook
+    threading.excepthook = lambda args: args.exc_type is UnexpectedEndOfStream or excepthook(args)
+
+    for payload in (text, binary):
+        data, _ = _pipe_throughput(payload, ring)
+        if data != payload:
+            print('stream: ring reader lost or changed output')
+            return False
+
+    for name, consume in (('char', chars), ('ring', ring)):
+        _, seconds = _pipe_throughput(text, consume)
+        print('stream: {:<4} {:8.1f} MB/s'.format(name, size / seconds / 1e6))
+    time.sleep(0.1)
+    threading.excepthook = excepthook
+    return True
+
+
+def _sample_outputs():
+    """Summary
+
+    Returns:
+        dict: Name to output resembling what the menu and shell produce
+    """
+    rnd = random.Random(0)
+
+    def mac():
+        return ':'.join('{:02x}'.format(rnd.getrandbits(8)) for _ in range(6))
+
+    scan = ''.join(
+        'BSS {}(on wlan0)\n\tfreq: {}\n\tsignal: -{}.00 dBm\n\tSSID: net-{}\n'
+        '\tRSN:\t * Version: 1\n\t\t * Group cipher: CCMP\n'.format(
+            mac(), rnd.choice((2412, 2437, 2462, 5180)), rnd.randint(30, 90), rnd.randint(1, 99))
+        for _ in range(40))
+    addr = ''.join('{:<16} UP             10.{}.{}.{}/24\n'.format(
+        rnd.choice(('eth0', 'wlan0', 'usb0', 'tun0')), rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254))
+        for _ in range(12))
+    log = ''.join('[{:12.6f}] {}: {}\n'.format(i * 0.0137, rnd.choice(('usb 1-1', 'brcmfmac', 'EXT4-fs', 'bcm2835')),
+        rnd.choice(('new high-speed USB device number 3', 'power management enabled',
+        'mounted filesystem with ordered data mode', 'firmware: direct-loading failed')))
+        for i in range(400))
+    noise = bytes(rnd.getrandbits(8) for _ in range(8192))
+
+    return {'iw scan': scan.encode(), 'ip addr': addr.encode(), 'dmesg': log.encode(), 'random': noise}
+
+
+def bench_compress(page_size=20):
+    """Compressed output pages, ratio and cost on representative outputs.
+    """
+    import zlib
+    from penpi.gatt.compress import Compressor, Pager, DEFLATE, read_size
+
+    # Read the way the command characteristic reads compressed sessions;
+    # raw pages are what raw mode sends for the same reads.
+    size = read_size(page_size, 4)
+    for name, output in sorted(_sample_outputs().items()):
+        pager = Pager(Compressor(), page_size)
+        started = time.perf_counter()
+        for start in range(0, len(output), size):
+            pager.add(output[start:start + size])
+        seconds = time.perf_counter() - started
+        raw = sum(-(-len(output[start:start + size]) // page_size) for start in range(0, len(output), size))
+
+        pages = []
+        while len(pager):
+            pages.append(pager.take())
+
+        inflate = zlib.decompressobj(-15)
+        received = b''.join(inflate.decompress(page[1:]) if page[0] == DEFLATE else page[1:] for page in pages)
+        if received != output:
+            print('compress: {} does not survive the round trip'.format(name))
+            return False
+
+        print('compress: {:<8} {:6d} bytes in {:5d} pages, {:5d} raw, ratio {:.2f}, {:6.1f} MB/s'.format(
+            name, len(output), len(pages), raw,
+            pager.compressor.ratio, len(output) / seconds / 1e6))
+    return True
+
+
+BENCHMARKS = {
+    'compress': bench_compress,
+    'display': bench_display,
+    'stream': bench_stream,
+}
+
+
+def main(argv):
+    names = argv or sorted(BENCHMARKS)
+    ok = True
+    for name in names:
+        ok = BENCHMARKS[name]() and ok
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
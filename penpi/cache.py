@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""Cached output of slow menu commands.
+
+A menu entry opts in with ``cache`` settings in config.json::
+
+    {"name": "BT Scan", "command": "hcitool scan",
+     "cache": {"ttl": 120, "refresh": true, "max_size": 16384}}
+
+``ttl`` is how many seconds a result is shown without running the command
+again.  Once it is older, ``refresh`` shows the old result straight away
+and runs the command in the background to replace it; without ``refresh``
+the command runs as if uncached.  Outputs above ``max_size`` bytes are not
+kept.
+
+``ResultCache`` is a thread-safe LRU bounded by the total size of the
+outputs it holds.
+
+Attributes:
+    CachedResult (namedtuple): Output of one run, ``time`` as time.monotonic()
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from penpi.runner import CommandRunner
+
+
+CachedResult = namedtuple('CachedResult', 'text returncode time')
+
+
+def cache_key(cmd):
+    """Summary
+
+    Args:
+        cmd (list or str): Command line
+
+    Returns:
+        tuple or str: Hashable key of the command
+    """
+    return tuple(cmd) if isinstance(cmd, list) else cmd
+
+
+def age_label(seconds):
+    """Summary
+
+    Args:
+        seconds (float): Age of a result
+
+    Returns:
+        str: Short age such as '45s', '12m' or '3h'
+    """
+    if seconds < 60:
+        return '{}s'.format(int(seconds))
+    if seconds < 3600:
+        return '{}m'.format(int(seconds // 60))
+    return '{}h'.format(int(seconds // 3600))
+
+
+class ResultCache():
+
+    """Least recently used command outputs, bounded by their total size.
+
+    Attributes:
+        max_bytes (int): Total size of the outputs held
+    """
+
+    def __init__(self, max_bytes=256 * 1024):
+        """Summary
+
+        Args:
+            max_bytes (int): Total size of the outputs held
+        """
+        self.max_bytes = max_bytes
+        self.__results = OrderedDict()
+        self.__size = 0
+        self.__refreshing = set()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__results)
+
+    @property
+    def size(self):
+        """Summary
+
+        Returns:
+            int: Total size of the outputs held
+        """
+        return self.__size
+
+    def get(self, cmd):
+        """Summary
+
+        Args:
+            cmd (list or str): Command line
+
+        Returns:
+            CachedResult: Last output of cmd, None if there is none
+        """
+        key = cache_key(cmd)
+        with self.__lock:
+            result = self.__results.get(key)
+            if result is not None:
+                self.__results.move_to_end(key)
+            return result
+
+    def put(self, cmd, text, returncode, max_size=None):
+        """Keep an output, dropping the least recently used ones to make room.
+
+        Args:
+            cmd (list or str): Command line
+            text (str): Output
+            returncode (int): Exit status
+            max_size (int): Outputs above this size are not kept
+
+        Returns:
+            bool: Whether the output was kept
+        """
+        key = cache_key(cmd)
+        size = len(text)
+        with self.__lock:
+            self.__drop(key)
+            if size > self.max_bytes or (max_size is not None and size > max_size):
+                return False
+
+            self.__results[key] = CachedResult(text, returncode, time.monotonic())
+            self.__size += size
+            while self.__size > self.max_bytes:
+                self.__drop(next(iter(self.__results)))
+            return True
+
+    def __drop(self, key):
+        result = self.__results.pop(key, None)
+        if result is not None:
+            self.__size -= len(result.text)
+
+    def invalidate(self, cmd=None):
+        """Drop the output of cmd, or all outputs.
+
+        Args:
+            cmd (list or str): Command line, None for all
+        """
+        with self.__lock:
+            if cmd is None:
+                self.__results.clear()
+                self.__size = 0
+            else:
+                self.__drop(cache_key(cmd))
+
+    def store(self, cmd, runner, max_size=None):
+        """Keep the output of a finished run, unless it was cancelled.
+
+        Args:
+            cmd (list or str): Command line the runner was started with
+            runner (CommandRunner): Finished run
+            max_size (int): Outputs above this size are not kept
+        """
+        if not runner.cancelled:
+            self.put(cmd, runner.lines.text(), runner.process.returncode, max_size)
+
+    def refresh(self, cmd, max_size=None, on_done=None):
+        """Run cmd in the background and keep its output.
+
+        Does nothing while a refresh of cmd is running already.
+
+        Args:
+            cmd (list or str): Command line
+            max_size (int): Outputs above this size are not kept
+            on_done (callable): Called with the cache from the runner thread
+                once the new output was stored
+
+        Returns:
+            bool: Whether a refresh was started
+        """
+        key = cache_key(cmd)
+        with self.__lock:
+            if key in self.__refreshing:
+                return False
+            self.__refreshing.add(key)
+
+        def on_exit(runner):
+            self.store(cmd, runner, max_size)
+            with self.__lock:
+                self.__refreshing.discard(key)
+            if on_done:
+                on_done(self)
+
+        runner = CommandRunner(cmd, on_exit=on_exit)
+        try:
+            runner.start()
+        except OSError:
+            with self.__lock:
+                self.__refreshing.discard(key)
+            raise
+        return True
+
+    def refreshing(self, cmd):
+        """Summary
+
+        Args:
+            cmd (list or str): Command line
+
+        Returns:
+            bool: Whether a background refresh of cmd is running
+        """
+        with self.__lock:
+            return cache_key(cmd) in self.__refreshing
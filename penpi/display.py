@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""Dirty-region framebuffer pushes for the SSD1306.
+
+The SSD1306 keeps its own copy of the framebuffer (GDDRAM), organised as
+8 pages of 128 column bytes, each byte holding 8 vertical pixels.  The
+Adafruit driver sends all 1024 bytes on every ``display()`` call.  ``Display``
+remembers the page buffer that was last pushed, works out which pages and
+column ranges changed and only sends those through the controller's
+column/page address window.
+
+Attributes:
+    SSD1306_COLUMNADDR (int): Set column address window command
+    SSD1306_PAGEADDR (int): Set page address window command
+    WINDOW_COST (int): Command bytes spent on opening one address window
+    push_seconds (Histogram): Time spent in Display.push
+    pushed_bytes (Counter): Data bytes sent by Display.push
+"""
+
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from penpi import metrics
+
+
+SSD1306_COLUMNADDR = 0x21
+SSD1306_PAGEADDR = 0x22
+
+WINDOW_COST = 6
+
+push_seconds = metrics.histogram('penpi_display_push_seconds', 'Time spent pushing a frame')
+pushed_bytes = metrics.counter('penpi_display_bytes_total', 'Data bytes sent to the display')
+
+
+def image_to_pages_py(image, width, pages):
+    """Convert a mode '1' image into SSD1306 page buffer layout.
+
+    Byte ``page * width + x`` holds the pixels ``(x, page*8)`` to
+    ``(x, page*8+7)``, least significant bit on top.  This is the pixel
+    loop of Adafruit_SSD1306.image() and the reference for the numpy path.
+
+    Args:
+        image (PIL.Image): 1-bit image of width x pages*8 pixels
+        width (int): Display width in pixels
+        pages (int): Number of 8 pixel pages
+
+    Returns:
+        bytearray: Page buffer of width * pages bytes
+    """
+    _check_image(image, width, pages)
+
+    pix = image.load()
+    buf = bytearray(width * pages)
+    index = 0
+    for page in range(pages):
+        for x in range(width):
+            bits = 0
+            for bit in range(8):
+                bits = bits << 1
+                bits |= 0 if pix[(x, page*8+7-bit)] == 0 else 1
+            buf[index] = bits
+            index += 1
+    return buf
+
+
+def image_to_pages_np(image, width, pages):
+    """Vectorized image_to_pages_py producing the same bytes.
+
+    The packed rows of the image buffer are unpacked into a (pages, 8, width)
+    bit array, transposed so that the 8 pixels of a column byte are adjacent
+    and packed again with the top pixel as least significant bit.
+
+    Args:
+        image (PIL.Image): 1-bit image of width x pages*8 pixels
+        width (int): Display width in pixels
+        pages (int): Number of 8 pixel pages
+
+    Returns:
+        bytearray: Page buffer of width * pages bytes
+    """
+    _check_image(image, width, pages)
+
+    rows = numpy.frombuffer(image.tobytes(), dtype=numpy.uint8)
+    bits = numpy.unpackbits(rows.reshape(pages * 8, -1), axis=1)[:, :width]
+    bits = bits.reshape(pages, 8, width).transpose(0, 2, 1)[:, :, ::-1]
+    return bytearray(numpy.packbits(bits, axis=2).tobytes())
+
+
+def _check_image(image, width, pages):
+    if image.mode != '1':
+        raise ValueError('Image must be in mode 1.')
+    if image.size != (width, pages * 8):
+        raise ValueError('Image must be same dimensions as display ({0}x{1}).'
+                         .format(width, pages * 8))
+
+
+if numpy is not None:
+    image_to_pages = image_to_pages_np
+else:
+    image_to_pages = image_to_pages_py
+
+
+def dirty_windows(old, new, width, pages):
+    """Work out which address windows have to be sent to get from old to new.
+
+    Every page with changes gets a window covering its changed columns.
+    Neighbouring dirty pages are merged into a single window when sending
+    the union is cheaper than opening another window.
+
+    Args:
+        old (bytearray): Page buffer currently on the display
+        new (bytearray): Page buffer to display
+        width (int): Display width in pixels
+        pages (int): Number of 8 pixel pages
+
+    Returns:
+        list: (col_start, col_end, page_start, page_end) tuples, inclusive
+    """
+    windows = []
+    for page in range(pages):
+        start = page * width
+        end = start + width
+        if old[start:end] == new[start:end]:
+            continue
+
+        first = 0
+        while old[start+first] == new[start+first]:
+            first += 1
+        last = width - 1
+        while old[start+last] == new[start+last]:
+            last -= 1
+
+        if windows:
+            c0, c1, p0, p1 = windows[-1]
+            if p1 == page - 1:
+                m0 = min(c0, first)
+                m1 = max(c1, last)
+                separate = (c1-c0+1) * (p1-p0+1) + (last-first+1) + WINDOW_COST
+                merged = (m1-m0+1) * (page-p0+1)
+                if merged <= separate:
+                    windows[-1] = (m0, m1, p0, page)
+                    continue
+
+        windows.append((first, last, page, page))
+    return windows
+
+
+class SSD1306Device():
+
+    """Window writes on top of an initialised Adafruit_SSD1306 driver.
+
+    Attributes:
+        disp (Adafruit_SSD1306.SSD1306Base): Driver used for the bus access
+        width (int): Display width in pixels
+        height (int): Display height in pixels
+    """
+
+    def __init__(self, disp):
+        """Summary
+
+        Args:
+            disp (Adafruit_SSD1306.SSD1306Base): Initialised driver
+        """
+        self.disp = disp
+        self.width = disp.width
+        self.height = disp.height
+
+    def write_window(self, col_start, col_end, page_start, page_end, data):
+        """Send data into the given GDDRAM window.
+
+        Args:
+            col_start (int): First column, inclusive
+            col_end (int): Last column, inclusive
+            page_start (int): First page, inclusive
+            page_end (int): Last page, inclusive
+            data (bytes): Column bytes for the window in horizontal addressing order
+        """
+        disp = self.disp
+        disp.command(SSD1306_COLUMNADDR)
+        disp.command(col_start)
+        disp.command(col_end)
+        disp.command(SSD1306_PAGEADDR)
+        disp.command(page_start)
+        disp.command(page_end)
+
+        if disp._spi is not None:
+            disp._gpio.set_high(disp._dc)
+            disp._spi.write(list(data))
+        else:
+            for i in range(0, len(data), 16):
+                disp._i2c.writeList(0x40, list(data[i:i+16]))
+
+
+class FakeDevice():
+
+    """In-memory SSD1306 used to measure and check pushes off-device.
+
+    Emulates the GDDRAM with horizontal addressing inside the address
+    window and keeps byte counters per frame.
+
+    Attributes:
+        width (int): Display width in pixels
+        height (int): Display height in pixels
+        ram (bytearray): Emulated GDDRAM contents
+        data_bytes (int): Data bytes received since the last reset
+        command_bytes (int): Command bytes received since the last reset
+        windows (list): Windows written since the last reset
+    """
+
+    def __init__(self, width=128, height=64):
+        """Summary
+
+        Args:
+            width (int): Display width in pixels
+            height (int): Display height in pixels
+        """
+        self.width = width
+        self.height = height
+        self.ram = bytearray(width * (height // 8))
+        self.reset_counters()
+
+    def reset_counters(self):
+        """Summary
+        """
+        self.data_bytes = 0
+        self.command_bytes = 0
+        self.windows = []
+
+    @property
+    def bytes_sent(self):
+        """Summary
+
+        Returns:
+            int: Command and data bytes received since the last reset
+        """
+        return self.data_bytes + self.command_bytes
+
+    def write_window(self, col_start, col_end, page_start, page_end, data):
+        """See SSD1306Device.write_window.
+        """
+        cols = col_end - col_start + 1
+        if len(data) != cols * (page_end - page_start + 1):
+            raise ValueError('Data does not fill the address window.')
+
+        self.command_bytes += WINDOW_COST
+        self.data_bytes += len(data)
+        self.windows.append((col_start, col_end, page_start, page_end))
+
+        for i, page in enumerate(range(page_start, page_end + 1)):
+            dst = page * self.width + col_start
+            self.ram[dst:dst+cols] = data[i*cols:(i+1)*cols]
+
+
+class Display():
+
+    """Pushes images to a device, sending only what changed since the last push.
+
+    Attributes:
+        device (SSD1306Device): Backend receiving the window writes
+        width (int): Display width in pixels
+        height (int): Display height in pixels
+        pages (int): Number of 8 pixel pages
+        frames (int): Number of pushes
+        last_frame_bytes (int): Data bytes sent by the last push
+        last_frame_time (float): Seconds spent in the last push
+    """
+
+    def __init__(self, device):
+        """Summary
+
+        Args:
+            device (SSD1306Device): Backend, assumed to show a cleared screen
+        """
+        self.device = device
+        self.width = device.width
+        self.height = device.height
+        self.pages = device.height // 8
+
+        self.__shown = bytearray(self.width * self.pages)
+
+        self.frames = 0
+        self.last_frame_bytes = 0
+        self.last_frame_time = 0.0
+
+    def invalidate(self):
+        """Force the next push to send the whole frame.
+
+        Needed when something else wrote to the display behind our back.
+        """
+        self.__shown = None
+
+    def push(self, image):
+        """Send the parts of image that differ from what is on the display.
+
+        Args:
+            image (PIL.Image): 1-bit image of the display size
+        """
+        start = time.perf_counter()
+
+        pages = image_to_pages(image, self.width, self.pages)
+
+        if self.__shown is None:
+            windows = [(0, self.width - 1, 0, self.pages - 1)]
+        else:
+            windows = dirty_windows(self.__shown, pages, self.width, self.pages)
+
+        sent = 0
+        for c0, c1, p0, p1 in windows:
+            data = bytearray()
+            for page in range(p0, p1 + 1):
+                data += pages[page*self.width+c0:page*self.width+c1+1]
+            self.device.write_window(c0, c1, p0, p1, data)
+            sent += len(data)
+
+        self.__shown = pages
+
+        self.frames += 1
+        self.last_frame_bytes = sent
+        self.last_frame_time = time.perf_counter() - start
+        push_seconds.observe(self.last_frame_time)
+        pushed_bytes.inc(sent)
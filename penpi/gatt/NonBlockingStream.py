@@ -1,5 +1,15 @@
+"""Background readers for the pipes of the GATT shell.
+
+``NonBlockingStreamReader`` queues a stream one character at a time and is
+kept for comparison, see ``python3 -m penpi.bench stream``.
+``StreamReader`` reads the raw pipe in large chunks into a ``RingBuffer``
+and hands the output out as memoryviews.
+"""
+
 from threading import Thread
+import os
 import queue
+import threading
 
 
 class NonBlockingStreamReader:
@@ -45,3 +55,274 @@ class NonBlockingStreamReader:
 
 class UnexpectedEndOfStream(Exception):
     pass
+
+
+class RingBuffer:
+    """Bytes between a writer and a reader thread, in a preallocated bytearray.
+
+    The writer reads straight from a file descriptor into the free part of
+    the ring, the reader gets memoryviews of the filled part, so output is
+    never copied on its way through.  A full ring blocks the writer.
+    """
+
+    def __init__(self, capacity=64 * 1024):
+        """Summary
+
+        Args:
+            capacity (int): Size of the ring in bytes
+        """
+        self.capacity = capacity
+        self.__buffer = bytearray(capacity)
+        self.__view = memoryview(self.__buffer)
+        self.__head = 0
+        self.__size = 0
+        self.__released = 0
+        self.__lock = threading.Condition()
+
+    def __len__(self):
+        with self.__lock:
+            return self.__size - self.__released
+
+    def fill(self, fd, timeout=None):
+        """Read from fd into the free part of the ring, one os.readv call.
+
+        Args:
+            fd (int): File descriptor to read
+            timeout (float): Seconds to wait for free space, None waits forever
+
+        Returns:
+            int: Bytes read, 0 at end of file, None if the ring stayed full
+        """
+        with self.__lock:
+            if not self.__lock.wait_for(lambda: self.__size < self.capacity, timeout):
+                return None
+            tail = (self.__head + self.__size) % self.capacity
+            free = self.capacity - self.__size
+
+        # Only the writer touches the free part, no lock needed while reading.
+        end = min(tail + free, self.capacity)
+        parts = [self.__view[tail:end]]
+        if tail + free > self.capacity:
+            parts.append(self.__view[:tail + free - self.capacity])
+        count = os.readv(fd, parts)
+
+        with self.__lock:
+            self.__size += count
+            self.__lock.notify_all()
+        return count
+
+    def wait(self, timeout=None):
+        """Wait until there is something to take.
+
+        Args:
+            timeout (float): Seconds to wait, None waits forever
+
+        Returns:
+            bool: Whether there is data
+        """
+        with self.__lock:
+            return self.__lock.wait_for(lambda: self.__size > self.__released, timeout)
+
+    def peek(self, max_bytes=None):
+        """Look at the oldest bytes without taking them.
+
+        Args:
+            max_bytes (int): Most bytes to return
+
+        Returns:
+            memoryview: Oldest contiguous bytes, empty if there are none
+        """
+        with self.__lock:
+            return self.__contiguous(self.__released, max_bytes)
+
+    def drain(self, max_bytes=None):
+        """Take the oldest bytes.
+
+        The view returned stays valid until the next drain(), which hands
+        its space back to the writer.  When the data wraps around the end
+        of the ring the view stops there, drain again for the rest.
+
+        Args:
+            max_bytes (int): Most bytes to take
+
+        Returns:
+            memoryview: Oldest contiguous bytes, empty if there are none
+        """
+        with self.__lock:
+            self.__release()
+            view = self.__contiguous(0, max_bytes)
+            self.__released = len(view)
+            return view
+
+    def release(self):
+        """Hand the space of the last drain() back to the writer.
+        """
+        with self.__lock:
+            self.__release()
+
+    def __release(self):
+        if self.__released:
+            self.__head = (self.__head + self.__released) % self.capacity
+            self.__size -= self.__released
+            self.__released = 0
+            self.__lock.notify_all()
+
+    def __contiguous(self, skip, max_bytes):
+        start = (self.__head + skip) % self.capacity
+        count = min(self.__size - skip, self.capacity - start)
+        if max_bytes is not None:
+            count = min(count, max_bytes)
+        return self.__view[start:start + count]
+
+
+class StreamReader:
+    """Reads a pipe in large chunks into a RingBuffer.
+
+    By default a background thread keeps reading.  Without it the pipe is
+    made non-blocking and read by pump(), e.g. when a main loop reports it
+    readable.  Output stays bytes end to end, whatever encoding the command
+    produces.
+
+    Attributes:
+        ready (bool): Set when data arrived, cleared by the consumer
+        eof (bool): Whether the pipe was closed
+    """
+
+    def __init__(self, stream, capacity=64 * 1024, on_data=None, threaded=True):
+        """Summary
+
+        Args:
+            stream (file or int): Pipe to read, usually the stdout of a Popen
+            capacity (int): Bytes buffered before the writing end blocks
+            on_data (callable): Called with the reader from its thread
+                whenever data arrived and once at end of file
+            threaded (bool): Read from a background thread, otherwise pump()
+        """
+        self._fd = stream if isinstance(stream, int) else stream.fileno()
+        self._ring = RingBuffer(capacity)
+        self._on_data = on_data
+
+        self.ready = False
+        self.eof = False
+
+        self._t = None
+        if threaded:
+            self._t = Thread(target=self._populate, name='stream-{}'.format(self._fd))
+            self._t.daemon = True
+            self._t.start()
+        else:
+            os.set_blocking(self._fd, False)
+
+    def fileno(self):
+        return self._fd
+
+    def pump(self):
+        """Read what the pipe holds without blocking, as far as the ring has room.
+
+        Only for readers created with threaded=False.
+
+        Returns:
+            int: Bytes read
+        """
+        total = 0
+        while not self.eof:
+            try:
+                count = self._ring.fill(self._fd, timeout=0)
+            except BlockingIOError:
+                break
+            except OSError:
+                count = 0
+            if count is None:
+                break
+            if not count:
+                self.eof = True
+                break
+            total += count
+
+        if total:
+            self.ready = True
+        return total
+
+    def _populate(self):
+        while True:
+            try:
+                count = self._ring.fill(self._fd)
+            except OSError:
+                count = 0
+            if not count:
+                break
+            self.ready = True
+            if self._on_data:
+                self._on_data(self)
+
+        self.eof = True
+        self._ring.release()
+        if self._on_data:
+            self._on_data(self)
+
+    def __len__(self):
+        return len(self._ring)
+
+    @property
+    def full(self):
+        """Summary
+
+        Returns:
+            bool: Whether the ring has no room left, pump() reads nothing
+        """
+        return len(self._ring) >= self._ring.capacity
+
+    def wait(self, timeout=None):
+        """Summary
+
+        Args:
+            timeout (float): Seconds to wait for data, None waits forever
+
+        Returns:
+            bool: Whether there is data to read
+        """
+        return self._ring.wait(timeout)
+
+    def peek(self, max_bytes=None):
+        """See RingBuffer.peek().
+        """
+        return self._ring.peek(max_bytes)
+
+    def drain(self, max_bytes=None):
+        """See RingBuffer.drain().
+        """
+        return self._ring.drain(max_bytes)
+
+    def skip(self, count):
+        """Take count bytes, e.g. after sending what peek() returned.
+
+        Args:
+            count (int): Bytes to take
+        """
+        while count > 0:
+            view = self._ring.drain(count)
+            if not view:
+                break
+            count -= len(view)
+        self._ring.release()
+
+    def read(self, max_bytes=None):
+        """Take everything buffered, as one copy.
+
+        Args:
+            max_bytes (int): Most bytes to take
+
+        Returns:
+            bytes: Data read, empty if there is none
+        """
+        chunks = []
+        remaining = max_bytes
+        while remaining is None or remaining > 0:
+            view = self._ring.drain(remaining)
+            if not view:
+                break
+            chunks.append(bytes(view))
+            if remaining is not None:
+                remaining -= len(view)
+        self._ring.release()
+        return b''.join(chunks)
@@ -10,14 +10,11 @@ import dbus.service
 import array
 from uuid import UUID
 
-try:
-  from gi.repository import GObject  # python3
-except ImportError:
-  import gobject as GObject  # python2
-
 from random import randint
 
-mainloop = None
+from penpi import loop, profile, status
+
+advertisement = None
 
 BLUEZ_SERVICE_NAME = 'org.bluez'
 LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
@@ -137,6 +134,11 @@ class Advertisement(dbus.service.Object):
     def Release(self):
         print('%s: Released!' % self.path)
 
+    @dbus.service.signal(DBUS_PROP_IFACE,
+                         signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
 class PenpiAdvertisement(Advertisement):
 
     def __init__(self, bus, index):
@@ -144,14 +146,25 @@ class PenpiAdvertisement(Advertisement):
         self.add_service_uuid("999d97c6-0e31-4b46-b8cb-ef4c2c918c00")
         self.add_local_name('PenPi')
 
+        # Device status as manufacturer data, see penpi.status
+        self.status = status.Broadcaster(self.UpdateStatus)
+        self.status.start()
+
+    def UpdateStatus(self, data):
+        # BlueZ updates the advertisement in place on PropertiesChanged.
+        self.add_manufacturer_data(status.COMPANY_ID, data)
+        self.PropertiesChanged(LE_ADVERTISEMENT_IFACE,
+            { 'ManufacturerData': self.get_properties()[LE_ADVERTISEMENT_IFACE]['ManufacturerData'] }, [])
+
 
 def register_ad_cb():
     print('Advertisement registered')
+    profile.mark('advertising')
 
 
 def register_ad_error_cb(error):
+    # The rest of the daemon runs on, registration is retried once BlueZ restarts.
     print('Failed to register advertisement: ' + str(error))
-    mainloop.quit()
 
 
 def find_adapter(bus):
@@ -166,17 +179,21 @@ def find_adapter(bus):
     return None
 
 class GattAdvertise():
-    def run():
-        global mainloop
+    def start(bus):
+        """Power the adapter on and register the advertisement.
 
-        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        Args:
+            bus (dbus.Bus): System bus, set up with the GLib main loop
 
-        bus = dbus.SystemBus()
+        Returns:
+            bool: Whether registration was started
+        """
+        global advertisement
 
         adapter = find_adapter(bus)
         if not adapter:
             print('LEAdvertisingManager1 interface not found')
-            return
+            return False
 
         adapter_props = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter),
                                        "org.freedesktop.DBus.Properties");
@@ -186,12 +203,17 @@ class GattAdvertise():
         ad_manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter),
                                     LE_ADVERTISING_MANAGER_IFACE)
 
-        penpi_advertisement = PenpiAdvertisement(bus, 0)
-
-        mainloop = GObject.MainLoop()
+        # Registered again as is when BlueZ restarts.
+        if advertisement is None:
+            advertisement = PenpiAdvertisement(bus, 0)
 
-        ad_manager.RegisterAdvertisement(penpi_advertisement.get_path(), {},
+        ad_manager.RegisterAdvertisement(advertisement.get_path(), {},
                                          reply_handler=register_ad_cb,
                                          error_handler=register_ad_error_cb)
+        return True
+
+    def run():
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
-        mainloop.run()
\ No newline at end of file
+        if GattAdvertise.start(loop.bluez_bus()):
+            loop.run()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""Optional compression of shell output pages.
+
+A client opts in per session by writing ``\\0deflate`` to the command
+characteristic, and back out with ``\\0raw``.  From then on every page,
+notification or read, starts with a flag byte:
+
+    ``RAW`` (0x00)      the rest of the page is output as is
+    ``DEFLATE`` (0x01)  the rest of the page continues a raw deflate stream
+                        (zlib wbits -15) that is sync flushed after every
+                        piece of output, so all output sent so far can be
+                        decompressed as soon as its last page arrived
+
+Output shorter than ``min_size``, or that deflate would not make smaller,
+is sent raw and never enters the deflate stream.  Output is read
+``read_size()`` at a time, a multiple of the page payload, so a read sent
+raw fills as many pages as raw mode needs for it, and one that deflates
+takes fewer.
+
+Attributes:
+    TOTALS (dict): Counters over all sessions, see Compressor
+"""
+
+import time
+import zlib
+from collections import deque
+
+from penpi import metrics
+
+
+RAW = 0x00
+DEFLATE = 0x01
+
+TOTALS = {
+    'raw_bytes': 0,
+    'compressed_bytes': 0,
+    'compressed_pages': 0,
+    'raw_pages': 0,
+    'cpu_seconds': 0.0,
+}
+
+metrics.counter('penpi_compress_raw_bytes_total', 'Output that went into deflate streams',
+    function=lambda: TOTALS['raw_bytes'])
+metrics.counter('penpi_compress_compressed_bytes_total', 'Deflate streams produced',
+    function=lambda: TOTALS['compressed_bytes'])
+metrics.counter('penpi_compress_pages_total', 'Pages of paged output, by format',
+    {'format': 'deflate'}, function=lambda: TOTALS['compressed_pages'])
+metrics.counter('penpi_compress_pages_total', 'Pages of paged output, by format',
+    {'format': 'raw'}, function=lambda: TOTALS['raw_pages'])
+metrics.counter('penpi_compress_cpu_seconds_total', 'Process time spent compressing',
+    function=lambda: TOTALS['cpu_seconds'])
+
+
+def read_size(page_size, pages):
+    """Output to read at a time for flagged pages.
+
+    Args:
+        page_size (int): Most bytes per page, flag included
+        pages (int): Pages a read fills when it is sent raw
+
+    Returns:
+        int: Bytes to read
+    """
+    return max(page_size - 1, 1) * pages
+
+
+class Compressor():
+
+    """Raw deflate stream, sync flushed after every piece of output.
+
+    Attributes:
+        min_size (int): Output shorter than this is not compressed
+        raw_bytes (int): Output that went into the deflate stream
+        compressed_bytes (int): Deflate stream produced from it
+        cpu_seconds (float): Process time spent compressing
+    """
+
+    def __init__(self, level=6, min_size=48):
+        """Summary
+
+        Args:
+            level (int): zlib compression level
+            min_size (int): Output shorter than this is not compressed
+        """
+        self.min_size = min_size
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.cpu_seconds = 0.0
+        self.__deflate = zlib.compressobj(level, zlib.DEFLATED, -15)
+
+    @property
+    def ratio(self):
+        """Summary
+
+        Returns:
+            float: Compressed over raw size, 1.0 before anything was compressed
+        """
+        if not self.raw_bytes:
+            return 1.0
+        return self.compressed_bytes / self.raw_bytes
+
+    def compress(self, data):
+        """Summary
+
+        Args:
+            data (bytes): Output
+
+        Returns:
+            tuple: (RAW or DEFLATE, bytes to send)
+        """
+        if len(data) < self.min_size:
+            return RAW, bytes(data)
+
+        # Compressed on a copy of the stream, kept only if it got smaller;
+        # otherwise the stream goes on as if the output never entered it.
+        started = time.process_time()
+        deflate = self.__deflate.copy()
+        out = deflate.compress(data) + deflate.flush(zlib.Z_SYNC_FLUSH)
+        seconds = time.process_time() - started
+
+        self.cpu_seconds += seconds
+        TOTALS['cpu_seconds'] += seconds
+        if len(out) >= len(data):
+            return RAW, bytes(data)
+
+        self.__deflate = deflate
+        self.raw_bytes += len(data)
+        self.compressed_bytes += len(out)
+        TOTALS['raw_bytes'] += len(data)
+        TOTALS['compressed_bytes'] += len(out)
+        return DEFLATE, out
+
+
+class Pager():
+
+    """Output cut into flagged pages, waiting to be sent or read.
+
+    Attributes:
+        compressor (Compressor): Compresses the output
+        page_size (int): Most bytes per page, flag included
+        send (callable): Called with a page while notifying, returns False
+            if it cannot take more right now
+    """
+
+    def __init__(self, compressor=None, page_size=20):
+        """Summary
+
+        Args:
+            compressor (Compressor): Compresses the output
+            page_size (int): Most bytes per page, flag included
+        """
+        self.compressor = compressor or Compressor()
+        self.page_size = page_size
+        self.send = None
+        self.__pages = deque()
+
+    def __len__(self):
+        return len(self.__pages)
+
+    def add(self, data, page_size=None):
+        """Compress output and cut it into pages.
+
+        Args:
+            data (bytes): Output
+            page_size (int): Most bytes per page, defaults to page_size
+        """
+        if not data:
+            return
+        size = max((page_size or self.page_size) - 1, 1)
+        flag, payload = self.compressor.compress(data)
+        key = 'compressed_pages' if flag == DEFLATE else 'raw_pages'
+        for start in range(0, len(payload), size):
+            self.__pages.append(bytes((flag,)) + payload[start:start + size])
+            TOTALS[key] += 1
+
+    def take(self):
+        """Summary
+
+        Returns:
+            bytes: The oldest page, None if there is none
+        """
+        return self.__pages.popleft() if self.__pages else None
+
+    def flush(self):
+        """Pass pages to send until it is blocked.
+
+        Returns:
+            bool: Whether every page was sent
+        """
+        while self.send is not None and self.__pages:
+            if not self.send(self.__pages[0]):
+                return False
+            self.__pages.popleft()
+        return not self.__pages
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""Stand-in for BlueZ on a private bus, to run penpi.gatt off-device.
+
+Usage:
+    python3 -m penpi.gatt.fakebluez
+
+``FakeBluez`` claims ``org.bluez`` on a bus and exports one adapter,
+``/org/bluez/hci0``, with the ``Adapter1`` properties, ``GattManager1`` and
+``LEAdvertisingManager1``, plus ``ProfileManager1`` on ``/org/bluez``.
+Registered applications are read back through their ObjectManager, just
+as BlueZ does; profiles are only recorded.
+
+``Central`` then plays a connected client: it calls ``ReadValue``,
+``WriteValue``, ``StartNotify`` and the ``Acquire*`` methods on the
+registered characteristics with the options BlueZ would pass, splitting
+long values into long reads and prepared writes.  All calls are
+asynchronous, so centrals and the fake share one main loop.
+
+Run on its own it serves the session bus until interrupted, start the
+daemon with ``PENPI_BUS=session`` to register with it.
+"""
+
+import socket
+
+import dbus
+import dbus.mainloop.glib
+import dbus.service
+
+try:
+  from gi.repository import GLib
+except ImportError:
+  import glib as GLib
+
+
+BLUEZ_SERVICE_NAME = 'org.bluez'
+ADAPTER_IFACE = 'org.bluez.Adapter1'
+GATT_MANAGER_IFACE = 'org.bluez.GattManager1'
+LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
+LE_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
+DBUS_OM_IFACE = 'org.freedesktop.DBus.ObjectManager'
+DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
+GATT_CHRC_IFACE = 'org.bluez.GattCharacteristic1'
+PROFILE_MANAGER_IFACE = 'org.bluez.ProfileManager1'
+
+ADAPTER_PATH = '/org/bluez/hci0'
+
+
+class InvalidArgsException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.freedesktop.DBus.Error.InvalidArgs'
+
+
+class AlreadyExistsException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.AlreadyExists'
+
+
+class DoesNotExistException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.DoesNotExist'
+
+
+class Application():
+
+    """A GATT application as registered, with its objects read back.
+
+    Attributes:
+        sender (str): Unique bus name of the process that registered it
+        path (str): Object path of its ObjectManager
+        objects (dict): Its managed objects, None until they were read
+    """
+
+    def __init__(self, sender, path):
+        """Summary
+
+        Args:
+            sender (str): Unique bus name of the process that registered it
+            path (str): Object path of its ObjectManager
+        """
+        self.sender = sender
+        self.path = path
+        self.objects = None
+
+    def characteristic(self, uuid):
+        """Summary
+
+        Args:
+            uuid (str): Characteristic UUID
+
+        Returns:
+            str: Object path of the characteristic, None if there is none
+        """
+        for path, interfaces in (self.objects or {}).items():
+            properties = interfaces.get(GATT_CHRC_IFACE)
+            if properties is not None and str(properties['UUID']).lower() == uuid.lower():
+                return str(path)
+        return None
+
+
+class Root(dbus.service.Object):
+    """
+    org.freedesktop.DBus.ObjectManager of the fake, lists the adapter
+    """
+
+    def __init__(self, bus, adapter):
+        self.adapter = adapter
+        dbus.service.Object.__init__(self, bus, '/')
+
+    @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        return {
+            dbus.ObjectPath(ADAPTER_PATH): {
+                ADAPTER_IFACE: self.adapter.properties,
+                GATT_MANAGER_IFACE: {},
+                LE_ADVERTISING_MANAGER_IFACE: {},
+            }
+        }
+
+
+class ProfileManager(dbus.service.Object):
+    """
+    org.bluez.ProfileManager1 of the fake, only records the profiles
+    """
+
+    def __init__(self, bus):
+        self.profiles = {}
+        dbus.service.Object.__init__(self, bus, '/org/bluez')
+
+    @dbus.service.method(PROFILE_MANAGER_IFACE, in_signature='osa{sv}', sender_keyword='sender')
+    def RegisterProfile(self, path, uuid, options, sender=None):
+        key = (str(sender), str(path))
+        if key in self.profiles:
+            raise AlreadyExistsException()
+        self.profiles[key] = (str(uuid), dict(options))
+        print('fakebluez: profile {} of {}'.format(uuid, sender))
+
+    @dbus.service.method(PROFILE_MANAGER_IFACE, in_signature='o', sender_keyword='sender')
+    def UnregisterProfile(self, path, sender=None):
+        if self.profiles.pop((str(sender), str(path)), None) is None:
+            raise DoesNotExistException()
+
+
+class FakeBluez(dbus.service.Object):
+    """
+    The adapter: org.bluez.Adapter1 properties, GattManager1 and
+    LEAdvertisingManager1
+    """
+
+    def __init__(self, bus, on_application=None):
+        """Summary
+
+        Args:
+            bus (dbus.Bus): Bus to claim org.bluez on
+            on_application (callable): Called with an Application once its
+                objects were read back
+        """
+        self.bus = bus
+        self.name = dbus.service.BusName(BLUEZ_SERVICE_NAME, bus)
+        self.properties = {
+            'Address': dbus.String('00:00:00:00:00:00'),
+            'Name': dbus.String('fakebluez'),
+            'Alias': dbus.String('fakebluez'),
+            'Powered': dbus.Boolean(False),
+            'Discoverable': dbus.Boolean(False),
+        }
+        self.applications = {}
+        self.advertisements = {}
+        self.on_application = on_application
+        dbus.service.Object.__init__(self, bus, ADAPTER_PATH)
+        self.root = Root(bus, self)
+        self.profile_manager = ProfileManager(bus)
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature='ss', out_signature='v')
+    def Get(self, interface, name):
+        if interface != ADAPTER_IFACE or name not in self.properties:
+            raise InvalidArgsException()
+        return self.properties[name]
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature='ssv')
+    def Set(self, interface, name, value):
+        if interface != ADAPTER_IFACE or name not in self.properties:
+            raise InvalidArgsException()
+        self.properties[name] = value
+        self.PropertiesChanged(ADAPTER_IFACE, { name: value }, [])
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature='s', out_signature='a{sv}')
+    def GetAll(self, interface):
+        if interface != ADAPTER_IFACE:
+            raise InvalidArgsException()
+        return self.properties
+
+    @dbus.service.signal(DBUS_PROP_IFACE, signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature='oa{sv}', sender_keyword='sender')
+    def RegisterApplication(self, path, options, sender=None):
+        key = (str(sender), str(path))
+        if key in self.applications:
+            raise AlreadyExistsException()
+        application = self.applications[key] = Application(*key)
+        print('fakebluez: application {} of {}'.format(path, sender))
+
+        def read(objects):
+            application.objects = objects
+            if self.on_application:
+                self.on_application(application)
+
+        manager = dbus.Interface(self.bus.get_object(sender, path, introspect=False), DBUS_OM_IFACE)
+        manager.GetManagedObjects(reply_handler=read,
+            error_handler=lambda e: print('fakebluez: cannot read application: {}'.format(e)))
+
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature='o', sender_keyword='sender')
+    def UnregisterApplication(self, path, sender=None):
+        if self.applications.pop((str(sender), str(path)), None) is None:
+            raise DoesNotExistException()
+
+    @dbus.service.method(LE_ADVERTISING_MANAGER_IFACE, in_signature='oa{sv}', sender_keyword='sender')
+    def RegisterAdvertisement(self, path, options, sender=None):
+        key = (str(sender), str(path))
+        if key in self.advertisements:
+            raise AlreadyExistsException()
+        self.advertisements[key] = None
+
+        def read(properties):
+            self.advertisements[key] = properties
+            print('fakebluez: advertising {}'.format(dict(properties)))
+
+        advertisement = dbus.Interface(self.bus.get_object(sender, path, introspect=False), DBUS_PROP_IFACE)
+        advertisement.GetAll(LE_ADVERTISEMENT_IFACE, reply_handler=read,
+            error_handler=lambda e: print('fakebluez: cannot read advertisement: {}'.format(e)))
+
+    @dbus.service.method(LE_ADVERTISING_MANAGER_IFACE, in_signature='o', sender_keyword='sender')
+    def UnregisterAdvertisement(self, path, sender=None):
+        if self.advertisements.pop((str(sender), str(path)), None) is None:
+            raise DoesNotExistException()
+
+
+class Central():
+
+    """A simulated client connected to a registered application.
+
+    Attributes:
+        application (Application): Application it talks to
+        device (str): Its device object path, tells its session apart
+        mtu (int): ATT MTU it negotiated
+    """
+
+    def __init__(self, bus, application, index=0, mtu=185):
+        """Summary
+
+        Args:
+            bus (dbus.Bus): Bus the application is on
+            application (Application): Application to talk to
+            index (int): Number of the central, picks its address
+            mtu (int): ATT MTU
+        """
+        self.bus = bus
+        self.application = application
+        self.device = '{}/dev_00_00_00_00_00_{:02X}'.format(ADAPTER_PATH, index & 0xff)
+        self.mtu = mtu
+
+    def options(self, **extra):
+        """Summary
+
+        Returns:
+            dbus.Dictionary: Options as BlueZ passes them, plus extra
+        """
+        options = {
+            'device': dbus.ObjectPath(self.device),
+            'mtu': dbus.UInt16(self.mtu),
+            'link': dbus.String('LE'),
+        }
+        options.update(extra)
+        return dbus.Dictionary(options, signature='sv')
+
+    def characteristic(self, path):
+        """Summary
+
+        Args:
+            path (str): Object path of a characteristic
+
+        Returns:
+            dbus.Interface: The characteristic, calls on it are sent as is
+        """
+        return dbus.Interface(self.bus.get_object(self.application.sender, path,
+            introspect=False), GATT_CHRC_IFACE)
+
+    def read(self, path, on_value, on_error):
+        """Read a value, as a long read if it does not fit one response.
+
+        Args:
+            path (str): Object path of the characteristic
+            on_value (callable): Called with the whole value (bytes)
+            on_error (callable): Called with the D-Bus error
+        """
+        chrc = self.characteristic(path)
+        value = bytearray()
+        page = self.mtu - 1
+
+        def read_at(offset):
+            chrc.ReadValue(self.options(offset=dbus.UInt16(offset)),
+                reply_handler=lambda data: received(bytes(data)), error_handler=on_error)
+
+        def received(data):
+            value.extend(data)
+            if len(data) == page:
+                read_at(len(value))
+            else:
+                on_value(bytes(value))
+
+        read_at(0)
+
+    def write(self, path, value, on_done, on_error, without_response=False):
+        """Write a value, as prepared writes if it does not fit one request.
+
+        Args:
+            path (str): Object path of the characteristic
+            value (bytes): Value
+            on_done (callable): Called once every write was answered
+            on_error (callable): Called with the D-Bus error
+            without_response (bool): Write commands instead of requests
+        """
+        chrc = self.characteristic(path)
+        if len(value) <= self.mtu - 3:
+            chrc.WriteValue(dbus.ByteArray(value),
+                self.options(type=dbus.String('command' if without_response else 'request')),
+                reply_handler=on_done, error_handler=on_error)
+            return
+
+        # Prepare writes carry mtu - 5 bytes; on execute BlueZ passes them on
+        # one by one, typed 'reliable', the first at offset 0.  Nothing marks
+        # the last one, the value ends at the next write at offset 0.
+        size = self.mtu - 5
+
+        def write_at(offset):
+            if offset >= len(value):
+                on_done()
+                return
+            chrc.WriteValue(dbus.ByteArray(value[offset:offset + size]),
+                self.options(offset=dbus.UInt16(offset), type=dbus.String('reliable')),
+                reply_handler=lambda: write_at(offset + size), error_handler=on_error)
+
+        write_at(0)
+
+    def start_notify(self, path, on_value, on_done, on_error):
+        """Subscribe to the notifications of a characteristic.
+
+        Notifications through StartNotify go to every subscribed client.
+
+        Args:
+            path (str): Object path of the characteristic
+            on_value (callable): Called with every notified value (bytes)
+            on_done (callable): Called once subscribed
+            on_error (callable): Called with the D-Bus error
+        """
+        def changed(interface, properties, invalidated):
+            if interface == GATT_CHRC_IFACE and 'Value' in properties:
+                on_value(bytes(properties['Value']))
+
+        self.bus.add_signal_receiver(changed, 'PropertiesChanged', DBUS_PROP_IFACE,
+            self.application.sender, path)
+        self.characteristic(path).StartNotify(reply_handler=on_done, error_handler=on_error)
+
+    def acquire_notify(self, path, on_value, on_done, on_error):
+        """Take the notifications of this central from a socket.
+
+        Args:
+            path (str): Object path of the characteristic
+            on_value (callable): Called with every notified value (bytes)
+            on_done (callable): Called with the socket once acquired
+            on_error (callable): Called with the D-Bus error
+        """
+        def acquired(fd, mtu):
+            sock = socket.socket(fileno=fd.take())
+            sock.setblocking(False)
+
+            def readable(source, condition):
+                while True:
+                    try:
+                        packet = sock.recv(int(mtu))
+                    except BlockingIOError:
+                        return True
+                    except OSError:
+                        packet = b''
+                    if not packet:
+                        return False
+                    on_value(packet)
+
+            GLib.io_add_watch(sock.fileno(), GLib.PRIORITY_DEFAULT,
+                GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, readable)
+            on_done(sock)
+
+        self.characteristic(path).AcquireNotify(self.options(),
+            reply_handler=acquired, error_handler=on_error)
+
+    def acquire_write(self, path, on_done, on_error):
+        """Get a socket to write without response through.
+
+        Args:
+            path (str): Object path of the characteristic
+            on_done (callable): Called with the socket and its MTU
+            on_error (callable): Called with the D-Bus error
+        """
+        def acquired(fd, mtu):
+            on_done(socket.socket(fileno=fd.take()), int(mtu))
+
+        self.characteristic(path).AcquireWrite(self.options(),
+            reply_handler=acquired, error_handler=on_error)
+
+
+def main():
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    fake = FakeBluez(dbus.SessionBus())
+    print('fakebluez: serving {} on the session bus'.format(ADAPTER_PATH))
+    try:
+        GLib.MainLoop().run()
+    except KeyboardInterrupt:
+        pass
+    return fake
+
+
+if __name__ == '__main__':
+    main()
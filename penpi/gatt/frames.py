@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""Framed command protocol of the shell.
+
+Every frame is a 5 byte header followed by its payload::
+
+    type (uint8) | id (uint16, little endian) | length (uint16, little endian) | payload
+
+The client sends ``RUN`` frames, the id chosen by the client and the
+command as payload; a request may span several writes.  Commands run one
+after the other in the client's shell, so a client can send many without
+waiting.  For every request the server sends ``STDOUT`` and ``STDERR``
+frames with the output and finally a ``DONE`` frame, its payload the exit
+status as a signed 32 bit integer.  Output the shell produces outside of a
+request, e.g. from background jobs, comes with id 0.
+
+Notifications and reads only ever carry whole frames, so each can be
+decoded on its own.  Output and error messages longer than a notification
+are split into several frames of the same type and id.
+
+Commands are told apart in the output by sentinel lines the shell prints
+after each of them, tagged with a random per-session nonce so command
+output cannot fake them.
+"""
+
+import os
+import struct
+from collections import deque
+
+
+HEADER = struct.Struct('<BHH')
+STATUS = struct.Struct('<i')
+
+RUN = 0x01
+
+STDOUT = 0x81
+STDERR = 0x82
+DONE = 0x83
+ERROR = 0x8f
+
+# Id of output that does not belong to a request
+UNSOLICITED = 0
+
+
+def encode(kind, ident, payload=b''):
+    """Summary
+
+    Args:
+        kind (int): Frame type
+        ident (int): Request id
+        payload (bytes): Payload, at most 65535 bytes
+
+    Returns:
+        bytes: The frame
+    """
+    return HEADER.pack(kind, ident, len(payload)) + bytes(payload)
+
+
+class FrameDecoder():
+
+    """Reassembles frames from writes that may split or join them.
+    """
+
+    def __init__(self, max_frame=64 * 1024):
+        """Summary
+
+        Args:
+            max_frame (int): Largest payload accepted
+        """
+        self.max_frame = max_frame
+        self.__buffer = bytearray()
+
+    def __len__(self):
+        return len(self.__buffer)
+
+    def feed(self, data):
+        """Summary
+
+        Args:
+            data (bytes): Bytes as written by the client
+
+        Returns:
+            list: (type, id, payload) of every frame completed
+
+        Raises:
+            ValueError: A frame is longer than max_frame, the buffer is dropped
+        """
+        self.__buffer += data
+        frames = []
+        while len(self.__buffer) >= HEADER.size:
+            kind, ident, length = HEADER.unpack_from(self.__buffer)
+            if length > self.max_frame:
+                self.__buffer = bytearray()
+                raise ValueError('frame of {} bytes'.format(length))
+            end = HEADER.size + length
+            if len(self.__buffer) < end:
+                break
+            frames.append((kind, ident, bytes(self.__buffer[HEADER.size:end])))
+            del self.__buffer[:end]
+        return frames
+
+
+def _quote(command):
+    return b"'" + command.replace(b"'", b"'\\''") + b"'"
+
+
+class FramedShell():
+
+    """Runs requests in a ShellSession and turns its output into frames.
+
+    Attributes:
+        session (ShellSession): Shell the requests run in
+        send (callable): Called with whole frames as output arrives, returns
+            False if it cannot take more right now; call resume() once it can
+        max_queued (int): Bytes of frames queued before output is held back
+    """
+
+    def __init__(self, session, send=None, max_queued=16 * 1024):
+        """Summary
+
+        Args:
+            session (ShellSession): Shell the requests run in
+            send (callable): Receives whole frames while notifying
+            max_queued (int): Bytes of frames queued before output is held back
+        """
+        self.session = session
+        self.send = send
+        self.max_queued = max_queued
+        self.decoder = FrameDecoder()
+
+        self.__nonce = b'\0' + os.urandom(4).hex().encode() + b':'
+        self.__requests = (deque(), deque())
+        self.__held = [b'', b'']
+        self.__status = {}
+        self.__stderr_done = set()
+        self.__frames = deque()
+        self.__queued = 0
+
+    @property
+    def queued(self):
+        """Summary
+
+        Returns:
+            int: Bytes of frames waiting to be sent or read
+        """
+        return self.__queued
+
+    def write(self, data):
+        """Handle bytes written by the client.
+
+        Args:
+            data (bytes): Part of one or more request frames
+        """
+        try:
+            frames = self.decoder.feed(data)
+        except ValueError as e:
+            self.__split(ERROR, UNSOLICITED, str(e).encode())
+            self.flush()
+            return
+
+        for kind, ident, payload in frames:
+            if kind == RUN and ident != UNSOLICITED:
+                self.run(ident, payload)
+            else:
+                self.__split(ERROR, ident, b'unknown request')
+        self.flush()
+
+    def run(self, ident, command):
+        """Queue a command in the shell.
+
+        The command runs through eval with stdin from /dev/null, so it
+        cannot swallow the requests queued behind it.
+
+        Args:
+            ident (int): Request id
+            command (bytes): Shell command
+        """
+        tag = self.__nonce + str(ident).encode()
+        self.session.write(b"eval " + _quote(command) + b" </dev/null; "
+            b"printf '" + tag.replace(b'\0', b'\\000') + b":%d\\n' $?; "
+            b"printf '" + tag.replace(b'\0', b'\\000') + b"\\n' >&2\n")
+        self.__requests[0].append(ident)
+        self.__requests[1].append(ident)
+
+    def feed(self, chunk, stderr=False):
+        """Turn shell output into frames, the send callback of the session.
+
+        Args:
+            chunk (memoryview): Output
+            stderr (bool): Whether it came from stderr
+
+        Returns:
+            bool: False while too many frames are queued, chunk was not taken
+        """
+        if self.__queued > self.max_queued:
+            return False
+        self.__parse(bytes(chunk), int(stderr))
+        self.flush()
+        return True
+
+    def poll(self):
+        """Take the output buffered in the session, for reads.
+        """
+        for stream, reader in enumerate((self.session.stdout, self.session.stderr)):
+            reader.pump()
+            self.__parse(reader.read(), stream)
+
+    def __parse(self, data, stream):
+        data = self.__held[stream] + data
+        requests = self.__requests[stream]
+        while data:
+            at = data.find(self.__nonce)
+            if at < 0:
+                # Hold back what may be the start of a sentinel.
+                keep = data.rfind(b'\0', max(len(data) - len(self.__nonce), 0))
+                if keep < 0 or not self.__nonce.startswith(data[keep:]):
+                    keep = len(data)
+                self.__output(stream, data[:keep])
+                data = data[keep:]
+                break
+
+            end = data.find(b'\n', at)
+            if end < 0:
+                self.__output(stream, data[:at])
+                data = data[at:]
+                break
+
+            self.__output(stream, data[:at])
+            fields = data[at + len(self.__nonce):end].split(b':')
+            data = data[end + 1:]
+            if requests:
+                self.__finish(stream, requests.popleft(), fields)
+        self.__held[stream] = data
+
+    def __output(self, stream, data):
+        requests = self.__requests[stream]
+        ident = requests[0] if requests else UNSOLICITED
+        self.__split(STDERR if stream else STDOUT, ident, data)
+
+    def __split(self, kind, ident, payload):
+        # One frame per notification of the negotiated size.
+        size = max(self.session.chunk_size - HEADER.size, 1)
+        for start in range(0, len(payload), size):
+            self.__queue(kind, ident, payload[start:start + size])
+
+    def __finish(self, stream, ident, fields):
+        # Done once both streams passed their sentinel, in whatever order
+        # their output was read.
+        if stream == 1:
+            if ident not in self.__status:
+                self.__stderr_done.add(ident)
+                return
+        else:
+            try:
+                status = int(fields[1])
+            except (IndexError, ValueError):
+                status = -1
+            if ident not in self.__stderr_done:
+                self.__status[ident] = status
+                return
+            self.__status[ident] = status
+            self.__stderr_done.discard(ident)
+        self.__queue(DONE, ident, STATUS.pack(self.__status.pop(ident)))
+
+    def __queue(self, kind, ident, payload):
+        frame = encode(kind, ident, payload)
+        self.__frames.append(frame)
+        self.__queued += len(frame)
+
+    def take(self, limit):
+        """Take whole frames, as many as fit.
+
+        Args:
+            limit (int): Most bytes to take, at least one frame is taken
+
+        Returns:
+            bytes: Frames, empty if none are queued
+        """
+        taken = []
+        size = 0
+        while self.__frames and (not taken or size + len(self.__frames[0]) <= limit):
+            frame = self.__frames.popleft()
+            taken.append(frame)
+            size += len(frame)
+        self.__queued -= size
+        return b''.join(taken)
+
+    def flush(self):
+        """Pass queued frames to send until it is blocked.
+        """
+        while self.send is not None and self.__frames:
+            data = self.take(self.session.chunk_size)
+            if not self.send(data):
+                self.__frames.appendleft(data)
+                self.__queued += len(data)
+                return
+
+    def resume(self):
+        """Send what queued up while send was blocked, then let output through.
+        """
+        self.flush()
+        self.session.resume()
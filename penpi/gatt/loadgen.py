@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""Load generator for the command characteristic, runnable off-device.
+
+Usage:
+    python3 -m penpi.gatt.loadgen [--centrals N] [--seconds S] [--mode MODE]
+        [--size BYTES] [--mtu MTU] [--min-rate OPS]
+
+Starts a private dbus-daemon, penpi.gatt.fakebluez on it and the GATT
+server in a child process registering with the fake.  Every simulated
+central then runs commands back to back in its own session: it writes a
+command printing ``--size`` bytes and a unique marker, and takes output
+until the marker arrived.  MODE is how output is taken:
+
+    read     long reads of ReadValue, polled
+    notify   StartNotify notifications, one central only as they go to all
+    acquire  AcquireWrite and AcquireNotify sockets
+
+Reports operations per second, latency percentiles and the bytes per
+second written and received, and exits non-zero below ``--min-rate``.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import dbus
+import dbus.mainloop.glib
+
+try:
+  from gi.repository import GLib
+except ImportError:
+  import glib as GLib
+
+from .fakebluez import FakeBluez, Central
+from .server import UUID_COMMAND
+
+
+class Stats():
+
+    """Counters of a load run.
+
+    Attributes:
+        latencies (list): Seconds from write to marker of every operation
+        written (int): Bytes written
+        received (int): Bytes of output received
+        errors (int): Failed D-Bus calls
+    """
+
+    def __init__(self):
+        """Summary
+        """
+        self.latencies = []
+        self.written = 0
+        self.received = 0
+        self.errors = 0
+        self.started = None
+        self.stopped = None
+
+    def percentile(self, fraction):
+        """Summary
+
+        Args:
+            fraction (float): 0.5 for the median
+
+        Returns:
+            float: Latency in seconds, 0 without operations
+        """
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+    def report(self, label):
+        """Summary
+
+        Args:
+            label (str): What ran
+
+        Returns:
+            float: Operations per second
+        """
+        seconds = max((self.stopped or time.monotonic()) - self.started, 1e-9)
+        rate = len(self.latencies) / seconds
+        print('loadgen: {}: {} ops in {:.1f} s, {:.1f} ops/s, {} errors'.format(
+            label, len(self.latencies), seconds, rate, self.errors))
+        print('loadgen: latency p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(
+            self.percentile(0.5) * 1e3, self.percentile(0.9) * 1e3, self.percentile(0.99) * 1e3,
+            max(self.latencies or [0]) * 1e3))
+        print('loadgen: written {:.1f} kB/s, received {:.1f} kB/s'.format(
+            self.written / seconds / 1e3, self.received / seconds / 1e3))
+        return rate
+
+
+class CommandClient():
+
+    """Runs commands back to back through one central.
+
+    Attributes:
+        central (Central): The central
+        path (str): Object path of the command characteristic
+        mode (str): 'read', 'notify' or 'acquire'
+        size (int): Bytes of output per command besides the marker
+    """
+
+    # Seconds between reads while output is awaited
+    POLL = 0.005
+
+    def __init__(self, central, path, mode, size, stats):
+        """Summary
+
+        Args:
+            central (Central): The central
+            path (str): Object path of the command characteristic
+            mode (str): 'read', 'notify' or 'acquire'
+            size (int): Bytes of output per command besides the marker
+            stats (Stats): Counters to add to
+        """
+        self.central = central
+        self.path = path
+        self.mode = mode
+        self.size = size
+        self.stats = stats
+        self.running = False
+
+        self.__index = int(central.device[-2:], 16)
+        self.__sequence = 0
+        self.__marker = None
+        self.__output = bytearray()
+        self.__scanned = 0
+        self.__sent = None
+        self.__write_socket = None
+
+    def start(self):
+        """Set up the mode, then send the first command.
+        """
+        self.running = True
+        if self.mode == 'notify':
+            self.central.start_notify(self.path, self.on_output, self.next, self.on_error)
+        elif self.mode == 'acquire':
+            def written(sock, mtu):
+                self.__write_socket = sock
+                self.next()
+            self.central.acquire_notify(self.path, self.on_output,
+                lambda sock: self.central.acquire_write(self.path, written, self.on_error),
+                self.on_error)
+        else:
+            self.next()
+
+    def stop(self):
+        """Summary
+        """
+        self.running = False
+
+    def next(self, *args):
+        """Send the next command.
+
+        Returns:
+            bool: None, so an idle or timeout source calling it is removed
+        """
+        if not self.running:
+            return
+        self.__sequence += 1
+        self.__marker = 'penpi-{}-{}'.format(self.__index, self.__sequence).encode()
+        self.__output = bytearray()
+        self.__scanned = 0
+
+        command = b"echo " + self.__marker + b"\n"
+        if self.size:
+            command = "head -c {} /dev/zero | tr '\\0' x; ".format(self.size).encode() + command
+        self.stats.written += len(command)
+        self.__sent = time.monotonic()
+
+        if self.__write_socket is not None:
+            packet = self.central.mtu - 3
+            for start in range(0, len(command), packet):
+                self.__write_socket.send(command[start:start + packet])
+        elif self.mode == 'read':
+            self.central.write(self.path, command, self.poll, self.on_error)
+        else:
+            self.central.write(self.path, command, lambda: None, self.on_error)
+
+    def poll(self):
+        """Read output until the marker is in.
+
+        Returns:
+            bool: False, for use as a timeout callback
+        """
+        if self.running:
+            self.central.read(self.path, self.on_read, self.on_error)
+        return False
+
+    def on_read(self, data):
+        if not self.on_output(data):
+            GLib.timeout_add(int(self.POLL * 1000), self.poll)
+
+    def on_output(self, data):
+        """Take output, and send the next command once the marker is in.
+
+        Args:
+            data (bytes): Output
+
+        Returns:
+            bool: Whether the marker arrived
+        """
+        self.stats.received += len(data)
+        self.__output.extend(data)
+        marker = self.__marker + b"\n"
+        at = self.__output.find(marker, max(self.__scanned - len(marker), 0))
+        self.__scanned = len(self.__output)
+        if at < 0:
+            return False
+
+        self.stats.latencies.append(time.monotonic() - self.__sent)
+        GLib.idle_add(self.next)
+        return True
+
+    def on_error(self, error):
+        self.stats.errors += 1
+        print('loadgen: {}: {}'.format(self.central.device, error))
+        if self.running:
+            GLib.timeout_add(100, self.next)
+
+
+def start_bus():
+    """Start a private dbus-daemon.
+
+    Returns:
+        tuple: (subprocess.Popen, bus address)
+    """
+    daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address'],
+        stdout=subprocess.PIPE)
+    address = daemon.stdout.readline().decode().strip()
+    if not address:
+        daemon.kill()
+        raise RuntimeError('dbus-daemon did not start')
+    return daemon, address
+
+
+def start_server(address, verbose=False):
+    """Run the GATT server in a child process, registering on the private bus.
+
+    Args:
+        address (str): Bus address
+        verbose (bool): Keep its output, it goes to /dev/null as on the device
+
+    Returns:
+        subprocess.Popen: The server
+    """
+    env = dict(os.environ)
+    env['DBUS_SESSION_BUS_ADDRESS'] = address
+    env['PENPI_BUS'] = 'session'
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [
+        os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+        env.get('PYTHONPATH')]))
+    return subprocess.Popen([sys.executable, '-c',
+        'from penpi.gatt.server import GattServer; GattServer.run()'], env=env,
+        stdout=None if verbose else subprocess.DEVNULL)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python3 -m penpi.gatt.loadgen',
+        description='Load the command characteristic through a fake BlueZ.')
+    parser.add_argument('--centrals', type=int, default=1)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--mode', choices=['read', 'notify', 'acquire'], default='acquire')
+    parser.add_argument('--size', type=int, default=0, help='bytes of output per command')
+    parser.add_argument('--mtu', type=int, default=185)
+    parser.add_argument('--min-rate', type=float, default=0, help='fail below this many ops/s')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the server')
+    args = parser.parse_args(argv)
+
+    if args.mode == 'notify' and args.centrals > 1:
+        parser.error('notify mode takes a single central')
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    daemon, address = start_bus()
+    server = None
+    mainloop = GLib.MainLoop()
+    stats = Stats()
+    clients = []
+
+    def finish():
+        stats.stopped = time.monotonic()
+        for client in clients:
+            client.stop()
+        mainloop.quit()
+        return False
+
+    def registered(application):
+        path = application.characteristic(UUID_COMMAND)
+        if path is None:
+            print('loadgen: no command characteristic')
+            mainloop.quit()
+            return
+        for index in range(args.centrals):
+            central = Central(bus, application, index + 1, args.mtu)
+            clients.append(CommandClient(central, path, args.mode, args.size, stats))
+        stats.started = time.monotonic()
+        for client in clients:
+            client.start()
+        GLib.timeout_add(int(args.seconds * 1000), finish)
+
+    def timed_out():
+        if stats.started is None:
+            print('loadgen: the server did not register')
+            mainloop.quit()
+        return False
+
+    try:
+        bus = dbus.bus.BusConnection(address)
+        fake = FakeBluez(bus, on_application=registered)
+        server = start_server(address, args.verbose)
+        GLib.timeout_add_seconds(15, timed_out)
+        mainloop.run()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        daemon.terminate()
+        daemon.wait()
+
+    if stats.started is None:
+        return 1
+    rate = stats.report('{} x {} centrals, {} bytes, MTU {}'.format(
+        args.mode, args.centrals, args.size, args.mtu))
+    return 0 if rate >= args.min_rate and not stats.errors else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
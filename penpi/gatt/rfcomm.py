@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""RFCOMM transport of the shell, for bulk output at RFCOMM speeds.
+
+Every connection gets a ``ShellSession`` from its own ``SessionPool``, with
+the semantics of the GATT shell: one shell per client kept across
+reconnects until it sits idle, input passed on in whole lines, stdout and
+stderr sent as they arrive.  The connection is a plain byte stream both
+ways.
+
+Connections are served from IO watches on the main loop, any number at
+once.  Output is buffered per connection up to ``max_buffered`` bytes and
+the shell's output is held back while the client does not keep up; input
+is read only while the shell keeps up with it, so a slow side pushes back
+on the other through the socket.
+
+BlueZ hands RFCOMM connections over through a registered ``Profile1``,
+which also publishes the SDP record.  ``listen()`` opens a listening socket
+instead: an RFCOMM channel, or a TCP or Unix socket standing in for it off
+the device.
+
+Attributes:
+    SERVICE_UUID (str): Serial port service of the shell
+"""
+
+import logging
+import os
+import socket
+
+try:
+  from gi.repository import GLib
+except ImportError:
+  import glib as GLib
+
+try:
+  import dbus
+  import dbus.service
+except ImportError:
+  dbus = None
+
+from .shell import SessionPool
+
+
+SERVICE_UUID = "a140ff7b-6539-40fe-9481-671108c144d6"
+
+DEFAULT_CHANNEL = 1
+
+PROFILE_MANAGER_IFACE = 'org.bluez.ProfileManager1'
+PROFILE_IFACE = 'org.bluez.Profile1'
+
+
+def listen(address, backlog=8):
+    """Open a listening socket.
+
+    Args:
+        address (str): ``rfcomm:CHANNEL``, ``tcp:HOST:PORT`` or ``unix:PATH``
+        backlog (int): Connections waiting to be accepted
+
+    Returns:
+        socket.socket: The socket, non-blocking
+
+    Raises:
+        ValueError: Unknown kind of address
+        OSError: The socket cannot be opened
+    """
+    kind, _, where = address.partition(':')
+    if kind == 'rfcomm':
+        sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+        sock.bind((socket.BDADDR_ANY, int(where or DEFAULT_CHANNEL)))
+    elif kind == 'tcp':
+        host, _, port = where.rpartition(':')
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host or '127.0.0.1', int(port)))
+    elif kind == 'unix':
+        if os.path.exists(where):
+            os.unlink(where)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(where)
+    else:
+        raise ValueError('unknown address {!r}'.format(address))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class Connection():
+
+    """A client attached to its shell session.
+
+    Attributes:
+        key (str): Identifies the client, its session is kept under it
+        sock (socket.socket): The connection
+        session (ShellSession): Shell of the client
+        max_buffered (int): Output buffered before the shell is held back
+        max_input (int): Input the shell may lag behind before reading stops
+        sent (int): Bytes sent
+        received (int): Bytes received
+    """
+
+    # Bytes taken from the shell's output at a time
+    CHUNK = 16 * 1024
+
+    def __init__(self, key, sock, session, max_buffered=256 * 1024, max_input=64 * 1024,
+            on_close=None):
+        """Summary
+
+        Args:
+            key (str): Identifies the client
+            sock (socket.socket): The connection
+            session (ShellSession): Shell of the client
+            max_buffered (int): Output buffered before the shell is held back
+            max_input (int): Input the shell may lag behind before reading stops
+            on_close (callable): Called with the connection once closed
+        """
+        self.key = key
+        self.sock = sock
+        self.session = session
+        self.max_buffered = max_buffered
+        self.max_input = max_input
+        self.sent = 0
+        self.received = 0
+
+        self.__on_close = on_close
+        self.__out = bytearray()
+        self.__held = False
+        self.__read_source = None
+        self.__write_source = None
+
+        sock.setblocking(False)
+        session.chunk_size = self.CHUNK
+        session.on_input_drained = self.__input_drained
+        session.start_notify(self.__queue)
+        self.__watch_input()
+
+    def __watch_input(self):
+        if self.__read_source is None:
+            self.__read_source = GLib.io_add_watch(self.sock.fileno(), GLib.PRIORITY_DEFAULT,
+                GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self.__readable)
+
+    def __readable(self, fd, condition):
+        try:
+            data = self.sock.recv(65536)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b''
+        if not data:
+            self.__read_source = None
+            self.close()
+            return False
+
+        self.received += len(data)
+        lines = self.session.input.write(data, None, False)
+        if lines:
+            self.session.write(lines)
+        if self.session.pending_input > self.max_input:
+            # Read on once the shell took its input.
+            self.__read_source = None
+            return False
+        return True
+
+    def __input_drained(self, session):
+        if self.sock.fileno() >= 0:
+            self.__watch_input()
+
+    def __queue(self, chunk, stderr):
+        # Send callback of the session.
+        if len(self.__out) >= self.max_buffered:
+            self.__held = True
+            return False
+        self.__out += chunk
+        self.__flush()
+        return True
+
+    def __flush(self, *args):
+        while self.__out:
+            try:
+                sent = self.sock.send(self.__out)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                logging.info('rfcomm: %s: %s', self.key, e)
+                self.__write_source = None
+                GLib.idle_add(self.close)
+                return False
+            self.sent += sent
+            del self.__out[:sent]
+
+        if self.__held and len(self.__out) < self.max_buffered // 2:
+            self.__held = False
+            self.session.resume()
+
+        if self.__out:
+            if self.__write_source is None:
+                self.__write_source = GLib.io_add_watch(self.sock.fileno(), GLib.PRIORITY_DEFAULT,
+                    GLib.IO_OUT | GLib.IO_ERR | GLib.IO_HUP, self.__flush)
+            return True
+        self.__write_source = None
+        return False
+
+    def close(self):
+        """Hang up, the session stays with its pool.
+
+        Returns:
+            bool: False, for use as an idle callback
+        """
+        if self.sock.fileno() < 0:
+            return False
+        for source in (self.__read_source, self.__write_source):
+            if source is not None:
+                GLib.source_remove(source)
+        self.__read_source = self.__write_source = None
+        self.session.stop_notify()
+        self.session.on_input_drained = None
+        self.sock.close()
+        logging.info('rfcomm: %s disconnected, %d bytes sent, %d received',
+            self.key, self.sent, self.received)
+        if self.__on_close:
+            self.__on_close(self)
+        return False
+
+
+class RfcommServer():
+
+    """Serves shell connections, one session per client.
+
+    Attributes:
+        pool (SessionPool): Sessions of the clients
+        connections (dict): Connection by client key
+        profile (Profile): BlueZ profile passing connections in, see register_profile()
+    """
+
+    def __init__(self, pool=None, **options):
+        """Summary
+
+        Args:
+            pool (SessionPool): Sessions, a pool of its own if None
+            **options: max_buffered and max_input of the connections
+        """
+        self.pool = pool or SessionPool(on_close=self.__session_closed)
+        self.connections = {}
+        self.options = options
+        self.profile = None
+
+        self.__listeners = {}
+        self.__count = 0
+
+    def start(self):
+        """Spawn the warm shells, from the main loop.
+        """
+        self.pool.start()
+
+    def serve(self, listener):
+        """Accept connections on a listening socket.
+
+        Clients of RFCOMM sockets are known by their address and get their
+        session back on reconnect, every other connection gets a session
+        of its own.
+
+        Args:
+            listener (socket.socket): Listening socket, see listen()
+        """
+        listener.setblocking(False)
+        self.__listeners[listener] = GLib.io_add_watch(listener.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN, self.__accept, listener)
+
+    def __accept(self, fd, condition, listener):
+        while True:
+            try:
+                sock, peer = listener.accept()
+            except BlockingIOError:
+                return True
+            except OSError as e:
+                logging.warning('rfcomm: accept failed: %s', e)
+                return True
+
+            if listener.family == getattr(socket, 'AF_BLUETOOTH', None):
+                key = 'rfcomm:{}'.format(peer[0])
+            else:
+                self.__count += 1
+                key = '{}:{}'.format('unix' if listener.family == socket.AF_UNIX else 'tcp', self.__count)
+            self.attach(key, sock)
+
+    def attach(self, key, sock):
+        """Attach a connected socket to the session of its client.
+
+        A client connecting again replaces its old connection.
+
+        Args:
+            key (str): Identifies the client
+            sock (socket.socket): The connection
+
+        Returns:
+            Connection: The connection
+        """
+        old = self.connections.get(key)
+        if old is not None:
+            old.close()
+
+        session = self.pool.get(key)
+        connection = self.connections[key] = Connection(key, sock, session,
+            on_close=self.__closed, **self.options)
+        logging.info('rfcomm: %s connected', key)
+        return connection
+
+    def disconnect(self, key):
+        """Summary
+
+        Args:
+            key (str): Identifies the client
+        """
+        connection = self.connections.get(key)
+        if connection is not None:
+            connection.close()
+
+    def __closed(self, connection):
+        if self.connections.get(connection.key) is connection:
+            del self.connections[connection.key]
+
+    def __session_closed(self, session):
+        # Reaped or replaced, the client loses its connection with it.
+        self.disconnect(session.device)
+
+    def stop(self):
+        """Close every connection, listener and session.
+        """
+        for listener, source in self.__listeners.items():
+            GLib.source_remove(source)
+            listener.close()
+        self.__listeners = {}
+        for connection in list(self.connections.values()):
+            connection.close()
+        self.pool.stop()
+
+
+if dbus is not None:
+
+    class Profile(dbus.service.Object):
+        """
+        org.bluez.Profile1 implementation, BlueZ passes RFCOMM connections in
+        """
+        PATH = '/org/penpi/rfcomm'
+
+        def __init__(self, bus, server):
+            self.server = server
+            dbus.service.Object.__init__(self, bus, self.PATH)
+
+        @dbus.service.method(PROFILE_IFACE, in_signature='', out_signature='')
+        def Release(self):
+            print('RFCOMM profile released')
+
+        @dbus.service.method(PROFILE_IFACE, in_signature='oha{sv}', out_signature='')
+        def NewConnection(self, device, fd, properties):
+            self.server.attach(str(device), socket.socket(fileno=fd.take()))
+
+        @dbus.service.method(PROFILE_IFACE, in_signature='o', out_signature='')
+        def RequestDisconnection(self, device):
+            self.server.disconnect(str(device))
+
+
+def register_profile(bus, server, channel=DEFAULT_CHANNEL):
+    """Have BlueZ accept RFCOMM connections for server and publish the SDP record.
+
+    Args:
+        bus (dbus.Bus): Bus BlueZ is on
+        server (RfcommServer): Server to pass the connections to
+        channel (int): RFCOMM channel
+
+    Returns:
+        Profile: The registered profile, the same one every time for server
+    """
+    if server.profile is None:
+        server.profile = Profile(bus, server)
+    profile = server.profile
+    manager = dbus.Interface(bus.get_object('org.bluez', '/org/bluez'), PROFILE_MANAGER_IFACE)
+    manager.RegisterProfile(profile.PATH, SERVICE_UUID, {
+            'Name': 'PenPi Service',
+            'Role': 'server',
+            'Channel': dbus.UInt16(channel),
+            'RequireAuthentication': dbus.Boolean(True),
+            'AutoConnect': dbus.Boolean(False),
+        },
+        reply_handler=lambda: print('RFCOMM profile registered'),
+        error_handler=lambda error: print('Failed to register RFCOMM profile: ' + str(error)))
+    return profile
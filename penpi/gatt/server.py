@@ -6,17 +6,22 @@ import dbus.mainloop.glib
 import dbus.service
 
 import array
+import logging
 try:
-  from gi.repository import GObject
+  from gi.repository import GLib
 except ImportError:
-  import gobject as GObject
+  import glib as GLib
 import sys
 import os
+import socket
 import subprocess
+import time
 
 from random import randint
 
-mainloop = None
+from penpi import loop, metrics, profile
+
+application = None
 
 BLUEZ_SERVICE_NAME = 'org.bluez'
 GATT_MANAGER_IFACE = 'org.bluez.GattManager1'
@@ -42,6 +47,9 @@ class InvalidValueLengthException(dbus.exceptions.DBusException):
 class FailedException(dbus.exceptions.DBusException):
     _dbus_error_name = 'org.bluez.Error.Failed'
 
+class InvalidOffsetException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.InvalidOffset'
+
 
 
 class Application(dbus.service.Object):
@@ -53,6 +61,7 @@ class Application(dbus.service.Object):
         self.services = []
         dbus.service.Object.__init__(self, bus, self.path)
         self.add_service(PenpiService(bus, 0))
+        self.add_service(TransferService(bus, 1))
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
@@ -193,6 +202,20 @@ class Characteristic(dbus.service.Object):
         print('Default StartNotify called, returning error')
         raise NotSupportedException()
 
+    @dbus.service.method(GATT_CHRC_IFACE,
+                        in_signature='a{sv}',
+                        out_signature='hq')
+    def AcquireWrite(self, options):
+        print('Default AcquireWrite called, returning error')
+        raise NotSupportedException()
+
+    @dbus.service.method(GATT_CHRC_IFACE,
+                        in_signature='a{sv}',
+                        out_signature='hq')
+    def AcquireNotify(self, options):
+        print('Default AcquireNotify called, returning error')
+        raise NotSupportedException()
+
     @dbus.service.method(GATT_CHRC_IFACE)
     def StopNotify(self):
         print('Default StopNotify called, returning error')
@@ -254,11 +277,28 @@ class Descriptor(dbus.service.Object):
 ##################################################################################
 ##################################################################################
 
-from .NonBlockingStream import NonBlockingStreamReader
+from .shell import SessionPool
+from .frames import FramedShell
+from .compress import Pager, read_size
+from .transfer import TransferManager, CHUNK
 
 UUID_PENPI_SERVICE  = "999d97c6-0e31-4b46-b8cb-ef4c2c918c00"
 UUID_COMMAND        = "999d97c6-0e31-4b46-b8cb-ef4c2c918c01"
 UUID_OUTPUT_READY   = "999d97c6-0e31-4b46-b8cb-ef4c2c918c02"
+UUID_FRAMES         = "999d97c6-0e31-4b46-b8cb-ef4c2c918c03"
+
+UUID_TRANSFER_SERVICE = "999d97c6-0e31-4b46-b8cb-ef4c2c918d00"
+UUID_TRANSFER_CONTROL = "999d97c6-0e31-4b46-b8cb-ef4c2c918d01"
+UUID_TRANSFER_DATA    = "999d97c6-0e31-4b46-b8cb-ef4c2c918d02"
+
+# Longest attribute value ATT allows, a read at offset 0 takes at most this
+MAX_VALUE_LENGTH    = 512
+
+# Pages of output read at a time when pages are compressed
+COMPRESSED_READ     = 4
+
+# ATT MTU assumed until BlueZ reports the negotiated one
+DEFAULT_MTU         = 23
 
 class PenpiService(Service):
     UUID = UUID_PENPI_SERVICE
@@ -266,12 +306,42 @@ class PenpiService(Service):
     def __init__(self, bus, index):
         Service.__init__(self, bus, index, UUID_PENPI_SERVICE, True)
         self.add_characteristic(CommandCharacteristic(bus, 0, self))
+        self.add_characteristic(FrameCharacteristic(bus, 1, self))
+
+
+class AcquiredSocket():
+    """
+    Our end of a socket handed to BlueZ by AcquireWrite or AcquireNotify.
+    """
+
+    def __init__(self, options):
+        # One end for BlueZ, the other stays here, packets keep their bounds.
+        self.mtu = int(options.get('mtu', DEFAULT_MTU))
+        self.socket, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.socket.setblocking(False)
+        self.fd = dbus.types.UnixFd(theirs.fileno())
+        theirs.close()
+        self.watches = []
+
+    def watch(self, condition, callback):
+        self.watches.append(GLib.io_add_watch(self.socket.fileno(),
+            GLib.PRIORITY_DEFAULT, condition, callback))
+
+    def close(self):
+        for source in self.watches:
+            GLib.source_remove(source)
+        self.watches = []
+        self.socket.close()
 
 
 class CommandCharacteristic(Characteristic):
     """
-    Dummy test characteristic requiring secure connection.
+    Shell characteristic requiring secure connection, a shell per client.
 
+    Clients are told apart by the 'device' option BlueZ passes.  StartNotify
+    has no options, so notifications set up through it go to every
+    subscribed client and carry the output of every session that is not
+    notifying through an acquired socket.
     """
     UUID = UUID_COMMAND
 
@@ -279,103 +349,529 @@ class CommandCharacteristic(Characteristic):
         Characteristic.__init__(
                 self, bus, index,
                 self.UUID,
-                ['secure-read', 'secure-write', 'notify'],
+                ['secure-read', 'secure-write', 'write-without-response', 'notify'],
                 service)
         self.value = []
 
-        self.bash = subprocess.Popen(['/bin/bash'], 
-            stdin=subprocess.PIPE, 
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.PIPE, 
-            universal_newlines=True,
-            bufsize=0)
-        
-        self.notifying = False
-        self.bash_stdout = NonBlockingStreamReader(self.bash.stdout)
-        self.bash_stderr = NonBlockingStreamReader(self.bash.stderr)
+        # Sockets handed to BlueZ by AcquireWrite and AcquireNotify, per
+        # session; writes and notifications then bypass D-Bus.
+        self.write_sockets = {}
+        self.notify_sockets = {}
 
-        self.WriteStdIn("cd /home/pi/\n")
+        # Sessions that negotiated compressed pages
+        self.pagers = {}
+
+        self.notifying = False
+        self.sessions = SessionPool(on_open=self.OnSessionOpen, on_close=self.OnSessionClose)
+        self.sessions.start()
+
+        # Labelled with the UUID, so the frame characteristic counts apart.
+        labels = {'uuid': self.UUID}
+        self.reads = metrics.counter('penpi_gatt_reads_total', 'ReadValue calls', labels)
+        self.read_bytes = metrics.counter('penpi_gatt_read_bytes_total',
+            'Bytes returned by ReadValue', labels)
+        self.read_seconds = metrics.histogram('penpi_gatt_read_seconds',
+            'Time spent in ReadValue', labels)
+        self.writes = metrics.counter('penpi_gatt_writes_total',
+            'Writes through WriteValue or an acquired socket', labels)
+        self.write_bytes = metrics.counter('penpi_gatt_write_bytes_total',
+            'Bytes written by clients', labels)
+        self.write_seconds = metrics.histogram('penpi_gatt_write_seconds',
+            'Time spent handling a write', labels)
+        self.notifications = metrics.counter('penpi_gatt_notifications_total',
+            'Notifications sent through D-Bus or an acquired socket', labels)
+        self.notify_bytes = metrics.counter('penpi_gatt_notify_bytes_total',
+            'Bytes sent as notifications', labels)
+        metrics.gauge('penpi_gatt_sessions', 'Shell sessions of clients', labels,
+            function=lambda: len(self.sessions))
+        metrics.gauge('penpi_gatt_buffered_bytes', 'Shell output read but not yet sent', labels,
+            function=self.Buffered)
 
         #self.add_descriptor(TestSecureDescriptor(bus, 2, self))
         # self.add_descriptor(
         #         CharacteristicUserDescriptionDescriptor(bus, 3, self))
 
-    def WriteStdIn(self, data):
-        self.bash.stdin.write(data)
-        self.bash.stdin.flush()
+    def get_properties(self):
+        properties = Characteristic.get_properties(self)
+        properties[GATT_CHRC_IFACE]['WriteAcquired'] = dbus.Boolean(len(self.write_sockets) > 0)
+        properties[GATT_CHRC_IFACE]['NotifyAcquired'] = dbus.Boolean(len(self.notify_sockets) > 0)
+        return properties
+
+    def Buffered(self):
+        return sum(len(session.stdout) + len(session.stderr)
+            for session in self.sessions.sessions())
+
+    def Written(self, value, started):
+        # A write was handled, started is its time.perf_counter().
+        self.writes.inc()
+        self.write_bytes.inc(len(value))
+        self.write_seconds.observe(time.perf_counter() - started)
+
+    def Session(self, options):
+        session = self.sessions.get(options.get('device'))
+        if 'mtu' in options:
+            self.SetPageSize(session, max(int(options['mtu']) - 3, 1))
+        return session
+
+    def SetPageSize(self, session, size):
+        # Compressed pages take more output than fits a page uncompressed,
+        # but output sent raw must still fill whole pages.
+        pager = self.pagers.get(session)
+        if pager is None:
+            session.chunk_size = size
+        else:
+            pager.page_size = size
+            session.chunk_size = read_size(size, COMPRESSED_READ)
+
+    def OnSessionOpen(self, session):
+        if self.notifying:
+            self.Attach(session, self.NotifyValue)
+
+    def OnSessionClose(self, session):
+        self.ReleaseWrite(session)
+        self.ReleaseNotify(session)
+        pager = self.pagers.pop(session, None)
+        if pager is not None:
+            print('Compression of {}: {:.2f} of {} bytes, {:.3f} s'.format(session.device,
+                pager.compressor.ratio, pager.compressor.raw_bytes, pager.compressor.cpu_seconds))
+
+    def Attach(self, session, send):
+        # Pass the output of session to send as it arrives.
+        session.start_notify(lambda chunk, stderr: self.SendPaged(session, send, chunk, stderr))
+
+    def SendPaged(self, session, send, chunk, stderr):
+        pager = self.pagers.get(session)
+        if pager is None:
+            return send(chunk, stderr)
+
+        pager.send = lambda page: send(page, stderr)
+        if not pager.flush():
+            return False
+        pager.add(chunk)
+        pager.flush()
+        return True
+
+    def Detach(self, session):
+        session.stop_notify()
+
+    def Resume(self, session):
+        pager = self.pagers.get(session)
+        if pager is None or pager.flush():
+            session.resume()
+
+    def HandleWrite(self, session, value, offset=None, end=True):
+        """A write from the client, through WriteValue or the acquired socket.
+
+        Writes are reassembled by the session's input buffer, the shell only
+        gets whole lines.  A write starting with a NUL byte negotiates the
+        page format instead, see penpi.gatt.compress.
+
+        Raises:
+            InvalidOffsetException: offset is past the end of the value
+        """
+        data = bytes(value)
+        if data[:1] == b"\0" and not offset and (end or not len(session.input)):
+            if offset == 0:
+                # A new value, input a long write left open ends first.
+                self.Input(session, session.input.write(b"", 0, False))
+            self.Negotiate(session, data[1:].strip())
+            return
+        try:
+            lines = session.input.write(data, offset, end)
+        except ValueError:
+            raise InvalidOffsetException()
+        self.Input(session, lines)
+
+    def Input(self, session, lines):
+        if lines:
+            logging.debug('Command Received: %r', lines)
+            session.write(lines)
+
+    def Negotiate(self, session, request):
+        size = self.pagers[session].page_size if session in self.pagers else session.chunk_size
+        if request == b"deflate":
+            self.pagers.setdefault(session, Pager())
+        elif request == b"raw":
+            self.pagers.pop(session, None)
+        else:
+            print('Unknown page format: {}'.format(request))
+            return
+        self.SetPageSize(session, size)
 
-    def ReadStdOut(self):
-        _data = bytearray()
-        while True:
-            _char = self.bash_stdout.readchar(0.1)
-            if not _char:
-                break
-            else:
-                _data += _char.encode()
-        self.bash_stdout.ready = False
-        return bytes(_data)
-        
-    def ReadStdErr(self):
-        _data = bytearray()
-        while True:
-            _char = self.bash_stderr.readchar(0.1)
-            if not _char:
-                break
-            else:
-                _data += _char.encode()
-        self.bash_stderr.ready = False
+    def TakeOutput(self, session):
+        # New output for a read at offset 0, never waits for more.
+        pager = self.pagers.get(session)
+        if pager is None:
+            return session.read(MAX_VALUE_LENGTH)
 
-        return bytes(_data)
+        if not len(pager):
+            pager.add(session.read(read_size(MAX_VALUE_LENGTH, COMPRESSED_READ)), MAX_VALUE_LENGTH)
+        return pager.take() or b""
 
     def ReadValue(self, options):
+        """Page through the output.
+
+        A read at offset 0 takes up to MAX_VALUE_LENGTH bytes of new output
+        as the snapshot, reads at a later offset (long reads) page through
+        that same snapshot, a page at most mtu - 1 bytes long.
+        """
+        started = time.perf_counter()
+        offset = int(options.get('offset', 0))
+        mtu = int(options.get('mtu', 0))
+        session = self.Session(options)
+
+        if offset == 0:
+            try:
+                command_output = self.TakeOutput(session)
+            except Exception as e:
+                print(e)
+                raise FailedException(str(e))
+
+            session.snapshot = command_output
+            logging.debug('Command Read: %r', command_output)
+        elif offset > len(session.snapshot):
+            raise InvalidOffsetException()
+
+        if mtu > 1:
+            value = session.snapshot[offset:offset + mtu - 1]
+        else:
+            value = session.snapshot[offset:]
+        self.reads.inc()
+        self.read_bytes.inc(len(value))
+        self.read_seconds.observe(time.perf_counter() - started)
+        return value
 
+    def WriteValue(self, value, options):
+        """Write to the shell, without response if the client asked so.
+
+        BlueZ passes the prepare writes of a long write one by one on
+        execute, typed 'reliable' and each with its offset; the value may go
+        on until the next write at offset 0, so clients end such input with
+        a newline.  Writes typed 'request' or 'command' are whole values.
+        """
+        started = time.perf_counter()
+        offset = int(options.get('offset', 0))
+        reliable = options.get('type') == 'reliable'
         try:
-            command_output = self.ReadStdOut()
-            command_output += self.ReadStdErr()
+            self.HandleWrite(self.Session(options), value, offset, not reliable)
+        except InvalidOffsetException:
+            raise
+        except Exception as e:
+            print(e)
+        self.Written(value, started)
 
-            print('Command Read: {}'.format(command_output.decode()))
+    def AcquireWrite(self, options):
+        """Hand BlueZ a socket to send the client's writes through.
 
-            return command_output
-        except Exception as e:
+        Returns:
+            tuple: (socket fd, MTU)
+        """
+        session = self.Session(options)
+        self.ReleaseWrite(session)
+
+        acquired = AcquiredSocket(options)
+        acquired.watch(GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+            lambda fd, condition: self.OnAcquiredWrite(session, acquired))
+        self.write_sockets[session] = acquired
+        self.PropertiesChanged(GATT_CHRC_IFACE, { 'WriteAcquired': dbus.Boolean(True) }, [])
+        return acquired.fd, dbus.UInt16(acquired.mtu)
+
+    def OnAcquiredWrite(self, session, acquired):
+        while True:
+            try:
+                packet = acquired.socket.recv(max(acquired.mtu, MAX_VALUE_LENGTH))
+            except BlockingIOError:
+                return True
+            except OSError:
+                packet = b""
+            if not packet:
+                # BlueZ closed its end, the client went away.
+                acquired.watches = []
+                self.ReleaseWrite(session)
+                return False
+            started = time.perf_counter()
+            try:
+                # A stream of write commands, newlines end the input.
+                self.HandleWrite(session, packet, None, False)
+            except Exception as e:
+                print(e)
+            self.Written(packet, started)
+
+    def ReleaseWrite(self, session):
+        acquired = self.write_sockets.pop(session, None)
+        if acquired is None:
+            return
+        acquired.close()
+        if not self.write_sockets:
+            self.PropertiesChanged(GATT_CHRC_IFACE, { 'WriteAcquired': dbus.Boolean(False) }, [])
+
+    def AcquireNotify(self, options):
+        """Hand BlueZ a socket to take the notifications of one client from.
+
+        BlueZ closes its end once the client unsubscribes.
+
+        Returns:
+            tuple: (socket fd, MTU)
+        """
+        session = self.Session(options)
+        self.ReleaseNotify(session)
+
+        acquired = AcquiredSocket(options)
+        acquired.watch(GLib.IO_HUP | GLib.IO_ERR,
+            lambda fd, condition: self.OnNotifyClosed(session, acquired))
+        self.notify_sockets[session] = acquired
+        self.PropertiesChanged(GATT_CHRC_IFACE, { 'NotifyAcquired': dbus.Boolean(True) }, [])
+
+        self.SetPageSize(session, max(acquired.mtu - 3, 1))
+        self.Attach(session, lambda chunk, stderr: self.SendNotify(session, acquired, chunk))
+        return acquired.fd, dbus.UInt16(acquired.mtu)
+
+    def SendNotify(self, session, acquired, chunk):
+        try:
+            acquired.socket.send(chunk)
+        except BlockingIOError:
+            # Resume once BlueZ took some notifications off the socket.
+            def writable(fd, condition):
+                acquired.watches.remove(source)
+                self.Resume(session)
+                return False
+            source = GLib.io_add_watch(acquired.socket.fileno(),
+                GLib.PRIORITY_DEFAULT, GLib.IO_OUT, writable)
+            acquired.watches.append(source)
+            return False
+        except OSError as e:
             print(e)
+        else:
+            self.notifications.inc()
+            self.notify_bytes.inc(len(chunk))
+        return True
+
+    def OnNotifyClosed(self, session, acquired):
+        acquired.watches.pop(0)
+        self.ReleaseNotify(session)
+        return False
+
+    def ReleaseNotify(self, session):
+        acquired = self.notify_sockets.pop(session, None)
+        if acquired is None:
+            return
+        self.Detach(session)
+        acquired.close()
+        if self.notifying:
+            self.Attach(session, self.NotifyValue)
+        if not self.notify_sockets:
+            self.PropertiesChanged(GATT_CHRC_IFACE, { 'NotifyAcquired': dbus.Boolean(False) }, [])
 
-    def WriteValue(self, value, options):
+    def NotifyValue(self, chunk, stderr=False):
         try:
-            print(value)
-            command = (''.join([chr(c) for c in value]))
-            print('Command Received: ' + command)
-            self.WriteStdIn("{}\n".format(command))
+            self.PropertiesChanged(GATT_CHRC_IFACE, { 'Value': dbus.ByteArray(bytes(chunk)) }, [])
         except Exception as e:
             print(e)
+        else:
+            self.notifications.inc()
+            self.notify_bytes.inc(len(chunk))
+        return True
 
     def StartNotify(self):
+        """Send output as notifications from now on, starting with what is buffered.
+        """
+        if self.notifying:
+            return
         self.notifying = True
-        self.DataCheck()
 
+        for session in self.sessions.sessions():
+            if session not in self.notify_sockets:
+                self.Attach(session, self.NotifyValue)
 
     def StopNotify(self):
+        """Remove every watch, nothing wakes up until the next StartNotify.
+        """
         self.notifying = False
 
-    def DataCheck(self):
-        if self.notifying:
-            try:
-                if self.bash_stdout.ready or self.bash_stderr.ready:
-                    print("Data available!")
-                    self.PropertiesChanged(GATT_CHRC_IFACE, { 'Value': [dbus.Byte(0x01)] }, [])
-            except Exception as e:
-                print(e)
+        for session in self.sessions.sessions():
+            if session not in self.notify_sockets:
+                self.Detach(session)
+
+
+class FrameCharacteristic(CommandCharacteristic):
+    """
+    Framed, pipelined shell, see penpi.gatt.frames for the protocol.
+
+    Same transport as the command characteristic, with sessions of its own.
+    """
+    UUID = UUID_FRAMES
+
+    def __init__(self, bus, index, service):
+        self.framed = {}
+        CommandCharacteristic.__init__(self, bus, index, service)
 
-        GObject.timeout_add(500, self.DataCheck)
-            
+    def Framed(self, session):
+        framed = self.framed.get(session)
+        if framed is None:
+            framed = self.framed[session] = FramedShell(session)
+        return framed
+
+    def OnSessionClose(self, session):
+        CommandCharacteristic.OnSessionClose(self, session)
+        self.framed.pop(session, None)
+
+    def Attach(self, session, send):
+        framed = self.Framed(session)
+        framed.send = lambda frames: send(frames, False)
+        session.start_notify(framed.feed)
+
+    def Detach(self, session):
+        session.stop_notify()
+        self.Framed(session).send = None
+
+    def Resume(self, session):
+        self.Framed(session).resume()
+
+    def HandleWrite(self, session, value, offset=None, end=True):
+        # Frames carry their own length, writes are simply appended.
+        self.Framed(session).write(bytes(value))
+
+    def TakeOutput(self, session):
+        framed = self.Framed(session)
+        framed.poll()
+        return framed.take(MAX_VALUE_LENGTH)
+
+
+
+class TransferService(Service):
+    """
+    Bulk file transfer to and from the scripts directory, see
+    penpi.gatt.transfer for the protocol.
+    """
+    UUID = UUID_TRANSFER_SERVICE
+
+    def __init__(self, bus, index):
+        Service.__init__(self, bus, index, UUID_TRANSFER_SERVICE, True)
+        self.transfers = TransferManager()
+        self.data = TransferDataCharacteristic(bus, 1, self)
+        self.control = TransferControlCharacteristic(bus, 0, self)
+        self.add_characteristic(self.control)
+        self.add_characteristic(self.data)
+
+    def Notify(self, controls, chunks=()):
+        for message in controls:
+            self.control.NotifyValue(message)
+        for message in chunks:
+            self.data.NotifyValue(message)
+
+
+class TransferCharacteristic(Characteristic):
+    """
+    Notifies every subscribed client, transfers are told apart by the
+    'device' option of their writes.
+    """
+
+    def __init__(self, bus, index, uuid, flags, service):
+        Characteristic.__init__(self, bus, index, uuid, flags, service)
+        self.notifying = False
+
+    def NotifyValue(self, message):
+        if not self.notifying:
+            return
+        try:
+            self.PropertiesChanged(GATT_CHRC_IFACE, { 'Value': dbus.ByteArray(message) }, [])
+        except Exception as e:
+            print(e)
+
+    def StartNotify(self):
+        self.notifying = True
+
+    def StopNotify(self):
+        self.notifying = False
+
+
+class TransferControlCharacteristic(TransferCharacteristic):
+    """
+    Requests of the client, answered by notifications.
+    """
+    UUID = UUID_TRANSFER_CONTROL
+
+    def __init__(self, bus, index, service):
+        TransferCharacteristic.__init__(
+                self, bus, index,
+                self.UUID,
+                ['secure-write', 'notify'],
+                service)
+
+    def WriteValue(self, value, options):
+        # Download chunks fill a notification of the client's MTU.
+        mtu = int(options.get('mtu', DEFAULT_MTU))
+        self.service.Notify(*self.service.transfers.control(options.get('device'),
+            bytes(value), max(mtu - 3 - CHUNK.size, 1)))
+
+
+class TransferDataCharacteristic(TransferCharacteristic):
+    """
+    Chunks of the file, written without response by uploads, notified to
+    downloads.  AcquireWrite hands uploads a socket that bypasses D-Bus.
+    """
+    UUID = UUID_TRANSFER_DATA
+
+    def __init__(self, bus, index, service):
+        TransferCharacteristic.__init__(
+                self, bus, index,
+                self.UUID,
+                ['secure-write', 'write-without-response', 'notify'],
+                service)
+        self.write_sockets = {}
+
+    def get_properties(self):
+        properties = Characteristic.get_properties(self)
+        properties[GATT_CHRC_IFACE]['WriteAcquired'] = dbus.Boolean(len(self.write_sockets) > 0)
+        return properties
+
+    def WriteValue(self, value, options):
+        self.service.Notify(self.service.transfers.data(options.get('device'), bytes(value)))
+
+    def AcquireWrite(self, options):
+        device = options.get('device')
+        self.ReleaseWrite(device)
+
+        acquired = AcquiredSocket(options)
+        acquired.watch(GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+            lambda fd, condition: self.OnAcquiredWrite(device, acquired))
+        self.write_sockets[device] = acquired
+        self.PropertiesChanged(GATT_CHRC_IFACE, { 'WriteAcquired': dbus.Boolean(True) }, [])
+        return acquired.fd, dbus.UInt16(acquired.mtu)
+
+    def OnAcquiredWrite(self, device, acquired):
+        while True:
+            try:
+                packet = acquired.socket.recv(max(acquired.mtu, MAX_VALUE_LENGTH))
+            except BlockingIOError:
+                return True
+            except OSError:
+                packet = b""
+            if not packet:
+                # The client went away, its upload resumes on reconnect.
+                acquired.watches = []
+                self.ReleaseWrite(device)
+                self.service.transfers.close(device)
+                return False
+            self.service.Notify(self.service.transfers.data(device, packet))
+
+    def ReleaseWrite(self, device):
+        acquired = self.write_sockets.pop(device, None)
+        if acquired is None:
+            return
+        acquired.close()
+        if not self.write_sockets:
+            self.PropertiesChanged(GATT_CHRC_IFACE, { 'WriteAcquired': dbus.Boolean(False) }, [])
 
 
 def register_app_cb():
     print('GATT application registered')
+    profile.mark('gatt')
 
 
 def register_app_error_cb(error):
+    # The rest of the daemon runs on, registration is retried once BlueZ restarts.
     print('Failed to register application: ' + str(error))
-    mainloop.quit()
 
 
 def find_adapter(bus):
@@ -391,30 +887,40 @@ def find_adapter(bus):
 
 
 class GattServer():
-    def run():
-        global mainloop
+    def start(bus):
+        """Register the GATT application, it is served by the main loop.
 
-        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        Args:
+            bus (dbus.Bus): System bus, set up with the GLib main loop
 
-        bus = dbus.SystemBus()
+        Returns:
+            bool: Whether registration was started
+        """
+        global application
 
         adapter = find_adapter(bus)
         if not adapter:
             print('GattManager1 interface not found')
-            return
+            return False
 
         service_manager = dbus.Interface(
                 bus.get_object(BLUEZ_SERVICE_NAME, adapter),
                 GATT_MANAGER_IFACE)
 
-        app = Application(bus)
-
-        mainloop = GObject.MainLoop()
+        # Registered again as is when BlueZ restarts.
+        if application is None:
+            with profile.section('setup gatt'):
+                application = Application(bus)
 
         print('Registering GATT application...')
 
-        service_manager.RegisterApplication(app.get_path(), {},
+        service_manager.RegisterApplication(application.get_path(), {},
                                         reply_handler=register_app_cb,
                                         error_handler=register_app_error_cb)
+        return True
+
+    def run():
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
-        mainloop.run()
+        if GattServer.start(loop.bluez_bus()):
+            loop.run()
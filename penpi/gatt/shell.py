@@ -0,0 +1,567 @@
+#!/usr/bin/env python3
+"""Shell sessions for the clients of the GATT shell.
+
+Every connected central gets its own ``ShellSession``: a shell with its own
+working directory and output buffers.  ``SessionPool`` keys the sessions by
+the BlueZ device object path, keeps a few shells spawned ahead of time so
+the first command of a new client does not wait for bash to start, and
+reaps sessions nobody used for a while.
+
+Input reaches a shell through an ``InputBuffer``, which puts writes split
+over several ATT packets back together and only lets whole lines through.
+
+Shells run in their own process group with resource limits applied, so a
+runaway command cannot take the daemon down with it.
+
+Attributes:
+    DEFAULT_LIMITS (dict): resource.RLIMIT_* name to limit applied to shells
+"""
+
+import logging
+import os
+import resource
+import signal
+import subprocess
+import time
+
+try:
+  from gi.repository import GLib
+except ImportError:
+  import glib as GLib
+
+from .NonBlockingStream import StreamReader
+
+
+# No address space limit, apt or numpy need more than a small Pi has
+# anyway; pass limits with RLIMIT_AS to cap it.
+DEFAULT_LIMITS = {
+    'RLIMIT_NOFILE': 256,
+    'RLIMIT_CORE': 0,
+}
+
+
+def _apply_limits(pid, limits, nice):
+    # Applied to the spawned shell from outside, a preexec_fn is not safe in
+    # a process with threads.  The shell waits for input, so it has started
+    # nothing yet that would not inherit them.
+    try:
+        for name, limit in limits.items():
+            resource.prlimit(pid, getattr(resource, name), (limit, limit))
+        if nice:
+            os.setpriority(os.PRIO_PROCESS, pid, os.getpriority(os.PRIO_PROCESS, 0) + nice)
+    except OSError as e:
+        logging.warning('shell: limits of %d not applied: %s', pid, e)
+
+
+class InputBuffer():
+
+    """Reassembles client writes into whole lines of shell input.
+
+    A long input arrives as several writes, each at most one ATT payload.
+    Writes of a long (prepared) write carry the offset of their bytes within
+    the value: a write at offset 0 starts a new value and ends the one
+    before it, a write at a later offset continues the current value and
+    replaces what was written there before.  Writes without an offset,
+    e.g. from an acquired socket, are appended.
+
+    Input is passed on up to its last newline.  A write that ends its
+    input gets a newline if it lacks one, so a client can still send one
+    command per write; input that may go on is held until its newline or
+    the next value.
+
+    Attributes:
+        max_size (int): Input held without a newline before it is passed on
+            anyway
+    """
+
+    def __init__(self, max_size=64 * 1024):
+        """Summary
+
+        Args:
+            max_size (int): Input held without a newline before it is passed on
+        """
+        self.max_size = max_size
+        self.__buffer = bytearray()
+        # Input passed on so far, and where the current value starts in it
+        self.__consumed = 0
+        self.__start = 0
+
+    def __len__(self):
+        return len(self.__buffer)
+
+    def __end_line(self):
+        if self.__buffer and not self.__buffer.endswith(b"\n"):
+            self.__buffer += b"\n"
+
+    def write(self, data, offset=None, end=True):
+        """Summary
+
+        Args:
+            data (bytes): Bytes as written by the client
+            offset (int): Offset of data within the value, None to append
+            end (bool): Whether the write ends its input, False for a
+                fragment of a long write or a stream where only newlines
+                end input
+
+        Returns:
+            bytes: Whole lines of input, empty while a line is incomplete
+
+        Raises:
+            ValueError: offset is past the end of the value
+        """
+        if offset == 0:
+            # A new value, whatever the last one left open ends here.
+            self.__end_line()
+            self.__start = self.__consumed + len(self.__buffer)
+
+        total = self.__consumed + len(self.__buffer)
+        if offset is None:
+            at = total
+        else:
+            at = self.__start + offset
+            if at > total:
+                raise ValueError('offset {} past the end of the value'.format(offset))
+            if at < self.__consumed:
+                # Sent again, part of it was passed on already.
+                data = data[self.__consumed - at:]
+                at = self.__consumed
+
+        del self.__buffer[at - self.__consumed:]
+        self.__buffer += data
+        if end:
+            self.__end_line()
+
+        if len(self.__buffer) > self.max_size:
+            cut = len(self.__buffer)
+        else:
+            cut = self.__buffer.rfind(b"\n") + 1
+        lines = bytes(self.__buffer[:cut])
+        del self.__buffer[:cut]
+        self.__consumed += cut
+        return lines
+
+    def clear(self):
+        """Drop input that was not passed on.
+        """
+        self.__consumed += len(self.__buffer)
+        self.__start = self.__consumed
+        self.__buffer = bytearray()
+
+
+class ShellSession():
+
+    """A shell and its output, read from the main loop.
+
+    Output is read on demand by read(), and while notifying through IO
+    watches that pass it to a send callback in chunks of ``chunk_size``.
+
+    Attributes:
+        device (str): Object path of the client, None while in the warm pool
+        process (subprocess.Popen): The shell
+        stdout (StreamReader): Output of the shell
+        stderr (StreamReader): Errors of the shell
+        chunk_size (int): Most bytes passed to send at a time
+        snapshot (bytes): Output the client is paging through
+        input (InputBuffer): Writes of the client, reassembled
+        on_input_drained (callable): Called with the session once input
+            held back by write() reached the shell
+        last_used (float): time.monotonic() of the last client request
+    """
+
+    # Chunks sent per main loop iteration before yielding to other sources
+    BURST = 32
+
+    def __init__(self, command=('/bin/bash',), cwd='/home/pi', limits=DEFAULT_LIMITS, nice=5):
+        """Summary
+
+        Args:
+            command (tuple): Shell command line
+            cwd (str): Working directory, the current one if it does not exist
+            limits (dict): resource.RLIMIT_* name to limit
+            nice (int): Niceness added to the shell
+        """
+        self.device = None
+        self.chunk_size = 20
+        self.snapshot = b""
+        self.input = InputBuffer()
+        self.last_used = time.monotonic()
+
+        self.process = subprocess.Popen(list(command),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=0,
+            cwd=cwd if os.path.isdir(cwd) else None,
+            start_new_session=True)
+        _apply_limits(self.process.pid, limits or {}, nice)
+
+        self.stdout = StreamReader(self.process.stdout, threaded=False)
+        self.stderr = StreamReader(self.process.stderr, threaded=False)
+
+        os.set_blocking(self.process.stdin.fileno(), False)
+        self.on_input_drained = None
+        self.__input = bytearray()
+        self.__input_source = None
+
+        self.__send = None
+        self.__watches = {}
+        self.__flush_source = None
+        self.__kill_source = None
+
+    @property
+    def alive(self):
+        """Summary
+
+        Returns:
+            bool: Whether the shell is still running
+        """
+        return self.process.poll() is None
+
+    @property
+    def notifying(self):
+        """Summary
+
+        Returns:
+            bool: Whether output is passed on as it arrives
+        """
+        return self.__send is not None
+
+    def touch(self):
+        """Summary
+        """
+        self.last_used = time.monotonic()
+
+    @property
+    def pending_input(self):
+        """Summary
+
+        Returns:
+            int: Bytes of input the shell did not take yet
+        """
+        return len(self.__input)
+
+    def write(self, data):
+        """Pass input to the shell, never waits for it to take it.
+
+        What does not fit the pipe is kept and written from the main loop
+        as the shell reads; on_input_drained is called once all of it was.
+
+        Args:
+            data (bytes): Input for the shell
+        """
+        self.touch()
+        self.__input += data
+        self.__write_input()
+
+    def __write_input(self, *args):
+        fd = self.process.stdin.fileno()
+        while self.__input:
+            try:
+                written = os.write(fd, self.__input)
+            except BlockingIOError:
+                break
+            except OSError:
+                # The shell is gone, its input with it.
+                self.__input = bytearray()
+                break
+            del self.__input[:written]
+
+        if self.__input:
+            if self.__input_source is None:
+                self.__input_source = GLib.io_add_watch(fd, GLib.PRIORITY_DEFAULT,
+                    GLib.IO_OUT | GLib.IO_ERR | GLib.IO_HUP, self.__write_input)
+            return True
+
+        self.__input_source = None
+        if args and self.on_input_drained is not None:
+            self.on_input_drained(self)
+        return False
+
+    def read(self, max_bytes=None):
+        """Take whatever output is buffered, never waits for more.
+
+        Args:
+            max_bytes (int): Most bytes to take
+
+        Returns:
+            bytes: Output, stdout before stderr
+        """
+        self.touch()
+        data = b""
+        for reader in (self.stdout, self.stderr):
+            reader.pump()
+            data += reader.read(None if max_bytes is None else max_bytes - len(data))
+            reader.ready = len(reader) > 0
+        return data
+
+    def start_notify(self, send):
+        """Pass output to send as it arrives, starting with what is buffered.
+
+        Args:
+            send (callable): Called with a memoryview of at most chunk_size
+                bytes and whether it is from stderr, returns False if it
+                cannot take more right now; call resume() once it can
+        """
+        self.__send = send
+        self.__watch_output()
+        self.resume()
+
+    def stop_notify(self):
+        """Remove every watch, nothing wakes up until the next start_notify().
+        """
+        self.__send = None
+        for source in self.__watches.values():
+            GLib.source_remove(source)
+        self.__watches = {}
+        if self.__flush_source is not None:
+            GLib.source_remove(self.__flush_source)
+            self.__flush_source = None
+
+    def resume(self):
+        """Flush buffered output from the main loop.
+        """
+        # Output arriving in a burst is sent by a single flush.
+        if self.__flush_source is None and self.__send is not None:
+            self.__flush_source = GLib.idle_add(self.__flush, priority=GLib.PRIORITY_DEFAULT)
+
+    def __watch_output(self):
+        # Watch the pipes that are open and have room to read into.
+        for reader in (self.stdout, self.stderr):
+            if reader not in self.__watches and not reader.eof and not reader.full:
+                self.__watches[reader] = GLib.io_add_watch(reader.fileno(),
+                    GLib.PRIORITY_DEFAULT, GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+                    self.__on_output, reader)
+
+    def __on_output(self, fd, condition, reader):
+        reader.pump()
+        self.resume()
+        if reader.eof or reader.full:
+            # A full ring is watched again once __flush made room.
+            del self.__watches[reader]
+            return False
+        return True
+
+    def __flush(self):
+        if self.__send is None:
+            self.__flush_source = None
+            return False
+
+        blocked = False
+        for _ in range(self.BURST):
+            reader = self.stdout if len(self.stdout) else self.stderr
+            chunk = reader.peek(self.chunk_size)
+            if not chunk:
+                break
+            if not self.__send(chunk, reader is self.stderr):
+                blocked = True
+                break
+            reader.skip(len(chunk))
+            self.last_used = time.monotonic()
+
+        for reader in (self.stdout, self.stderr):
+            reader.ready = len(reader) > 0
+        if self.__send is not None:
+            self.__watch_output()
+        if not blocked and (self.stdout.ready or self.stderr.ready):
+            return True
+
+        self.__flush_source = None
+        return False
+
+    def close(self, timeout=1.0):
+        """Hang up the shell and everything it started, never waits.
+
+        The shell is reaped from the main loop, its process group is
+        killed if it did not exit in time.
+
+        Args:
+            timeout (float): Seconds between SIGHUP and SIGKILL
+        """
+        self.stop_notify()
+        if self.__input_source is not None:
+            GLib.source_remove(self.__input_source)
+            self.__input_source = None
+        for pipe in (self.process.stdin, self.process.stdout, self.process.stderr):
+            pipe.close()
+        if self.process.returncode is not None or self.__kill_source is not None:
+            return
+        self.__kill(signal.SIGHUP)
+        self.__kill_source = GLib.timeout_add(int(timeout * 1000), self.__expired)
+        GLib.child_watch_add(GLib.PRIORITY_DEFAULT, self.process.pid, self.__exited)
+
+    def __expired(self):
+        self.__kill_source = None
+        self.__kill(signal.SIGKILL)
+        return False
+
+    def __kill(self, signum):
+        try:
+            os.killpg(self.process.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def __exited(self, pid, status):
+        # GLib reaped the shell, Popen learns its status from here.
+        if os.WIFSIGNALED(status):
+            self.process.returncode = -os.WTERMSIG(status)
+        else:
+            self.process.returncode = os.WEXITSTATUS(status)
+        if self.__kill_source is not None:
+            GLib.source_remove(self.__kill_source)
+            self.__kill_source = None
+
+
+class SessionPool():
+
+    """Sessions keyed by client, with a few shells spawned ahead of time.
+
+    Attributes:
+        warm (int): Shells kept spawned for new clients
+        max_sessions (int): Clients served at once, the least recently used
+            session is closed to make room
+        idle_timeout (float): Seconds after which an unused session is closed
+    """
+
+    def __init__(self, factory=ShellSession, warm=1, max_sessions=4, idle_timeout=900,
+            on_open=None, on_close=None):
+        """Summary
+
+        Args:
+            factory (callable): Creates a ShellSession
+            warm (int): Shells kept spawned for new clients
+            max_sessions (int): Clients served at once
+            idle_timeout (float): Seconds after which an unused session is closed
+            on_open (callable): Called with a session when a client gets it
+            on_close (callable): Called with a session before it is closed
+        """
+        self.warm = warm
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+
+        self.__factory = factory
+        self.__on_open = on_open
+        self.__on_close = on_close
+        self.__spares = []
+        self.__sessions = {}
+        self.__fill_source = None
+        self.__reap_source = None
+
+    def __len__(self):
+        return len(self.__sessions)
+
+    def start(self, reap_interval=60):
+        """Spawn the warm shells and start reaping, from the main loop.
+
+        Args:
+            reap_interval (int): Seconds between checks for idle sessions
+        """
+        self.__refill()
+        self.__reap_source = GLib.timeout_add_seconds(reap_interval, self.reap)
+
+    def sessions(self):
+        """Summary
+
+        Returns:
+            list: Sessions of the connected clients
+        """
+        return list(self.__sessions.values())
+
+    def get(self, device):
+        """Session of a client, opened on its first request.
+
+        Args:
+            device (str): Object path of the client, from the request options
+
+        Returns:
+            ShellSession: The session
+        """
+        session = self.__sessions.get(device)
+        if session is not None and session.alive:
+            session.touch()
+            return session
+        if session is not None:
+            self.close(device)
+
+        while len(self.__sessions) >= self.max_sessions:
+            oldest = min(self.__sessions.values(), key=lambda s: s.last_used)
+            self.close(oldest.device)
+
+        session = None
+        while self.__spares and session is None:
+            spare = self.__spares.pop()
+            if spare.alive:
+                session = spare
+            else:
+                spare.close()
+        if session is None:
+            session = self.__factory()
+
+        session.device = device
+        session.touch()
+        self.__sessions[device] = session
+        self.__refill()
+
+        logging.info('shell: session for %s', device)
+        if self.__on_open:
+            self.__on_open(session)
+        return session
+
+    def close(self, device):
+        """Summary
+
+        Args:
+            device (str): Object path of the client
+        """
+        session = self.__sessions.pop(device, None)
+        if session is None:
+            return
+        if self.__on_close:
+            self.__on_close(session)
+        session.close()
+        logging.info('shell: closed session of %s', device)
+
+    def reap(self):
+        """Close sessions that died or sat unused for idle_timeout.
+
+        Output passed on as it arrives counts as use.
+
+        Returns:
+            bool: True, keeps the timeout source alive
+        """
+        now = time.monotonic()
+        for session in self.sessions():
+            if not session.alive or now - session.last_used > self.idle_timeout:
+                self.close(session.device)
+        return True
+
+    def __refill(self):
+        # Spawned from an idle callback, off the path of the request.
+        if self.__fill_source is None and len(self.__spares) < self.warm:
+            self.__fill_source = GLib.idle_add(self.__spawn)
+
+    def __spawn(self):
+        try:
+            self.__spares.append(self.__factory())
+        except OSError as e:
+            logging.warning('shell: cannot spawn a shell: %s', e)
+            self.__fill_source = None
+            return False
+        if len(self.__spares) < self.warm:
+            return True
+        self.__fill_source = None
+        return False
+
+    def stop(self):
+        """Close every session and spare shell.
+        """
+        if self.__reap_source is not None:
+            GLib.source_remove(self.__reap_source)
+            self.__reap_source = None
+        if self.__fill_source is not None:
+            GLib.source_remove(self.__fill_source)
+            self.__fill_source = None
+        for session in self.sessions():
+            self.close(session.device)
+        for spare in self.__spares:
+            spare.close()
+        self.__spares = []
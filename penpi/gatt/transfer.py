@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+"""Bulk file transfer to and from the scripts directory.
+
+A transfer is set up on the control characteristic and its bytes move as
+chunks on the data characteristic.  Every message starts with a type byte;
+integers are little endian, hashes are SHA-256.
+
+Control, written by the client::
+
+    UPLOAD   (0x01) | size (uint32) | sha256 (32 bytes) | name (utf-8)
+    DOWNLOAD (0x02) | name (utf-8)
+    ACK      (0x03) | offset (uint32)   download bytes received in order
+    CANCEL   (0x04)
+
+Control, notified by the server::
+
+    READY    (0x81) | offset (uint32) | size (uint32) | sha256 (32 bytes)
+    ACK      (0x03) | offset (uint32)   upload bytes stored in order
+    DONE     (0x82)
+    ERROR    (0x8f) | message (utf-8)
+
+Data, in both directions::
+
+    offset (uint32) | crc32 (uint32) | payload
+
+An upload answers ``READY`` with the offset to start from: 0 for a new
+file, or the bytes kept from an earlier attempt with the same name, size
+and hash, so a client that lost its connection resumes where it stopped.
+The client keeps up to ``window`` chunks in flight and the server acks
+every ``window`` chunks and on a gap; a chunk that fails its CRC or does
+not start at the acked offset is dropped and the ack repeated, and the
+client resends from there.  Once all bytes are in, the whole file is
+checked against the hash and renamed into place, so a half written script
+never shows up.
+
+A download answers ``READY`` with the size and hash of the file; the client
+sends ``ACK`` with the offset to start from (0, or where an earlier attempt
+stopped) and keeps acking as chunks arrive, the server keeping up to
+``window`` chunks unacked.
+
+Attributes:
+    SCRIPTS_DIR (Path): Directory files are uploaded to and downloaded from
+"""
+
+import hashlib
+import os
+import struct
+import zlib
+from pathlib import Path
+
+
+SCRIPTS_DIR = Path(os.path.dirname(os.path.realpath(__file__))).parent / 'menu' / 'ducky-scripts'
+
+UPLOAD = 0x01
+DOWNLOAD = 0x02
+ACK = 0x03
+CANCEL = 0x04
+
+READY = 0x81
+DONE = 0x82
+ERROR = 0x8f
+
+CHUNK = struct.Struct('<II')
+OFFSET = struct.Struct('<I')
+SIZE = struct.Struct('<I')
+DIGEST_SIZE = 32
+
+# Largest file accepted
+MAX_SIZE = 16 * 1024 * 1024
+
+
+class TransferError(Exception):
+
+    """A request that cannot be served, its message goes to the client.
+    """
+
+
+def chunk(offset, payload):
+    """Summary
+
+    Args:
+        offset (int): Offset of payload within the file
+        payload (bytes): Bytes of the file
+
+    Returns:
+        bytes: Data message
+    """
+    return CHUNK.pack(offset, zlib.crc32(payload)) + bytes(payload)
+
+
+def ready(offset, size, digest):
+    """Summary
+
+    Args:
+        offset (int): Offset to start from
+        size (int): File size
+        digest (bytes): SHA-256 of the file
+
+    Returns:
+        bytes: READY message
+    """
+    return bytes((READY,)) + OFFSET.pack(offset) + SIZE.pack(size) + digest
+
+
+def ack(offset):
+    """Summary
+
+    Args:
+        offset (int): Bytes received in order
+
+    Returns:
+        bytes: ACK message
+    """
+    return bytes((ACK,)) + OFFSET.pack(offset)
+
+
+def error(message):
+    """Summary
+
+    Args:
+        message (str): What went wrong
+
+    Returns:
+        bytes: ERROR message
+    """
+    return bytes((ERROR,)) + message.encode('utf-8')
+
+
+def file_name(name):
+    """Check a file name sent by a client.
+
+    Args:
+        name (bytes): Name as sent
+
+    Returns:
+        str: The name
+
+    Raises:
+        TransferError: Not a plain file name within the directory
+    """
+    try:
+        name = name.decode('utf-8')
+    except UnicodeDecodeError:
+        raise TransferError('file name is not utf-8')
+    if not name or name.startswith('.') or '/' in name or '\0' in name:
+        raise TransferError('invalid file name')
+    return name
+
+
+def _digest(path, size=None):
+    sha = hashlib.sha256()
+    with open(str(path), 'rb') as handle:
+        while size is None or size > 0:
+            block = handle.read(64 * 1024 if size is None else min(size, 64 * 1024))
+            if not block:
+                break
+            sha.update(block)
+            if size is not None:
+                size -= len(block)
+    return sha
+
+
+class Upload():
+
+    """A file arriving in chunks, kept in a partial file until complete.
+
+    The partial file is named after the name and hash of the upload, so
+    only an upload of the same file resumes it.
+
+    Attributes:
+        path (Path): Where the file goes once complete
+        size (int): File size
+        digest (bytes): SHA-256 the file must have
+        offset (int): Bytes stored in order
+        window (int): Chunks between acks
+    """
+
+    def __init__(self, directory, name, size, digest, window=8):
+        """Summary
+
+        Args:
+            directory (Path): Directory of the file
+            name (str): Checked file name
+            size (int): File size
+            digest (bytes): SHA-256 the file must have
+            window (int): Chunks between acks
+
+        Raises:
+            TransferError: The file is too large
+            OSError: The partial file cannot be opened
+        """
+        if size > MAX_SIZE:
+            raise TransferError('file larger than {} bytes'.format(MAX_SIZE))
+        self.path = Path(directory) / name
+        self.size = size
+        self.digest = digest
+        self.window = window
+        self.partial = Path(directory) / '.{}.{}.part'.format(name, digest.hex()[:16])
+
+        self.__handle = open(str(self.partial), 'ab+')
+        self.offset = min(self.__handle.tell(), size)
+        self.__handle.truncate(self.offset)
+        self.__sha = _digest(self.partial, self.offset)
+        self.__unacked = 0
+
+    @property
+    def complete(self):
+        """Summary
+
+        Returns:
+            bool: Whether every byte was stored
+        """
+        return self.offset >= self.size
+
+    def ready(self):
+        """Summary
+
+        Returns:
+            bytes: READY message with the offset to resume from
+        """
+        return ready(self.offset, self.size, self.digest)
+
+    def feed(self, data):
+        """Store a data message if it is the next chunk.
+
+        Args:
+            data (bytes): Data message
+
+        Returns:
+            bytes: Control message to notify, None if nothing is due
+
+        Raises:
+            TransferError: The complete file does not match its hash
+            OSError: The file cannot be written
+        """
+        if len(data) < CHUNK.size:
+            return ack(self.offset)
+        offset, crc = CHUNK.unpack_from(data)
+        payload = data[CHUNK.size:]
+        if offset < self.offset and offset + len(payload) <= self.offset:
+            # Resent before our ack arrived, already stored.
+            return None
+        if offset != self.offset or zlib.crc32(payload) != crc \
+                or offset + len(payload) > self.size:
+            self.__unacked = 0
+            return ack(self.offset)
+
+        self.__handle.write(payload)
+        self.__sha.update(payload)
+        self.offset += len(payload)
+        self.__unacked += 1
+
+        if self.complete:
+            self.finish()
+            return bytes((DONE,))
+        if self.__unacked >= self.window:
+            self.__unacked = 0
+            return ack(self.offset)
+        return None
+
+    def finish(self):
+        """Check the hash and move the file into place.
+
+        Raises:
+            TransferError: The file does not match its hash, it is dropped
+        """
+        self.__handle.flush()
+        os.fsync(self.__handle.fileno())
+        self.__handle.close()
+        if self.__sha.digest() != self.digest:
+            os.unlink(str(self.partial))
+            raise TransferError('hash mismatch')
+
+        os.replace(str(self.partial), str(self.path))
+        directory = os.open(str(self.path.parent), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def close(self):
+        """Stop, keeping the partial file to resume from.
+        """
+        if not self.__handle.closed:
+            self.__handle.close()
+
+
+class Download():
+
+    """A file sent in chunks, at most window chunks ahead of the client's ack.
+
+    Attributes:
+        path (Path): The file
+        size (int): File size
+        digest (bytes): SHA-256 of the file
+        acked (int): Bytes the client received in order
+        window (int): Chunks sent ahead of the ack
+        chunk_size (int): Payload bytes per chunk
+    """
+
+    def __init__(self, directory, name, chunk_size=12, window=8):
+        """Summary
+
+        Args:
+            directory (Path): Directory of the file
+            name (str): Checked file name
+            chunk_size (int): Payload bytes per chunk
+            window (int): Chunks sent ahead of the ack
+
+        Raises:
+            TransferError: There is no such file
+        """
+        self.path = Path(directory) / name
+        try:
+            self.__handle = open(str(self.path), 'rb')
+        except OSError:
+            raise TransferError('no such file')
+        self.size = os.fstat(self.__handle.fileno()).st_size
+        self.digest = _digest(self.path).digest()
+        self.chunk_size = chunk_size
+        self.window = window
+        self.acked = 0
+        self.__sent = 0
+
+    @property
+    def complete(self):
+        """Summary
+
+        Returns:
+            bool: Whether the client received every byte
+        """
+        return self.acked >= self.size
+
+    def ready(self):
+        """Summary
+
+        Returns:
+            bytes: READY message with size and hash of the file
+        """
+        return ready(0, self.size, self.digest)
+
+    def ack(self, offset):
+        """Take the client's ack, it may go back to resend from there.
+
+        Args:
+            offset (int): Bytes the client received in order
+        """
+        self.acked = min(offset, self.size)
+        if self.__sent < self.acked or offset < self.__sent:
+            self.__sent = self.acked
+
+    def chunks(self):
+        """Summary
+
+        Returns:
+            list: Data messages that fit the window
+        """
+        messages = []
+        limit = min(self.acked + self.window * self.chunk_size, self.size)
+        while self.__sent < limit:
+            self.__handle.seek(self.__sent)
+            payload = self.__handle.read(min(self.chunk_size, limit - self.__sent))
+            if not payload:
+                break
+            messages.append(chunk(self.__sent, payload))
+            self.__sent += len(payload)
+        return messages
+
+    def close(self):
+        """Summary
+        """
+        self.__handle.close()
+
+
+class TransferManager():
+
+    """Transfers of the connected clients, one at a time per client.
+
+    Attributes:
+        directory (Path): Directory files go to and come from
+        window (int): Chunks in flight per transfer
+    """
+
+    def __init__(self, directory=SCRIPTS_DIR, window=8):
+        """Summary
+
+        Args:
+            directory (Path): Directory files go to and come from
+            window (int): Chunks in flight per transfer
+        """
+        self.directory = Path(directory)
+        self.window = window
+        self.__transfers = {}
+
+    def control(self, device, message, chunk_size=12):
+        """Handle a control message of a client.
+
+        Args:
+            device (str): Object path of the client
+            message (bytes): Control message
+            chunk_size (int): Payload bytes per download chunk
+
+        Returns:
+            tuple: (control messages, data messages) to notify
+        """
+        kind, body = message[:1], bytes(message[1:])
+        try:
+            if kind == bytes((UPLOAD,)):
+                if len(body) < SIZE.size + DIGEST_SIZE:
+                    raise TransferError('short upload request')
+                self.close(device)
+                size, = SIZE.unpack_from(body)
+                digest = body[SIZE.size:SIZE.size + DIGEST_SIZE]
+                name = file_name(body[SIZE.size + DIGEST_SIZE:])
+                upload = Upload(self.directory, name, size, digest, self.window)
+                self.__transfers[device] = upload
+                if upload.complete:
+                    return [upload.ready()] + self.__feed(device, upload, b''), []
+                return [upload.ready()], []
+
+            if kind == bytes((DOWNLOAD,)):
+                self.close(device)
+                download = Download(self.directory, file_name(body), chunk_size, self.window)
+                self.__transfers[device] = download
+                return [download.ready()], []
+
+            if kind == bytes((ACK,)):
+                download = self.__transfers.get(device)
+                if not isinstance(download, Download) or len(body) < OFFSET.size:
+                    raise TransferError('no download')
+                download.ack(OFFSET.unpack_from(body)[0])
+                if download.complete:
+                    self.close(device)
+                    return [bytes((DONE,))], []
+                return [], download.chunks()
+
+            if kind == bytes((CANCEL,)):
+                self.close(device)
+                return [], []
+
+            raise TransferError('unknown request')
+        except TransferError as e:
+            self.close(device)
+            return [error(str(e))], []
+        except OSError as e:
+            self.close(device)
+            return [error(e.strerror or str(e))], []
+
+    def data(self, device, message):
+        """Handle a data message of a client.
+
+        Args:
+            device (str): Object path of the client
+            message (bytes): Data message
+
+        Returns:
+            list: Control messages to notify
+        """
+        upload = self.__transfers.get(device)
+        if not isinstance(upload, Upload):
+            return [error('no upload')]
+        return self.__feed(device, upload, bytes(message))
+
+    def __feed(self, device, upload, message):
+        try:
+            if upload.complete:
+                upload.finish()
+                reply = bytes((DONE,))
+            else:
+                reply = upload.feed(message)
+        except (TransferError, OSError) as e:
+            self.close(device)
+            return [error(str(e))]
+        if upload.complete:
+            self.__transfers.pop(device, None)
+        return [reply] if reply else []
+
+    def close(self, device):
+        """Stop the transfer of a client, an upload can resume later.
+
+        Args:
+            device (str): Object path of the client
+        """
+        transfer = self.__transfers.pop(device, None)
+        if transfer is not None:
+            transfer.close()
@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+"""Button input as a queue of timestamped events.
+
+Input backends watch the button pins and report every edge with the level
+it left the pin at and a timestamp, from their own thread:
+
+    RPiGPIOBackend   RPi.GPIO edge callbacks, timestamped on arrival
+    GpiodBackend     Linux GPIO character device, kernel edge timestamps
+    ScriptedBackend  In-memory pins driven by press()/release() or a script
+
+``Button`` debounces the edges in software using their timestamps and puts
+an ``InputEvent`` per real press or release on a queue; the screen takes
+them off it on the main loop (see ``penpi.loop``) and does no work at all
+until something happens.  ``AutoRepeat`` tells the screen when held
+buttons are due to repeat, getting faster the longer they are held.
+
+Attributes:
+    BACKENDS (dict): Backend classes by the name PENPI_GPIO selects them with
+"""
+
+import os
+import select
+import threading
+import time
+from collections import namedtuple
+
+
+LOW = 0
+HIGH = 1
+
+
+InputEvent = namedtuple('InputEvent', ['button', 'state', 'time', 'repeat'])
+InputEvent.__new__.__defaults__ = (False,)
+InputEvent.__doc__ = """Press or release of a button.
+
+Attributes:
+    button (Button): Button that changed
+    state (int): Button.DOWN or Button.UP
+    time (float): Timestamp of the edge in seconds, as given by the backend
+    repeat (bool): Generated by AutoRepeat while the button is held
+"""
+
+
+class Button():
+
+    """Debounced button on a pull-up input pin.
+
+    The state follows the level reported with each edge instead of toggling
+    on every edge, so a lost edge cannot invert it.  Edges closer than
+    ``debounce`` seconds to the last accepted one are bounce; once the
+    window is over the pin is read again in case it settled elsewhere.
+
+    Attributes:
+        callbacks (list): (state, func) pairs, see addOnPress and addOnRelease
+        debounce (float): Debounce window in seconds
+        DOWN (int): State of a pressed button, the pin is pulled low
+        UP (int): State of a released button
+    """
+
+    DOWN = 0
+    UP = 1
+
+    def __init__(self, gpio, events, backend, debounce=0.02):
+        """Summary
+
+        Args:
+            gpio (int): BCM pin number
+            events (queue.Queue): Queue receiving an InputEvent per press and release
+            backend (RPiGPIOBackend): Input backend watching the pin
+            debounce (float): Debounce window in seconds
+        """
+        self.__gpio = gpio
+        self.__events = events
+        self.__backend = backend
+        self.callbacks = []
+        self.debounce = debounce
+
+        self.__state = Button.UP
+        self.__last = None
+        self.__bounce = None
+        self.__settle = None
+        self.__lock = threading.Lock()
+
+        backend.watch(gpio, self.edge_detected)
+
+    def dispatch(self, state):
+        """Run the callbacks registered for state.
+
+        Args:
+            state (int): Button.DOWN or Button.UP
+        """
+        for cb_state, cb_func in self.callbacks:
+            if cb_state == state:
+                cb_func(self, state)
+
+    def addOnPress(self, func):
+        """Summary
+
+        Args:
+            func (callable): Called with (button, state) when pressed
+        """
+        self.callbacks.append((Button.DOWN, func))
+
+    def addOnRelease(self, func):
+        """Summary
+
+        Args:
+            func (callable): Called with (button, state) when released
+        """
+        self.callbacks.append((Button.UP, func))
+
+    def edge_detected(self, level, timestamp):
+        """Called by the backend for every edge on the pin.
+
+        Args:
+            level (int): Level the pin changed to, LOW or HIGH
+            timestamp (float): Time of the edge in seconds
+        """
+        with self.__lock:
+            if self.__last is not None and timestamp - self.__last < self.debounce:
+                self.__bounce = timestamp
+                if self.__settle is None:
+                    self.__settle = threading.Timer(self.debounce, self.__settled)
+                    self.__settle.daemon = True
+                    self.__settle.start()
+                return
+            self.__change(Button.DOWN if level == LOW else Button.UP, timestamp)
+
+    def __settled(self):
+        with self.__lock:
+            self.__settle = None
+            level = self.__backend.input(self.__gpio)
+            self.__change(Button.DOWN if level == LOW else Button.UP, self.__bounce)
+
+    def __change(self, state, timestamp):
+        if state == self.__state:
+            return
+        self.__state = state
+        self.__last = timestamp
+        self.__events.put(InputEvent(self, state, timestamp))
+
+    @property
+    def state(self):
+        """Summary
+
+        Returns:
+            int: Debounced state, Button.DOWN or Button.UP
+        """
+        return self.__state
+
+    @property
+    def down(self):
+        """Summary
+
+        Returns:
+            bool: Whether the pin currently reads low
+        """
+        return self.__backend.input(self.__gpio) == LOW
+
+    @property
+    def up(self):
+        """Summary
+
+        Returns:
+            bool: Whether the pin currently reads high
+        """
+        return self.__backend.input(self.__gpio) == HIGH
+
+    @property
+    def gpio(self):
+        """Summary
+
+        Returns:
+            int: BCM pin number
+        """
+        return self.__gpio
+
+    def __repr__(self):
+        """Summary
+
+        Returns:
+            str: Description
+        """
+        return "<Button {}>".format(self.__gpio)
+
+
+class AutoRepeat():
+
+    """Repeat schedule for held buttons.
+
+    A held button repeats for the first time after ``delay`` seconds, then
+    every ``interval`` seconds, each interval ``acceleration`` times the one
+    before until ``minimum`` is reached.
+
+    Attributes:
+        buttons (list): Buttons that repeat
+        delay (float): Seconds from the press to the first repeat
+        interval (float): Seconds between the first repeats
+        minimum (float): Shortest interval between repeats
+        acceleration (float): Factor applied to the interval after each repeat
+    """
+
+    def __init__(self, buttons, delay=0.4, interval=0.1, minimum=0.02, acceleration=0.85):
+        """Summary
+
+        Args:
+            buttons (list): Buttons that repeat
+            delay (float): Seconds from the press to the first repeat
+            interval (float): Seconds between the first repeats
+            minimum (float): Shortest interval between repeats
+            acceleration (float): Factor applied to the interval after each repeat
+        """
+        self.buttons = list(buttons)
+        self.delay = delay
+        self.interval = interval
+        self.minimum = minimum
+        self.acceleration = acceleration
+        self.__held = {}
+
+    def update(self, event):
+        """Track presses and releases, call for every event taken off the queue.
+
+        Args:
+            event (InputEvent): Event from the queue, other objects are ignored
+        """
+        if not isinstance(event, InputEvent) or event.repeat or event.button not in self.buttons:
+            return
+        if event.state == Button.DOWN:
+            self.__held[event.button] = (time.monotonic() + self.delay, self.interval)
+        else:
+            self.__held.pop(event.button, None)
+
+    def reset(self):
+        """Forget held buttons, e.g. when switching between screens.
+        """
+        self.__held.clear()
+
+    def timeout(self, default=None):
+        """Summary
+
+        Args:
+            default (float): Returned when no button is held
+
+        Returns:
+            float: Seconds until the next repeat is due
+        """
+        if not self.__held:
+            return default
+        wait = max(min(due for due, _ in self.__held.values()) - time.monotonic(), 0)
+        return wait if default is None else min(wait, default)
+
+    def due(self):
+        """Take the repeats that are due.
+
+        Returns:
+            list: InputEvent with repeat set for every button due to repeat
+        """
+        now = time.monotonic()
+        repeats = []
+        for button, (due, interval) in list(self.__held.items()):
+            if due > now:
+                continue
+            if button.up:
+                # The release is still on its way through the queue.
+                continue
+            self.__held[button] = (now + interval, max(interval * self.acceleration, self.minimum))
+            repeats.append(InputEvent(button, Button.DOWN, now, True))
+        return repeats
+
+
+class RPiGPIOBackend():
+
+    """Input backend on RPi.GPIO.
+
+    RPi.GPIO does not report when an edge happened, edges are timestamped
+    with time.monotonic() when the callback runs.
+    """
+
+    def __init__(self):
+        """Summary
+        """
+        import RPi.GPIO as GPIO
+
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BCM)
+
+    def watch(self, pin, callback):
+        """Set pin up as input with pull-up and report its edges.
+
+        Args:
+            pin (int): BCM pin number
+            callback (callable): Called with (level, timestamp) for every edge
+        """
+        GPIO = self.GPIO
+        GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(pin, GPIO.BOTH,
+            callback=lambda ch: callback(GPIO.input(ch), time.monotonic()))
+
+    def input(self, pin):
+        """Summary
+
+        Args:
+            pin (int): BCM pin number
+
+        Returns:
+            int: LOW or HIGH
+        """
+        return self.GPIO.input(pin)
+
+    def cleanup(self):
+        """Summary
+        """
+        self.GPIO.cleanup()
+
+
+class GpiodBackend():
+
+    """Input backend on the Linux GPIO character device through libgpiod.
+
+    Edge events carry the kernel's timestamp.  Works with the v1 bindings
+    shipped by Debian (python3-libgpiod) and the v2 bindings on PyPI.
+
+    Attributes:
+        chip (str): GPIO chip device
+    """
+
+    def __init__(self, chip='/dev/gpiochip0'):
+        """Summary
+
+        Args:
+            chip (str): GPIO chip device
+        """
+        import gpiod
+
+        self.gpiod = gpiod
+        self.chip = chip
+        self.__v2 = hasattr(gpiod, 'request_lines')
+        self.__chip = None if self.__v2 else gpiod.Chip(chip)
+        self.__lines = {}
+        self.__callbacks = {}
+        self.__wake_r, self.__wake_w = os.pipe()
+        self.__thread = None
+
+    def watch(self, pin, callback):
+        """Request pin as input with pull-up and report its edges.
+
+        Args:
+            pin (int): Line offset on the chip, the BCM number on a Pi
+            callback (callable): Called with (level, timestamp) for every edge
+        """
+        gpiod = self.gpiod
+        if self.__v2:
+            settings = gpiod.LineSettings(
+                direction=gpiod.line.Direction.INPUT,
+                edge_detection=gpiod.line.Edge.BOTH,
+                bias=gpiod.line.Bias.PULL_UP)
+            line = gpiod.request_lines(self.chip, consumer='penpi', config={pin: settings})
+        else:
+            line = self.__chip.get_line(pin)
+            line.request(consumer='penpi', type=gpiod.LINE_REQ_EV_BOTH_EDGES,
+                flags=getattr(gpiod, 'LINE_REQ_FLAG_BIAS_PULL_UP', 0))
+
+        self.__lines[pin] = line
+        self.__callbacks[pin] = callback
+
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name='gpiod')
+            self.__thread.daemon = True
+            self.__thread.start()
+        else:
+            os.write(self.__wake_w, b'\0')
+
+    def __fd(self, line):
+        return line.fd if self.__v2 else line.event_get_fd()
+
+    def __read(self, pin, line):
+        callback = self.__callbacks[pin]
+        if self.__v2:
+            for event in line.read_edge_events():
+                rising = event.event_type == event.Type.RISING_EDGE
+                callback(HIGH if rising else LOW, event.timestamp_ns / 1e9)
+        else:
+            event = line.event_read()
+            rising = event.type == self.gpiod.LineEvent.RISING_EDGE
+            callback(HIGH if rising else LOW, event.sec + event.nsec / 1e9)
+
+    def __run(self):
+        while True:
+            fds = {self.__fd(line): (pin, line) for pin, line in list(self.__lines.items())}
+            ready, _, _ = select.select([self.__wake_r] + list(fds), [], [])
+            for fd in ready:
+                if fd == self.__wake_r:
+                    if not os.read(self.__wake_r, 64):
+                        return
+                else:
+                    self.__read(*fds[fd])
+
+    def input(self, pin):
+        """Summary
+
+        Args:
+            pin (int): Line offset on the chip
+
+        Returns:
+            int: LOW or HIGH
+        """
+        line = self.__lines[pin]
+        if self.__v2:
+            return HIGH if line.get_value(pin) == self.gpiod.line.Value.ACTIVE else LOW
+        return line.get_value()
+
+    def cleanup(self):
+        """Summary
+        """
+        os.close(self.__wake_w)
+        for line in self.__lines.values():
+            line.release()
+        self.__lines.clear()
+
+
+class ScriptedBackend():
+
+    """In-memory input backend for running the input path off-device.
+
+    Pins read high until pulled low.  Edges are delivered on the calling
+    thread, with the given timestamp or time.monotonic().
+    """
+
+    def __init__(self):
+        """Summary
+        """
+        self.levels = {}
+        self.callbacks = {}
+
+    def watch(self, pin, callback):
+        self.levels[pin] = HIGH
+        self.callbacks[pin] = callback
+
+    def input(self, pin):
+        return self.levels[pin]
+
+    def cleanup(self):
+        self.callbacks.clear()
+
+    def edge(self, pin, level, timestamp=None):
+        """Set the level of pin and report the edge, even if the level did not change.
+
+        Args:
+            pin (int): Pin number
+            level (int): LOW or HIGH
+            timestamp (float): Time of the edge, defaults to time.monotonic()
+        """
+        self.levels[pin] = level
+        callback = self.callbacks.get(pin)
+        if callback is not None:
+            callback(level, time.monotonic() if timestamp is None else timestamp)
+
+    def press(self, pin, timestamp=None):
+        """Pull pin low, like a button shorting it to ground.
+        """
+        self.edge(pin, LOW, timestamp)
+
+    def release(self, pin, timestamp=None):
+        """Let the pull-up take pin high again.
+        """
+        self.edge(pin, HIGH, timestamp)
+
+    def play(self, script, realtime=True):
+        """Replay a recorded sequence of edges.
+
+        Args:
+            script (list): (seconds from start, pin, level) tuples in order
+            realtime (bool): Sleep between edges; otherwise the edges are
+                delivered at once, stamped with their scripted times
+        """
+        start = time.monotonic()
+        for offset, pin, level in script:
+            if realtime:
+                time.sleep(max(start + offset - time.monotonic(), 0))
+                self.edge(pin, level)
+            else:
+                self.edge(pin, level, start + offset)
+
+
+BACKENDS = {
+    'rpi': RPiGPIOBackend,
+    'gpiod': GpiodBackend,
+    'fake': ScriptedBackend,
+}
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""The GLib main loop everything runs on.
+
+GATT server, advertisement, screen, input events and command output all
+share one GLib main loop in the main thread, so the menu state and the
+image are only ever touched from there.  Threads are left for blocking
+work only: button edge callbacks and debouncing, recompiling the menu and
+result cache refreshes.  They hand their results to the loop through an
+``EventQueue``.
+
+Attributes:
+    mainloop (GLib.MainLoop): The loop, once run() created it
+"""
+
+import os
+import queue
+import threading
+
+# Importing is fine without gi, e.g. to profile the screen on a dev box.
+try:
+  from gi.repository import GLib
+except ImportError:
+  try:
+    import glib as GLib
+  except ImportError:
+    GLib = None
+
+
+mainloop = None
+
+
+class EventQueue(queue.Queue):
+
+    """Queue whose events are handled on the main loop.
+
+    Any thread may put events; the handler then takes them off the queue
+    from an idle callback on the main loop, one wakeup per burst.
+
+    Attributes:
+        handler (callable): Called with every event, on the main loop
+    """
+
+    def __init__(self):
+        """Summary
+        """
+        queue.Queue.__init__(self)
+        self.handler = None
+        self.__scheduled = False
+        self.__lock = threading.Lock()
+
+    def put(self, item, block=True, timeout=None):
+        """Queue an event and wake the main loop up to handle it.
+
+        Args:
+            item (object): Event
+            block (bool): See queue.Queue.put
+            timeout (float): See queue.Queue.put
+        """
+        queue.Queue.put(self, item, block, timeout)
+        self.__schedule()
+
+    def attach(self, handler):
+        """Handle events on the main loop from now on, starting with the queued ones.
+
+        Args:
+            handler (callable): Called with every event
+        """
+        self.handler = handler
+        self.__schedule()
+
+    def __schedule(self):
+        with self.__lock:
+            if self.__scheduled or self.handler is None:
+                return
+            self.__scheduled = True
+        GLib.idle_add(self.__dispatch, priority=GLib.PRIORITY_DEFAULT)
+
+    def __dispatch(self):
+        with self.__lock:
+            self.__scheduled = False
+        while self.handler is not None:
+            try:
+                event = self.get_nowait()
+            except queue.Empty:
+                break
+            self.handler(event)
+        return False
+
+
+def bluez_bus():
+    """The bus BlueZ is on.
+
+    The system bus, or the session bus if PENPI_BUS is ``session``, e.g.
+    with penpi.gatt.fakebluez standing in for BlueZ.
+
+    Returns:
+        dbus.Bus: The bus, call after setting up the GLib main loop for dbus
+    """
+    import dbus
+
+    if os.environ.get('PENPI_BUS') == 'session':
+        return dbus.SessionBus()
+    return dbus.SystemBus()
+
+
+def watch_bluez(bus, callback):
+    """Call callback once BlueZ is on the bus, and again whenever it restarts.
+
+    Args:
+        bus (dbus.Bus): Bus BlueZ is on, see bluez_bus()
+        callback (callable): Called without arguments, on the main loop
+
+    Returns:
+        object: The watch, cancel() ends it
+    """
+    return bus.watch_name_owner('org.bluez', lambda owner: owner and callback())
+
+
+def timeout_add(seconds, callback):
+    """Call callback on the main loop after a while.
+
+    Args:
+        seconds (float): Delay, rounded down to milliseconds
+        callback (callable): Called without arguments, returns True to be
+            called again after the same delay
+
+    Returns:
+        int: The source, for source_remove()
+    """
+    return GLib.timeout_add(int(seconds * 1000), callback)
+
+
+def source_remove(source):
+    """Summary
+
+    Args:
+        source (int): Source of timeout_add()
+    """
+    GLib.source_remove(source)
+
+
+def run():
+    """Run the main loop until quit() is called.
+    """
+    global mainloop
+
+    mainloop = GLib.MainLoop()
+    mainloop.run()
+
+
+def quit():
+    """Summary
+    """
+    if mainloop is not None:
+        mainloop.quit()
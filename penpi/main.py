@@ -1,26 +1,65 @@
 #!/usr/bin/env python3
 
 import logging
-from threading import Thread
 
-from penpi.screen import Screen
-from penpi.gatt.server import GattServer
-from penpi.gatt.advertise import GattAdvertise
+from penpi import loop, metrics, profile
 
 
 
 class Main():
     def run():
         logging.basicConfig(level=logging.INFO, format='%(relativeCreated)6d %(threadName)s %(message)s')
-        
-        thread_screen = Thread(target = Screen.run)
-        thread_server = Thread(target = GattServer.run)
-        thread_advertise = Thread(target = GattAdvertise.run)
-        
-        thread_screen.start()
-        thread_server.start()
-        thread_advertise.start()
-
-        thread_advertise.join()
-        thread_server.join()
-        thread_screen.join()
+
+        # Imported here so that importing penpi.main stays cheap, the
+        # hardware is only touched once run.
+        with profile.section('import screen'):
+            from penpi.screen import Screen
+        with profile.section('import gatt'):
+            import dbus.exceptions
+            import dbus.mainloop.glib
+            from penpi.gatt.server import GattServer
+            from penpi.gatt.advertise import GattAdvertise
+            from penpi.gatt.rfcomm import RfcommServer, register_profile
+            from penpi import scanner
+
+        # GATT, advertising, RFCOMM, screen and command output share one main loop.
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        bus = loop.bluez_bus()
+
+        try:
+            # The display comes up first, whatever state Bluetooth is in.
+            Screen.start()
+
+            # Bulk output goes over RFCOMM, shells of its own.
+            rfcomm = RfcommServer()
+            rfcomm.start()
+
+            # Nearby devices are kept in a table the menu reads instantly.
+            devices = scanner.Scanner(snapshot_path=scanner.SNAPSHOT_PATH)
+            devices.start()
+            cycle = scanner.duty_cycle()
+            source = scanner.BluezSource(devices, bus, *cycle) if cycle is not None else None
+
+            # Counters and latencies, served on a Unix socket for headless devices.
+            metrics.start()
+
+            def start_bluetooth():
+                # Once bluetoothd is up, and again whenever it restarts; one
+                # part failing leaves the others and the screen running.
+                parts = [
+                    ('GATT server', lambda: GattServer.start(bus)),
+                    ('advertisement', lambda: GattAdvertise.start(bus)),
+                    ('RFCOMM profile', lambda: register_profile(bus, rfcomm)),
+                ]
+                if source is not None:
+                    parts.append(('scanner', source.start))
+                for name, start in parts:
+                    try:
+                        start()
+                    except dbus.exceptions.DBusException as e:
+                        logging.warning('%s not started: %s', name, e)
+
+            loop.watch_bluez(bus, start_bluetooth)
+            loop.run()
+        except KeyboardInterrupt:
+            Screen.stop()
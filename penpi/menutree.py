@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+"""Menu model compiled from config.json, reloaded when the file changes.
+
+config.json holds a list of entries.  An entry with ``command`` runs it, an
+entry with ``items`` opens a submenu holding more entries::
+
+    [
+        {"name": "Hello World", "command": ["echo", "Hello World!"]},
+        {"name": "Network", "items": [
+            {"name": "IP Addresses", "command": "ip -br -4 addr",
+             "cache": {"ttl": 60, "refresh": true}}
+        ]}
+    ]
+
+A command entry may carry ``cache`` settings, see ``penpi.cache``.  An
+entry with ``builtin`` instead shows text the daemon produces itself, see
+``penpi.screen.BUILTINS``; its command is ``{"builtin": NAME}``.
+
+``compile_menu`` flattens the tree breadth first into a ``MenuTree``: flat
+name, command and parent tables in which the entries of every menu are
+consecutive, so finding the n-th entry of a menu is an index computation no
+matter how large the menu is.  The compiled tables are kept in a marshal
+cache next to the config, keyed by the config's mtime, size and SHA-1, so a
+restart skips the JSON parsing.
+
+``MenuWatcher`` recompiles in its own thread when the config changes
+(inotify, falling back to polling the mtime) and swaps the new tree in with
+a single assignment; readers take ``menu.tree`` once and keep using it.
+
+Attributes:
+    CACHE_VERSION (int): Bumped whenever the cached layout changes
+    ROOT (int): Node of the top level menu
+"""
+
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import logging
+import marshal
+import os
+import select
+import struct
+import threading
+from array import array
+
+
+CACHE_VERSION = 2
+
+ROOT = 0
+
+_IN_MODIFY = 0x002
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_EVENT = struct.Struct('iIII')
+
+
+class MenuTree():
+
+    """Compiled menu, node ROOT is the top level menu itself.
+
+    Attributes:
+        names (list): Entry names, indexed by node
+        commands (list): Entry commands, None for submenus and the root, a dict for builtins
+        cache (list): Entry result cache settings (dict), None if uncached
+        parent (array): Parent node of every node
+        first (array): First child node, the children are consecutive
+        count (array): Number of children, -1 for commands
+        key (tuple): (mtime_ns, size, sha1) of the config it was compiled from
+    """
+
+    def __init__(self, names, commands, cache, parent, first, count, key=None):
+        """Summary
+
+        Args:
+            names (list): Entry names, indexed by node
+            commands (list): Entry commands, None for submenus and the root
+            cache (list): Entry result cache settings, None if uncached
+            parent (array): Parent node of every node
+            first (array): First child node of every node
+            count (array): Number of children of every node, -1 for commands
+            key (tuple): (mtime_ns, size, sha1) of the config
+        """
+        self.names = names
+        self.commands = commands
+        self.cache = cache
+        self.parent = parent
+        self.first = first
+        self.count = count
+        self.key = key
+
+    def __len__(self):
+        return len(self.names)
+
+    def is_menu(self, node):
+        """Summary
+
+        Args:
+            node (int): Node
+
+        Returns:
+            bool: Whether node opens a submenu
+        """
+        return self.count[node] >= 0
+
+    def size(self, node):
+        """Summary
+
+        Args:
+            node (int): Menu node
+
+        Returns:
+            int: Number of entries in the menu, 0 for commands
+        """
+        return max(self.count[node], 0)
+
+    def child(self, node, index):
+        """Summary
+
+        Args:
+            node (int): Menu node
+            index (int): Entry of the menu, starting at 0
+
+        Returns:
+            int: Node of the entry
+        """
+        return self.first[node] + index
+
+    def walk(self, path):
+        """Follow a path of entry indices from the top level menu.
+
+        Stops early where the tree no longer has the path, e.g. after a
+        reload removed a submenu.
+
+        Args:
+            path (list): Entry index within every menu opened
+
+        Returns:
+            tuple: (menu node reached, number of path entries followed)
+        """
+        node = ROOT
+        for depth, index in enumerate(path):
+            if index >= self.size(node) or not self.is_menu(self.child(node, index)):
+                return node, depth
+            node = self.child(node, index)
+        return node, len(path)
+
+    def dump(self):
+        """Summary
+
+        Returns:
+            bytes: Marshalled tables, for the disk cache
+        """
+        return marshal.dumps((CACHE_VERSION, self.key, self.names, self.commands,
+            self.cache, self.parent.tobytes(), self.first.tobytes(), self.count.tobytes()))
+
+    @classmethod
+    def load(cls, data):
+        """Summary
+
+        Args:
+            data (bytes): Output of dump()
+
+        Returns:
+            MenuTree: The tree, None if data is from another version
+        """
+        fields = marshal.loads(data)
+        if fields[0] != CACHE_VERSION:
+            return None
+        _, key, names, commands, cache, parent, first, count = fields
+        return cls(names, commands, cache, _array(parent), _array(first), _array(count), tuple(key))
+
+
+def _array(data):
+    table = array('l')
+    table.frombytes(data)
+    return table
+
+
+def compile_menu(entries, key=None):
+    """Flatten nested config entries into a MenuTree, breadth first.
+
+    Args:
+        entries (list): Top level entries as parsed from config.json
+        key (tuple): (mtime_ns, size, sha1) of the config
+
+    Returns:
+        MenuTree: The compiled menu
+
+    Raises:
+        ValueError: Items are not a list, an entry has no name or invalid
+            cache settings
+    """
+    names = ['']
+    commands = [None]
+    cache = [None]
+    parent = array('l', [-1])
+    first = array('l', [0])
+    count = array('l', [0])
+
+    pending = [(ROOT, entries)]
+    while pending:
+        queued = []
+        for node, items in pending:
+            if not isinstance(items, list):
+                raise ValueError('menu items of {!r} are not a list: {!r}'.format(names[node], items))
+            first[node] = len(names)
+            count[node] = len(items)
+            for item in items:
+                if not isinstance(item, dict) or 'name' not in item:
+                    raise ValueError('menu entry without a name: {!r}'.format(item))
+                child = len(names)
+                names.append(str(item['name']))
+                parent.append(node)
+                first.append(0)
+                if 'items' in item:
+                    commands.append(None)
+                    cache.append(None)
+                    count.append(0)
+                    queued.append((child, item['items']))
+                elif 'builtin' in item:
+                    commands.append({'builtin': str(item['builtin'])})
+                    cache.append(None)
+                    count.append(-1)
+                else:
+                    commands.append(item.get('command'))
+                    cache.append(_cache_settings(item))
+                    count.append(-1)
+        pending = queued
+
+    return MenuTree(names, commands, cache, parent, first, count, key)
+
+
+def _cache_settings(item):
+    settings = item.get('cache')
+    if settings is None:
+        return None
+    if not isinstance(settings, dict) or not isinstance(settings.get('ttl', 0), (int, float)):
+        raise ValueError('invalid cache settings of {!r}'.format(item['name']))
+    max_size = settings.get('max_size')
+    if max_size is not None and (isinstance(max_size, bool) or not isinstance(max_size, int) or max_size < 0):
+        raise ValueError('invalid cache settings of {!r}'.format(item['name']))
+    return {
+        'ttl': float(settings.get('ttl', 0)),
+        'refresh': bool(settings.get('refresh', False)),
+        'max_size': settings.get('max_size'),
+    }
+
+
+def _config_key(path, data=None):
+    info = os.stat(str(path))
+    if data is None:
+        with open(str(path), 'rb') as handle:
+            data = handle.read()
+    return (info.st_mtime_ns, info.st_size, hashlib.sha1(data).hexdigest()), data
+
+
+def load_menu(path, cache_path=None):
+    """Compiled menu of a config file, from the cache when it is current.
+
+    The cache is trusted when mtime and size match.  Otherwise the file is
+    hashed and the cache still used if only the mtime changed; failing
+    that the JSON is parsed, compiled and written back to the cache.
+
+    Args:
+        path (Path): config.json
+        cache_path (Path): Compiled cache, None for no cache
+
+    Returns:
+        MenuTree: The compiled menu
+
+    Raises:
+        OSError: The config cannot be read
+        ValueError: The config is not a valid menu
+    """
+    cached = None
+    if cache_path is not None:
+        try:
+            with open(str(cache_path), 'rb') as handle:
+                cached = MenuTree.load(handle.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            cached = None
+
+    info = os.stat(str(path))
+    if cached is not None and cached.key[:2] == (info.st_mtime_ns, info.st_size):
+        return cached
+
+    key, data = _config_key(path)
+    if cached is not None and cached.key[2] == key[2]:
+        cached.key = key
+    else:
+        entries = json.loads(data.decode('utf-8'))
+        if not isinstance(entries, list):
+            raise ValueError('menu config is not a list of entries')
+        cached = compile_menu(entries, key)
+
+    if cache_path is not None:
+        _write_cache(cache_path, cached)
+    return cached
+
+
+def _write_cache(cache_path, tree):
+    # Written next to the cache and renamed, so a crash never leaves half a cache.
+    partial = '{}.{}'.format(cache_path, os.getpid())
+    try:
+        with open(partial, 'wb') as handle:
+            handle.write(tree.dump())
+        os.replace(partial, str(cache_path))
+    except OSError as error:
+        logging.warning('menu cache not written: %s', error)
+
+
+class _Inotify():
+
+    """Directory watch through the inotify syscalls, via ctypes.
+    """
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+        if libc.inotify_add_watch(self.fd, os.fsencode(str(directory)), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch failed')
+
+    def names(self, timeout):
+        """Names of the files changed, waiting up to timeout seconds for one.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return []
+
+        names = []
+        offset = 0
+        while offset + _IN_EVENT.size <= len(data):
+            _, _, _, length = _IN_EVENT.unpack_from(data, offset)
+            offset += _IN_EVENT.size
+            names.append(os.fsdecode(data[offset:offset + length].rstrip(b'\0')))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class MenuWatcher():
+
+    """Keeps a compiled menu in step with its config file.
+
+    Attributes:
+        path (Path): config.json
+        cache_path (Path): Compiled cache, None for no cache
+        tree (MenuTree): Current menu, replaced whole on every reload
+        generation (int): Number of reloads so far
+    """
+
+    def __init__(self, path, cache_path=None, on_change=None, poll=1.0, settle=0.2):
+        """Summary
+
+        Args:
+            path (Path): config.json
+            cache_path (Path): Compiled cache, None for no cache
+            on_change (callable): Called with the watcher from the watcher
+                thread after a new tree was swapped in
+            poll (float): Seconds between mtime checks without inotify
+            settle (float): Seconds to wait for more changes before reloading
+        """
+        self.path = path
+        self.cache_path = cache_path
+        self.tree = load_menu(path, cache_path)
+        self.generation = 0
+
+        self.__on_change = on_change
+        self.__poll = poll
+        self.__settle = settle
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        """Start watching in a background thread.
+        """
+        self.__thread = threading.Thread(target=self.__watch, name='menu')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """Summary
+        """
+        self.__stopped.set()
+
+    def reload(self):
+        """Recompile if the config changed and swap the new tree in.
+
+        A config that does not parse is logged and the old tree kept.
+
+        Returns:
+            bool: Whether a new tree was swapped in
+        """
+        try:
+            tree = load_menu(self.path, self.cache_path)
+        except (OSError, ValueError) as error:
+            logging.warning('menu not reloaded: %s', error)
+            return False
+
+        if tree.key[2] == self.tree.key[2]:
+            self.tree.key = tree.key
+            return False
+
+        self.tree = tree
+        self.generation += 1
+        if self.__on_change:
+            self.__on_change(self)
+        return True
+
+    def __watch(self):
+        try:
+            inotify = _Inotify(self.path.parent)
+        except (OSError, AttributeError) as error:
+            logging.info('menu: no inotify (%s), polling', error)
+            inotify = None
+
+        name = self.path.name
+        try:
+            while not self.__stopped.is_set():
+                if inotify is None:
+                    self.__stopped.wait(self.__poll)
+                    if self.__changed():
+                        self.reload()
+                    continue
+
+                if name not in inotify.names(self.__poll):
+                    continue
+                # Editors write in several steps, reload once they are done.
+                while name in inotify.names(self.__settle):
+                    pass
+                self.reload()
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    def __changed(self):
+        try:
+            info = os.stat(str(self.path))
+        except OSError:
+            return False
+        return (info.st_mtime_ns, info.st_size) != self.tree.key[:2]
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+"""Runtime metrics of the daemon: counters, gauges and latency histograms.
+
+Usage:
+    python3 -m penpi.metrics [--socket PATH]
+
+Modules create their metrics once, at import or construction, and update
+them on their hot paths; an update is an addition or an assignment under
+a lock.  Gauges and counters may instead be given a function that is
+sampled only when the metrics are read, for values that are kept
+elsewhere anyway, such as queue depths.
+
+The metrics are exposed in the Prometheus text format, from the main loop:
+
+    Unix socket  ``PENPI_METRICS_SOCKET``, ``SOCKET_PATH`` by default, every
+                 connection gets the metrics and is closed; the usage line
+                 above prints them
+    Textfile     ``PENPI_METRICS_TEXTFILE``, rewritten every ``interval``
+                 seconds for the textfile collector of the node exporter
+
+Attributes:
+    SOCKET_PATH (str): Default socket path
+    LATENCY_BUCKETS (tuple): Upper bounds in seconds for latencies
+    DURATION_BUCKETS (tuple): Upper bounds in seconds for command durations
+"""
+
+import argparse
+import bisect
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Only serving the metrics needs the main loop, updating them does not.
+try:
+  from gi.repository import GLib
+except ImportError:
+  try:
+    import glib as GLib
+  except ImportError:
+    GLib = None
+
+
+SOCKET_PATH = '/run/penpi/metrics.sock'
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+DURATION_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+_lock = threading.Lock()
+_metrics = {}
+_help = {}
+
+_listener = None
+_sources = []
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in sorted(labels.items())) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter():
+
+    """A count that only goes up.
+
+    Attributes:
+        name (str): Metric name, ending in _total
+        labels (dict): Label names to values
+        function (callable): Returns the value when read, None if inc() counts
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, labels=None, function=None):
+        """Summary
+
+        Args:
+            name (str): Metric name
+            labels (dict): Label names to values
+            function (callable): Returns the value when read
+        """
+        self.name = name
+        self.labels = labels or {}
+        self.function = function
+        self.__value = 0
+        self.__lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Summary
+
+        Args:
+            amount (int): Added to the count
+        """
+        with self.__lock:
+            self.__value += amount
+
+    @property
+    def value(self):
+        """Summary
+
+        Returns:
+            float: Current value
+        """
+        if self.function is not None:
+            return self.function()
+        return self.__value
+
+    def samples(self):
+        """Summary
+
+        Returns:
+            list: (name, labels, value) tuples to expose
+        """
+        return [(self.name, self.labels, self.value)]
+
+
+class Gauge(Counter):
+
+    """A value that goes up and down.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, labels=None, function=None):
+        """Summary
+
+        Args:
+            name (str): Metric name
+            labels (dict): Label names to values
+            function (callable): Returns the value when read
+        """
+        super().__init__(name, labels, function)
+        self.__value = 0
+        self.__lock = threading.Lock()
+
+    def __check(self):
+        if self.function is not None:
+            raise ValueError('{} is read from a function'.format(self.name))
+
+    def set(self, value):
+        """Summary
+
+        Args:
+            value (float): New value
+
+        Raises:
+            ValueError: The gauge is read from a function
+        """
+        self.__check()
+        with self.__lock:
+            self.__value = value
+
+    def inc(self, amount=1):
+        """Summary
+
+        Args:
+            amount (int): Added to the value
+
+        Raises:
+            ValueError: The gauge is read from a function
+        """
+        self.__check()
+        with self.__lock:
+            self.__value += amount
+
+    def dec(self, amount=1):
+        """Summary
+
+        Args:
+            amount (int): Taken from the value
+
+        Raises:
+            ValueError: The gauge is read from a function
+        """
+        self.inc(-amount)
+
+    @property
+    def value(self):
+        """Summary
+
+        Returns:
+            float: Current value
+        """
+        if self.function is not None:
+            return self.function()
+        return self.__value
+
+
+class Histogram():
+
+    """Observations counted into buckets, with their count and sum.
+
+    Attributes:
+        name (str): Metric name
+        labels (dict): Label names to values
+        buckets (tuple): Upper bounds of the buckets, ascending
+        count (int): Observations
+        sum (float): Sum of the observations
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, labels=None, buckets=LATENCY_BUCKETS):
+        """Summary
+
+        Args:
+            name (str): Metric name
+            labels (dict): Label names to values
+            buckets (tuple): Upper bounds of the buckets, ascending
+        """
+        self.name = name
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.__counts = [0] * (len(self.buckets) + 1)
+        self.__lock = threading.Lock()
+
+    def observe(self, value):
+        """Summary
+
+        Args:
+            value (float): Observation, seconds for latencies
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            self.__counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        """Observe how long a block took.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def quantile(self, fraction):
+        """Estimate a quantile from the buckets.
+
+        Args:
+            fraction (float): 0.5 for the median
+
+        Returns:
+            float: Upper bound of the bucket the quantile falls in, None
+                without observations
+        """
+        with self.__lock:
+            counts = list(self.__counts)
+            total = self.count
+        if not total:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if seen >= fraction * total:
+                return bound
+
+    def samples(self):
+        """Summary
+
+        Returns:
+            list: (name, labels, value) tuples to expose
+        """
+        with self.__lock:
+            counts = list(self.__counts)
+            total, added = self.count, self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = dict(self.labels, le=_number(float(bound)))
+            samples.append((self.name + '_bucket', labels, cumulative))
+        samples.append((self.name + '_sum', self.labels, added))
+        samples.append((self.name + '_count', self.labels, total))
+        return samples
+
+
+def _register(cls, name, help, labels, **options):
+    key = (name, tuple(sorted((labels or {}).items())))
+    with _lock:
+        metric = _metrics.get(key)
+        if metric is None:
+            metric = _metrics[key] = cls(name, labels, **options)
+            _help[name] = (help, cls.kind)
+        elif type(metric) is not cls:
+            raise ValueError('{} is a {}'.format(name, metric.kind))
+    return metric
+
+
+def counter(name, help, labels=None, function=None):
+    """Get or create a counter.
+
+    Args:
+        name (str): Metric name, ending in _total
+        help (str): What it counts
+        labels (dict): Label names to values, one counter per combination
+        function (callable): Returns the value when read, instead of inc()
+
+    Returns:
+        Counter: The counter
+    """
+    return _register(Counter, name, help, labels, function=function)
+
+
+def gauge(name, help, labels=None, function=None):
+    """Get or create a gauge.
+
+    Args:
+        name (str): Metric name
+        help (str): What it measures
+        labels (dict): Label names to values, one gauge per combination
+        function (callable): Returns the value when read, instead of set()
+
+    Returns:
+        Gauge: The gauge
+    """
+    return _register(Gauge, name, help, labels, function=function)
+
+
+def histogram(name, help, labels=None, buckets=LATENCY_BUCKETS):
+    """Get or create a histogram.
+
+    Args:
+        name (str): Metric name, ending in the unit, e.g. _seconds
+        help (str): What it observes
+        labels (dict): Label names to values, one histogram per combination
+        buckets (tuple): Upper bounds of the buckets, ascending
+
+    Returns:
+        Histogram: The histogram
+    """
+    return _register(Histogram, name, help, labels, buckets=buckets)
+
+
+def unregister(metric):
+    """Drop a metric, e.g. one sampling an object that went away.
+
+    Args:
+        metric (Counter): Counter, gauge or histogram
+    """
+    key = (metric.name, tuple(sorted(metric.labels.items())))
+    with _lock:
+        if _metrics.get(key) is metric:
+            del _metrics[key]
+
+
+def exposition():
+    """Summary
+
+    Returns:
+        str: Every metric in the Prometheus text format
+    """
+    with _lock:
+        metrics = sorted(_metrics.items())
+        helps = dict(_help)
+
+    lines = []
+    name = None
+    for (metric_name, _), metric in metrics:
+        if metric_name != name:
+            name = metric_name
+            help, kind = helps[name]
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+        try:
+            samples = metric.samples()
+        except Exception as e:
+            logging.warning('metrics: %s: %s', name, e)
+            continue
+        for sample, labels, value in samples:
+            lines.append('{}{} {}'.format(sample, _label_text(labels), _number(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path):
+    """Write the metrics to a file, replacing it atomically.
+
+    Returns:
+        bool: True, keeps the timeout source alive
+    """
+    partial = '{}.{}'.format(path, os.getpid())
+    try:
+        with open(partial, 'w') as handle:
+            handle.write(exposition())
+        os.replace(partial, path)
+    except OSError as e:
+        logging.warning('metrics: %s not written: %s', path, e)
+    return True
+
+
+def _send(sock, data):
+    # Whatever the client does not take at once is sent as it becomes
+    # writable, so a slow reader never holds up the main loop.
+    pending = [memoryview(data)]
+
+    def writable(fd=None, condition=None):
+        try:
+            sent = sock.send(pending[0])
+        except BlockingIOError:
+            return True
+        except OSError:
+            sent = len(pending[0])
+        pending[0] = pending[0][sent:]
+        if len(pending[0]):
+            return True
+        sock.close()
+        return False
+
+    if writable():
+        GLib.io_add_watch(sock.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_OUT | GLib.IO_ERR | GLib.IO_HUP, writable)
+
+
+def _accept(fd, condition):
+    while True:
+        try:
+            sock, _ = _listener.accept()
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            logging.warning('metrics: accept failed: %s', e)
+            return True
+        sock.setblocking(False)
+        _send(sock, exposition().encode())
+
+
+def start(socket_path=None, textfile=None, interval=15):
+    """Serve the metrics from the main loop.
+
+    Args:
+        socket_path (str): Unix socket, PENPI_METRICS_SOCKET or SOCKET_PATH
+            if None, '' for none
+        textfile (str): Prometheus textfile, PENPI_METRICS_TEXTFILE if None,
+            '' for none
+        interval (int): Seconds between textfile writes
+    """
+    global _listener
+
+    if socket_path is None:
+        socket_path = os.environ.get('PENPI_METRICS_SOCKET', SOCKET_PATH)
+    if textfile is None:
+        textfile = os.environ.get('PENPI_METRICS_TEXTFILE', '')
+
+    if socket_path:
+        try:
+            os.makedirs(os.path.dirname(socket_path) or '.', exist_ok=True)
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            _listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            _listener.bind(socket_path)
+            _listener.listen(4)
+            _listener.setblocking(False)
+            _sources.append(GLib.io_add_watch(_listener.fileno(), GLib.PRIORITY_DEFAULT,
+                GLib.IO_IN, _accept))
+        except OSError as e:
+            logging.warning('metrics: cannot serve on %s: %s', socket_path, e)
+            _listener = None
+
+    if textfile:
+        write_textfile(textfile)
+        _sources.append(GLib.timeout_add_seconds(interval, write_textfile, textfile))
+
+
+def stop():
+    """Summary
+    """
+    global _listener
+
+    for source in _sources:
+        GLib.source_remove(source)
+    del _sources[:]
+    if _listener is not None:
+        _listener.close()
+        _listener = None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python3 -m penpi.metrics',
+        description='Print the metrics of the running daemon.')
+    parser.add_argument('--socket', default=os.environ.get('PENPI_METRICS_SOCKET', SOCKET_PATH))
+    args = parser.parse_args(argv)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(args.socket)
+        data = b''.join(iter(lambda: sock.recv(65536), b''))
+    except OSError as e:
+        print('penpi.metrics: {}: {}'.format(args.socket, e), file=sys.stderr)
+        return 1
+    finally:
+        sock.close()
+    sys.stdout.write(data.decode())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,35 +1,43 @@
 #!/usr/bin/env python3
+"""Standalone RFCOMM shell, see penpi.gatt.rfcomm.
 
-from bluetooth import BluetoothSocket, RFCOMM, PORT_ANY, advertise_service, SERIAL_PORT_CLASS, SERIAL_PORT_PROFILE
+Usage:
+    python3 -m penpi.pp_bt [ADDRESS ...]
 
-server_sock=BluetoothSocket( RFCOMM )
-server_sock.bind(("",PORT_ANY))
-server_sock.listen(1)
+Without an address BlueZ passes RFCOMM connections in through the
+registered profile; ADDRESS listens itself instead, ``rfcomm:CHANNEL``,
+``tcp:HOST:PORT`` or ``unix:PATH``.
+"""
 
-port = server_sock.getsockname()[1]
+import logging
+import sys
 
-uuid = "a140ff7b-6539-40fe-9481-671108c144d6"
+from penpi import loop
+from penpi.gatt.rfcomm import RfcommServer, listen, register_profile
 
-advertise_service( server_sock, "PenPi Service", uuid)
 
-                   
-print("Waiting for connection on RFCOMM channel %d" % port)
+def main(argv):
+    logging.basicConfig(level=logging.INFO, format='%(relativeCreated)6d %(message)s')
 
-client_sock, client_info = server_sock.accept()
+    server = RfcommServer()
+    server.start()
+    if argv:
+        for address in argv:
+            server.serve(listen(address))
+            print("Waiting for connections on {}".format(address))
+    else:
+        import dbus.mainloop.glib
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        register_profile(loop.bluez_bus(), server)
 
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+    return 0
 
-print("Accepted connection from ", client_info)
 
-try:
-    while True:
-        data = client_sock.recv(1024)
-        if len(data) == 0: break
-        print("received [%s]" % data)
-except IOError:
-    pass
-
-print("disconnected")
-
-client_sock.close()
-server_sock.close()
-print("all done")
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
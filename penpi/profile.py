@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Startup profiling.
+
+Enabled with ``PENPI_PROFILE=1`` or ``python3 -m penpi --profile``.  Every
+``section()`` logs how long it took and how much resident memory it added,
+every ``mark()`` logs the time since the daemon started, and once all
+``MILESTONES`` are reached a summary is logged.  When disabled, sections
+and marks cost a flag check.
+
+RSS deltas are taken from /proc/self/status and include whatever the other
+threads allocated at the same time.
+
+Attributes:
+    MILESTONES (tuple): Marks after which the summary is logged
+    enabled (bool): Whether profiling is on
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+MILESTONES = ('logo', 'advertising')
+
+enabled = os.environ.get('PENPI_PROFILE', '') not in ('', '0')
+
+_start = time.monotonic()
+_lock = threading.Lock()
+_sections = []
+_marks = {}
+
+
+def rss():
+    """Summary
+
+    Returns:
+        int: Resident set size of the process in kB, 0 if unknown
+    """
+    try:
+        with open('/proc/self/status') as handle:
+            for line in handle:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def enable():
+    """Turn profiling on, counting from now if nothing was recorded yet.
+    """
+    global enabled
+    global _start
+
+    with _lock:
+        if not _sections and not _marks:
+            _start = time.monotonic()
+        enabled = True
+
+
+@contextmanager
+def section(name):
+    """Time a block and record the RSS it added.
+
+    Args:
+        name (str): Subsystem, e.g. 'import screen' or 'setup display'
+    """
+    if not enabled:
+        yield
+        return
+
+    rss_before = rss()
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        seconds = time.monotonic() - started
+        added = rss() - rss_before
+        with _lock:
+            _sections.append((name, seconds, added))
+        logging.info('profile: %-20s %7.1f ms %+6d kB', name, seconds * 1000, added)
+
+
+def mark(name):
+    """Record that a milestone was reached.
+
+    Args:
+        name (str): Milestone, e.g. 'logo' or 'advertising'
+    """
+    if not enabled:
+        return
+
+    with _lock:
+        if name in _marks:
+            return
+        _marks[name] = time.monotonic() - _start
+        done = all(m in _marks for m in MILESTONES)
+    logging.info('profile: time to %-12s %7.1f ms', name, _marks[name] * 1000)
+
+    if done:
+        report()
+
+
+def report():
+    """Log everything recorded so far.
+    """
+    with _lock:
+        sections = list(_sections)
+        marks = sorted(_marks.items(), key=lambda m: m[1])
+
+    logging.info('profile: summary, RSS now %d kB', rss())
+    for name, seconds, added in sections:
+        logging.info('profile:   %-20s %7.1f ms %+6d kB', name, seconds * 1000, added)
+    for name, seconds in marks:
+        logging.info('profile:   time to %-12s %7.1f ms', name, seconds * 1000)
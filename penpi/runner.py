@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""Background execution of menu commands with streamed output.
+
+``CommandRunner`` starts a command without waiting for it and collects its
+output line by line into a bounded ``LineBuffer`` from a reader thread, so
+the screen can show output while the command is still running and cancel
+it at any time.  With ``main_loop`` the output is read from IO watches on
+the GLib main loop instead, no thread involved.
+
+Attributes:
+    MAX_LINE (int): Longest line in bytes, output without a newline is cut
+        into lines of this length
+    durations (Histogram): Seconds from start to exit of every command
+    output_bytes (Counter): Output read from commands
+"""
+
+import os
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+
+try:
+  from gi.repository import GLib
+except ImportError:
+  try:
+    import glib as GLib
+  except ImportError:
+    GLib = None
+
+from penpi import metrics
+
+
+MAX_LINE = 4096
+
+durations = metrics.histogram('penpi_command_seconds', 'Run time of menu commands',
+    buckets=metrics.DURATION_BUCKETS)
+output_bytes = metrics.counter('penpi_command_output_bytes_total', 'Output read from menu commands')
+
+
+class LineBuffer():
+
+    """Thread-safe ring of the most recent output lines.
+
+    Lines are numbered from the start of the output; once the ring is full
+    the oldest lines are dropped and ``start`` moves on.
+
+    Attributes:
+        max_lines (int): Number of lines kept
+    """
+
+    def __init__(self, max_lines=2000):
+        """Summary
+
+        Args:
+            max_lines (int): Number of lines kept
+        """
+        self.max_lines = max_lines
+        self.__lines = deque(maxlen=max_lines)
+        self.__total = 0
+        self.__lock = threading.Lock()
+
+    def append(self, line):
+        """Summary
+
+        Args:
+            line (str): Line without its newline
+        """
+        with self.__lock:
+            self.__lines.append(line)
+            self.__total += 1
+
+    @property
+    def start(self):
+        """Summary
+
+        Returns:
+            int: Number of the oldest line still held
+        """
+        with self.__lock:
+            return self.__total - len(self.__lines)
+
+    def span(self):
+        """Summary
+
+        Returns:
+            tuple: (number of the oldest line held, number of lines held)
+        """
+        with self.__lock:
+            return self.__total - len(self.__lines), len(self.__lines)
+
+    @property
+    def total(self):
+        """Summary
+
+        Returns:
+            int: Number of lines appended so far, grows with every append
+        """
+        return self.__total
+
+    def __len__(self):
+        return len(self.__lines)
+
+    def line(self, number):
+        """Summary
+
+        Args:
+            number (int): Line number counted from the start of the output
+
+        Returns:
+            str: The line, empty if it was dropped already
+        """
+        with self.__lock:
+            index = number - (self.__total - len(self.__lines))
+            if 0 <= index < len(self.__lines):
+                return self.__lines[index]
+            return ''
+
+    def text(self):
+        """Summary
+
+        Returns:
+            str: Lines held, joined by newlines
+        """
+        with self.__lock:
+            return '\n'.join(self.__lines)
+
+
+class CommandRunner():
+
+    """A command running in its own process group, stdout and stderr merged.
+
+    Attributes:
+        cmd (list): Command line
+        lines (LineBuffer): Output collected so far
+        process (subprocess.Popen): Running process, None before start()
+        cancelled (bool): Whether cancel() was called before it exited
+    """
+
+    def __init__(self, cmd, max_lines=2000, on_output=None, on_exit=None, main_loop=False):
+        """Summary
+
+        Args:
+            cmd (list or str): Command line, strings are run through sh -c
+            max_lines (int): Output lines kept
+            on_output (callable): Called from the reader thread after new
+                output arrived and once more when the output ended
+            on_exit (callable): Called from the reader thread once the
+                process exited and all output was collected
+            main_loop (bool): Read from the GLib main loop, the callbacks
+                are then called from the main loop
+        """
+        if isinstance(cmd, str):
+            cmd = ["sh", "-c", cmd]
+
+        self.cmd = cmd
+        self.lines = LineBuffer(max_lines)
+        self.process = None
+        self.cancelled = False
+
+        self.__on_output = on_output
+        self.__on_exit = on_exit
+        self.__thread = None
+        self.__main_loop = main_loop
+        self.__partial = b''
+        self.__finished = False
+        self.__started = None
+
+    def start(self):
+        """Start the command and the reader thread, returns immediately.
+        """
+        self.process = subprocess.Popen(self.cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=0,
+            start_new_session=True)
+        self.__started = time.monotonic()
+
+        if self.__main_loop:
+            os.set_blocking(self.process.stdout.fileno(), False)
+            GLib.io_add_watch(self.process.stdout.fileno(), GLib.PRIORITY_DEFAULT,
+                GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self.__on_readable)
+            return
+
+        self.__thread = threading.Thread(target=self.__read, name='runner')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __read(self):
+        for raw in iter(lambda: self.process.stdout.readline(MAX_LINE), b''):
+            output_bytes.inc(len(raw))
+            self.lines.append(raw.decode('utf-8', 'replace').rstrip('\r\n'))
+            if self.__on_output:
+                self.__on_output(self)
+
+        self.process.stdout.close()
+        self.process.wait()
+        durations.observe(time.monotonic() - self.__started)
+        if self.cancelled:
+            self.lines.append('[cancelled]')
+        if self.__on_exit:
+            self.__on_exit(self)
+        if self.__on_output:
+            self.__on_output(self)
+
+    def __on_readable(self, fd, condition):
+        try:
+            data = os.read(fd, 4096)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b''
+
+        if data:
+            output_bytes.inc(len(data))
+            *lines, self.__partial = (self.__partial + data).split(b'\n')
+            # A command writing without newlines must not fill the memory.
+            while len(self.__partial) >= MAX_LINE:
+                lines.append(self.__partial[:MAX_LINE])
+                self.__partial = self.__partial[MAX_LINE:]
+            for raw in lines:
+                self.lines.append(raw.decode('utf-8', 'replace').rstrip('\r'))
+            if lines and self.__on_output:
+                self.__on_output(self)
+            return True
+
+        if self.__partial:
+            self.lines.append(self.__partial.decode('utf-8', 'replace').rstrip('\r'))
+            self.__partial = b''
+        self.process.stdout.close()
+        GLib.child_watch_add(GLib.PRIORITY_DEFAULT, self.process.pid, self.__on_exited)
+        return False
+
+    def __on_exited(self, pid, status):
+        # GLib reaped the process, Popen learns its status from here.
+        if os.WIFSIGNALED(status):
+            self.process.returncode = -os.WTERMSIG(status)
+        else:
+            self.process.returncode = os.WEXITSTATUS(status)
+        self.__finished = True
+        durations.observe(time.monotonic() - self.__started)
+        if self.cancelled:
+            self.lines.append('[cancelled]')
+        if self.__on_exit:
+            self.__on_exit(self)
+        if self.__on_output:
+            self.__on_output(self)
+
+    @property
+    def running(self):
+        """Summary
+
+        Returns:
+            bool: Whether the process or its output is still going
+        """
+        if self.__main_loop:
+            return self.process is not None and not self.__finished
+        return self.__thread is not None and self.__thread.is_alive()
+
+    @property
+    def returncode(self):
+        """Summary
+
+        Returns:
+            int: Exit status, None while running
+        """
+        if self.running:
+            return None
+        return self.process.returncode
+
+    def cancel(self, timeout=1.0):
+        """Terminate the process group, and kill it if it does not exit in time.
+
+        Never waits when reading from the main loop, the kill is then
+        scheduled on it.
+
+        Args:
+            timeout (float): Seconds to wait between SIGTERM and SIGKILL
+        """
+        if self.__main_loop:
+            if self.running and not self.cancelled:
+                self.cancelled = True
+                self.__kill(signal.SIGTERM)
+                GLib.timeout_add(int(timeout * 1000), self.__expired)
+            return
+
+        if self.process is None or self.process.poll() is not None:
+            return
+
+        self.cancelled = True
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.process.pid, signal.SIGKILL)
+                self.process.wait()
+        except ProcessLookupError:
+            pass
+
+    def __expired(self):
+        if self.running:
+            self.__kill(signal.SIGKILL)
+        return False
+
+    def __kill(self, signum):
+        try:
+            os.killpg(self.process.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def wait(self, timeout=None):
+        """Wait for the process to exit and its output to be collected.
+
+        Args:
+            timeout (float): Seconds to wait, None waits forever
+
+        Returns:
+            int: Exit status, None on timeout
+        """
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+        return self.returncode
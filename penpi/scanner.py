@@ -0,0 +1,568 @@
+#!/usr/bin/env python3
+"""Background Bluetooth scanning into a table of nearby devices.
+
+Usage:
+    python3 -m penpi.scanner [--file PATH] [--replay RECORDING]
+
+``Scanner`` keeps a device table (address, name, RSSI, first and last
+seen, advertisement data) that sources update incrementally; devices not
+seen for ``ttl`` seconds are evicted.  Subscribers hear of every device
+added, changed or removed.  RSSI alone counts as a change only once it
+moved by ``rssi_delta`` dB, so a crowded room does not flood them.
+
+Sources:
+
+    BluezSource   BlueZ discovery over D-Bus, LE and classic interleaved,
+                  run for ``window`` seconds out of every ``interval``
+    ReplaySource  Records from a JSON lines recording, for tests and demos
+
+The daemon writes the table to ``SNAPSHOT_PATH`` whenever it changed, at
+most once a second; the menu reads it in-process through
+``read_snapshot()``, the GATT shell by running ``python3 -m penpi.scanner``.  The duty cycle of the daemon is
+``PENPI_SCAN=WINDOW/INTERVAL`` in seconds, 10/30 by default, 0 turns
+scanning off.  Each line of a recording is an
+object with ``time`` (seconds from the start) and the fields of
+``Scanner.update``, ``{"time": 1.5, "address": "AA:BB:CC:DD:EE:FF",
+"rssi": -60, "name": "Phone"}``.
+
+Attributes:
+    SNAPSHOT_PATH (Path): Table written by the daemon
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+# Reading the table needs no main loop, only scanning and replay do.
+try:
+  from gi.repository import GLib
+except ImportError:
+  try:
+    import glib as GLib
+  except ImportError:
+    GLib = None
+
+
+SNAPSHOT_PATH = Path('/run/penpi/devices.json')
+
+ADDED = 'added'
+CHANGED = 'changed'
+REMOVED = 'removed'
+
+BLUEZ_SERVICE_NAME = 'org.bluez'
+ADAPTER_IFACE = 'org.bluez.Adapter1'
+DEVICE_IFACE = 'org.bluez.Device1'
+DBUS_OM_IFACE = 'org.freedesktop.DBus.ObjectManager'
+DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
+
+
+class Device():
+
+    """A device in the table.
+
+    Attributes:
+        address (str): Bluetooth address
+        name (str): Name, None until one was seen
+        rssi (int): Last signal strength in dBm, None if unknown
+        first_seen (float): time.time() it was first seen
+        last_seen (float): time.time() it was last seen
+        data (dict): Advertisement data: 'manufacturer' (company id to
+            hex), 'service' (UUID to hex), 'uuids' (list), 'classic' (bool)
+    """
+
+    def __init__(self, address, now):
+        """Summary
+
+        Args:
+            address (str): Bluetooth address
+            now (float): time.time() it was seen
+        """
+        self.address = address
+        self.name = None
+        self.rssi = None
+        self.first_seen = now
+        self.last_seen = now
+        self.data = {}
+
+    def to_dict(self):
+        """Summary
+
+        Returns:
+            dict: The device, for JSON
+        """
+        return {
+            'address': self.address,
+            'name': self.name,
+            'rssi': self.rssi,
+            'first_seen': self.first_seen,
+            'last_seen': self.last_seen,
+            'data': self.data,
+        }
+
+    def __repr__(self):
+        return '<Device {} {!r} {}>'.format(self.address, self.name, self.rssi)
+
+
+class Scanner():
+
+    """Device table, updated by sources on the main loop.
+
+    Attributes:
+        ttl (float): Seconds after which an unseen device is evicted
+        rssi_delta (int): RSSI change that counts as a change
+        snapshot_path (Path): Table written here on change, None for none
+    """
+
+    def __init__(self, ttl=120, rssi_delta=5, snapshot_path=None):
+        """Summary
+
+        Args:
+            ttl (float): Seconds after which an unseen device is evicted
+            rssi_delta (int): RSSI change that counts as a change
+            snapshot_path (Path): Table written here on change, None for none
+        """
+        self.ttl = ttl
+        self.rssi_delta = rssi_delta
+        self.snapshot_path = snapshot_path
+
+        self.__devices = {}
+        self.__listeners = []
+        self.__evict_source = None
+        self.__snapshot_source = None
+
+    def __len__(self):
+        return len(self.__devices)
+
+    def start(self):
+        """Evict unseen devices from now on, from the main loop.
+        """
+        self.__evict_source = GLib.timeout_add_seconds(max(int(self.ttl // 4), 1), self.evict)
+        self.__changed()
+
+    def stop(self):
+        """Summary
+        """
+        for source in (self.__evict_source, self.__snapshot_source):
+            if source is not None:
+                GLib.source_remove(source)
+        self.__evict_source = self.__snapshot_source = None
+
+    def subscribe(self, callback):
+        """Summary
+
+        Args:
+            callback (callable): Called with (ADDED, CHANGED or REMOVED, Device)
+        """
+        self.__listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        """Summary
+
+        Args:
+            callback (callable): Callback passed to subscribe()
+        """
+        self.__listeners.remove(callback)
+
+    def get(self, address):
+        """Summary
+
+        Args:
+            address (str): Bluetooth address
+
+        Returns:
+            Device: The device, None if it is not in the table
+        """
+        return self.__devices.get(address.upper())
+
+    def devices(self):
+        """Summary
+
+        Returns:
+            list: Devices in the table, strongest signal first
+        """
+        return sorted(self.__devices.values(),
+            key=lambda device: (device.rssi is None, -(device.rssi or 0)))
+
+    def update(self, address, name=None, rssi=None, data=None, now=None):
+        """Record a sighting of a device.
+
+        Args:
+            address (str): Bluetooth address
+            name (str): Name, None if not known from this sighting
+            rssi (int): Signal strength in dBm, None if not known
+            data (dict): Advertisement data merged into what is known
+            now (float): time.time() of the sighting, now if None
+
+        Returns:
+            Device: The device
+        """
+        now = time.time() if now is None else now
+        address = address.upper()
+        device = self.__devices.get(address)
+        event = None
+        if device is None:
+            device = self.__devices[address] = Device(address, now)
+            event = ADDED
+
+        device.last_seen = max(device.last_seen, now)
+        if name is not None and name != device.name:
+            device.name = name
+            event = event or CHANGED
+        if rssi is not None:
+            if device.rssi is None or abs(rssi - device.rssi) >= self.rssi_delta:
+                event = event or CHANGED
+            device.rssi = rssi
+        if data:
+            for key, value in data.items():
+                if device.data.get(key) != value:
+                    device.data[key] = value
+                    event = event or CHANGED
+
+        if event is not None:
+            self.__notify(event, device)
+        return device
+
+    def evict(self, now=None):
+        """Drop devices not seen for ttl seconds.
+
+        Args:
+            now (float): time.time(), now if None
+
+        Returns:
+            bool: True, keeps the timeout source alive
+        """
+        now = time.time() if now is None else now
+        for device in list(self.__devices.values()):
+            if now - device.last_seen > self.ttl:
+                del self.__devices[device.address]
+                self.__notify(REMOVED, device)
+        return True
+
+    def clear(self):
+        """Summary
+        """
+        for device in list(self.__devices.values()):
+            del self.__devices[device.address]
+            self.__notify(REMOVED, device)
+
+    def __notify(self, event, device):
+        for callback in list(self.__listeners):
+            callback(event, device)
+        self.__changed()
+
+    def __changed(self):
+        # Written once a second at most, whatever changed in between.
+        if self.snapshot_path is not None and self.__snapshot_source is None:
+            self.__snapshot_source = GLib.timeout_add(1000, self.__write_snapshot)
+
+    def __write_snapshot(self):
+        self.__snapshot_source = None
+        path = Path(self.snapshot_path)
+        partial = '{}.{}'.format(path, os.getpid())
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(partial, 'w') as handle:
+                json.dump({'time': time.time(), 'ttl': self.ttl,
+                    'devices': [device.to_dict() for device in self.devices()]}, handle)
+            os.replace(partial, str(path))
+        except OSError as error:
+            logging.warning('scanner: snapshot not written: %s', error)
+        return False
+
+
+def _bytes_hex(value):
+    return bytes(bytearray(value)).hex()
+
+
+class BluezSource():
+
+    """Discovery through BlueZ, LE and classic, with a duty cycle.
+
+    Attributes:
+        scanner (Scanner): Table to update
+        window (float): Seconds of every interval spent discovering
+        interval (float): Seconds from one discovery window to the next
+    """
+
+    def __init__(self, scanner, bus, window=10, interval=30):
+        """Summary
+
+        Args:
+            scanner (Scanner): Table to update
+            bus (dbus.Bus): Bus BlueZ is on, with the GLib main loop
+            window (float): Seconds of every interval spent discovering,
+                discovery never stops if it is not shorter than interval
+            interval (float): Seconds from one discovery window to the next
+        """
+        self.scanner = scanner
+        self.bus = bus
+        self.window = window
+        self.interval = interval
+
+        self.__adapter = None
+        self.__addresses = {}
+        self.__source = None
+        self.__discovering = False
+        self.__receivers = []
+
+    def start(self):
+        """Start the duty cycle, from the main loop, or again once BlueZ restarted.
+
+        Returns:
+            bool: Whether an adapter was found
+        """
+        import dbus
+
+        if self.__source is not None:
+            GLib.source_remove(self.__source)
+            self.__source = None
+        self.__adapter = None
+        manager = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, '/'), DBUS_OM_IFACE)
+        for path, interfaces in manager.GetManagedObjects().items():
+            if ADAPTER_IFACE in interfaces and self.__adapter is None:
+                self.__adapter = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, path), ADAPTER_IFACE)
+            if DEVICE_IFACE in interfaces:
+                self.__device(path, interfaces[DEVICE_IFACE])
+        if self.__adapter is None:
+            logging.warning('scanner: no adapter')
+            return False
+
+        if not self.__receivers:
+            self.__receivers = [
+                self.bus.add_signal_receiver(self.__interfaces_added, 'InterfacesAdded',
+                    DBUS_OM_IFACE, BLUEZ_SERVICE_NAME),
+                self.bus.add_signal_receiver(self.__properties_changed, 'PropertiesChanged',
+                    DBUS_PROP_IFACE, BLUEZ_SERVICE_NAME, arg0=DEVICE_IFACE, path_keyword='path'),
+            ]
+
+        try:
+            self.__adapter.SetDiscoveryFilter({'Transport': 'auto', 'DuplicateData': dbus.Boolean(True)})
+        except dbus.exceptions.DBusException as error:
+            logging.info('scanner: no discovery filter: %s', error)
+        self.__scan()
+        return True
+
+    def stop(self):
+        """Summary
+        """
+        if self.__source is not None:
+            GLib.source_remove(self.__source)
+            self.__source = None
+        if self.__discovering:
+            self.__stop_discovery()
+
+    def __stop_discovery(self):
+        self.__discovering = False
+        self.__adapter.StopDiscovery(reply_handler=lambda: None,
+            error_handler=lambda error: logging.info('scanner: %s', error))
+
+    def __scan(self):
+        self.__discovering = True
+        self.__adapter.StartDiscovery(reply_handler=lambda: None,
+            error_handler=lambda error: logging.warning('scanner: %s', error))
+        if self.window < self.interval:
+            self.__source = GLib.timeout_add(int(self.window * 1000), self.__pause)
+        else:
+            self.__source = None
+        return False
+
+    def __pause(self):
+        self.__stop_discovery()
+        self.__source = GLib.timeout_add(int((self.interval - self.window) * 1000), self.__scan)
+        return False
+
+    def __interfaces_added(self, path, interfaces):
+        if DEVICE_IFACE in interfaces:
+            self.__device(path, interfaces[DEVICE_IFACE])
+
+    def __properties_changed(self, interface, changed, invalidated, path=None):
+        self.__device(path, changed)
+
+    def __device(self, path, properties):
+        address = properties.get('Address')
+        if address is not None:
+            self.__addresses[str(path)] = str(address)
+        address = self.__addresses.get(str(path))
+        # Devices BlueZ remembers but does not see carry no RSSI.
+        if address is None or ('RSSI' not in properties and self.scanner.get(address) is None):
+            return
+
+        data = {}
+        if 'ManufacturerData' in properties:
+            data['manufacturer'] = {str(int(key)): _bytes_hex(value)
+                for key, value in properties['ManufacturerData'].items()}
+        if 'ServiceData' in properties:
+            data['service'] = {str(key): _bytes_hex(value)
+                for key, value in properties['ServiceData'].items()}
+        if 'UUIDs' in properties:
+            data['uuids'] = sorted(str(uuid) for uuid in properties['UUIDs'])
+        if 'Class' in properties:
+            data['classic'] = True
+
+        name = properties.get('Name', properties.get('Alias'))
+        rssi = properties.get('RSSI')
+        self.scanner.update(address, None if name is None else str(name),
+            None if rssi is None else int(rssi), data)
+
+
+class ReplaySource():
+
+    """Feeds a recording to a scanner, in real time or faster.
+
+    Attributes:
+        scanner (Scanner): Table to update
+        records (list): Records ordered by their 'time'
+        speed (float): Playback speed, 2.0 plays twice as fast
+    """
+
+    def __init__(self, scanner, records, speed=1.0, on_done=None):
+        """Summary
+
+        Args:
+            scanner (Scanner): Table to update
+            records (list): Records, dicts with 'time' and the fields of
+                Scanner.update
+            speed (float): Playback speed
+            on_done (callable): Called once the last record was fed
+        """
+        self.scanner = scanner
+        self.records = sorted(records, key=lambda record: record.get('time', 0))
+        self.speed = speed
+        self.__on_done = on_done
+        self.__next = 0
+        self.__started = None
+        self.__source = None
+
+    @classmethod
+    def load(cls, scanner, path, **options):
+        """Summary
+
+        Args:
+            scanner (Scanner): Table to update
+            path (str): JSON lines recording
+            **options: speed and on_done
+
+        Returns:
+            ReplaySource: The source
+        """
+        with open(str(path)) as handle:
+            records = [json.loads(line) for line in handle if line.strip()]
+        return cls(scanner, records, **options)
+
+    def start(self):
+        """Summary
+        """
+        self.__started = time.monotonic()
+        self.__feed()
+
+    def stop(self):
+        """Summary
+        """
+        if self.__source is not None:
+            GLib.source_remove(self.__source)
+            self.__source = None
+
+    def __feed(self):
+        self.__source = None
+        elapsed = (time.monotonic() - self.__started) * self.speed
+        while self.__next < len(self.records) and self.records[self.__next].get('time', 0) <= elapsed:
+            record = dict(self.records[self.__next])
+            record.pop('time', None)
+            self.scanner.update(**record)
+            self.__next += 1
+
+        if self.__next < len(self.records):
+            wait = (self.records[self.__next].get('time', 0) - elapsed) / self.speed
+            self.__source = GLib.timeout_add(max(int(wait * 1000), 1), self.__feed)
+        elif self.__on_done:
+            self.__on_done()
+        return False
+
+
+def duty_cycle(default=(10, 30)):
+    """Summary
+
+    Args:
+        default (tuple): (window, interval) if PENPI_SCAN is not set
+
+    Returns:
+        tuple: (window, interval) in seconds, None if scanning is off
+    """
+    value = os.environ.get('PENPI_SCAN')
+    if value is None:
+        return default
+    try:
+        window, _, interval = value.partition('/')
+        window = float(window)
+        interval = float(interval or window)
+    except ValueError:
+        logging.warning('scanner: bad PENPI_SCAN %r', value)
+        return default
+    return (window, interval) if window > 0 else None
+
+
+def read_snapshot(path=SNAPSHOT_PATH):
+    """Summary
+
+    Args:
+        path (Path): Table written by the daemon
+
+    Returns:
+        list: Devices as dicts, strongest signal first; empty if there is
+            no table or it is older than its ttl
+    """
+    try:
+        with open(str(path)) as handle:
+            snapshot = json.load(handle)
+    except (OSError, ValueError):
+        return []
+    now = time.time()
+    return [device for device in snapshot.get('devices', [])
+        if now - device['last_seen'] <= snapshot.get('ttl', 120)]
+
+
+def format_device(device, now=None):
+    """Summary
+
+    Args:
+        device (dict): Device as in the snapshot
+        now (float): time.time(), now if None
+
+    Returns:
+        str: Name, and below it address, RSSI and age
+    """
+    now = time.time() if now is None else now
+    rssi = '' if device['rssi'] is None else ' {}dBm'.format(device['rssi'])
+    return '{}\n {}{} {}s'.format(device['name'] or '?', device['address'], rssi,
+        int(now - device['last_seen']))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python3 -m penpi.scanner',
+        description='Print the devices the daemon sees, or replay a recording.')
+    parser.add_argument('--file', default=str(SNAPSHOT_PATH), help='table written by the daemon')
+    parser.add_argument('--replay', help='JSON lines recording to play back, printing changes')
+    parser.add_argument('--speed', type=float, default=1.0, help='playback speed of --replay')
+    args = parser.parse_args(argv)
+
+    if args.replay is None:
+        for device in read_snapshot(args.file):
+            print(format_device(device))
+        return 0
+
+    scanner = Scanner()
+    scanner.subscribe(lambda event, device: print(event, device))
+    mainloop = GLib.MainLoop()
+    ReplaySource.load(scanner, args.replay, speed=args.speed, on_done=mainloop.quit).start()
+    mainloop.run()
+    for device in scanner.devices():
+        print(format_device(device.to_dict()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
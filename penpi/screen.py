@@ -4,22 +4,36 @@
 Attributes:
     A_pin (int): Description
     B_pin (int): Description
+    backend (RPiGPIOBackend): Input backend selected by PENPI_GPIO
     bottom (TYPE): Description
     buttons (dict): Description
     C_pin (int): Description
-    commands (TYPE): Description
     D_pin (int): Description
     DC (int): Description
     disp (TYPE): Description
+    display (Display): Pushes only the changed regions to disp
     draw (TYPE): Description
+    awaiting (Button): Button whose release is waited for, input is dropped until then
+    BUILTINS (dict): Text of the "builtin" menu entries, by name
+    events (EventQueue): Button events, runner and menu wakeups, handled on the main loop
     font (TYPE): Description
+    glyphs (GlyphAtlas): Cached glyph bitmaps of font
     gpio_buttons (TYPE): Description
     height (TYPE): Description
     image (TYPE): Description
     L_pin (int): Description
     logo (TYPE): Description
+    menu (MenuWatcher): Compiled menu, reloaded when config.json changes
+    menu_path (list): Entry index within every submenu opened
+    output (CommandOutput): Command output shown instead of the menu
+    press_to_pixel (Histogram): Seconds from the edge of a press to the frame it changed
     padding (int): Description
     R_pin (int): Description
+    repeat (AutoRepeat): Repeat schedule of held direction buttons
+    repeat_source (int): Main loop timeout of the next auto-repeat
+    render_seconds (Histogram): Time spent in render()
+    results (ResultCache): Outputs of the menu entries with cache settings
+    rows (RowCache): Rendered menu rows
     RST (int): Description
     script_dir (TYPE): Description
     selection (int): Description
@@ -28,16 +42,13 @@ Attributes:
     SPI_PORT (int): Description
     top (TYPE): Description
     U_pin (int): Description
+    viewport (OutputViewport): Scroll view on the last command output
     width (TYPE): Description
     x (int): Description
 """
 
 import time
 
-import RPi.GPIO as GPIO
-import Adafruit_GPIO.SPI as SPI
-import Adafruit_SSD1306
-import json
 import os
 from pathlib import Path
 
@@ -45,12 +56,20 @@ from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
 
-import subprocess
 import logging
 
+from penpi import loop, metrics, profile, scanner, status
+from penpi.display import Display, SSD1306Device
+from penpi.text import GlyphAtlas, RowCache
+from penpi.viewport import OutputViewport
+from penpi.runner import CommandRunner
+from penpi.menutree import MenuWatcher
+from penpi.cache import ResultCache, age_label
+from penpi.input import Button, InputEvent, AutoRepeat, BACKENDS
+from penpi.loop import EventQueue
+
 script_dir = Path(os.path.dirname(os.path.realpath(__file__)))
 
-logo = Image.open('/opt/penpi/logo.ppm').convert('1')
 # Input pins:
 L_pin = 27 
 R_pin = 23 
@@ -61,15 +80,14 @@ D_pin = 22
 A_pin = 5 
 B_pin = 6 
 
-GPIO.setmode(GPIO.BCM) 
-
-GPIO.setup(A_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(L_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(R_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(B_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(U_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(D_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(C_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+# Input timing in seconds: the software debounce window, and the auto-repeat
+# of held direction buttons (first repeat, first interval, fastest interval
+# and the factor every repeat speeds up by).
+debounce = 0.02
+repeat_delay = 0.4
+repeat_interval = 0.1
+repeat_minimum = 0.02
+repeat_acceleration = 0.85
 
 # Raspberry Pi pin configuration:
 RST = 24
@@ -78,55 +96,154 @@ DC = 23
 SPI_PORT = 0
 SPI_DEVICE = 0
 
-# 128x64 display with hardware I2C:
-disp = Adafruit_SSD1306.SSD1306_128_64(rst=RST)
+# Hardware and resources are set up by setup(), importing this module has
+# no side effects.
+logo = None
+disp = None
+display = None
+width = None
+height = None
+image = None
+draw = None
+font = None
+glyphs = None
+rows = None
+viewport = None
+backend = None
+repeat = None
 
+# First define some constants to allow easy resizing of shapes.
+padding = -2
+top = padding
+bottom = None
+# Move left to right keeping track of the current x position for drawing shapes.
+x = 0
 
-# Initialize library.
-disp.begin()
 
-# Clear display.
-disp.clear()
-disp.display()
+def setup_display():
+    """Initialise the SSD1306 and everything drawing on it.
+    """
+    global logo, disp, display, width, height, image, draw, bottom
+    global font, glyphs, rows, viewport
 
-# Create blank image for drawing.
-# Make sure to create image with mode '1' for 1-bit color.
-width = disp.width
-height = disp.height
-image = Image.new('1', (width, height))
+    import Adafruit_SSD1306
 
-# Get drawing object to draw on image.
-draw = ImageDraw.Draw(image)
+    logo = Image.open('/opt/penpi/logo.ppm').convert('1')
 
+    # 128x64 display with hardware I2C:
+    disp = Adafruit_SSD1306.SSD1306_128_64(rst=RST)
 
-# Draw some shapes.
-# First define some constants to allow easy resizing of shapes.
-padding = -2
-top = padding
-bottom = height-padding
-# Move left to right keeping track of the current x position for drawing shapes.
-x = 0
+    # Initialize library.
+    disp.begin()
+
+    # Clear display.
+    disp.clear()
+    disp.display()
+
+    # Only changed regions get pushed from here on.
+    display = Display(SSD1306Device(disp))
+
+    # Create blank image for drawing.
+    # Make sure to create image with mode '1' for 1-bit color.
+    width = disp.width
+    height = disp.height
+    image = Image.new('1', (width, height))
+
+    # Get drawing object to draw on image.
+    draw = ImageDraw.Draw(image)
+    bottom = height-padding
+
+    # Load default font.
+    font = ImageFont.load_default()
+
+    # Glyphs are rasterized once, menu rows are cached until the menu changes.
+    glyphs = GlyphAtlas(font)
+    rows = RowCache(glyphs, width)
+
+    # Command output, rasterized a few lines at a time while scrolling.
+    viewport = OutputViewport(glyphs, width, height, spacing=-2)
 
 
-# Load default font.
-font = ImageFont.load_default()
+def setup_input():
+    """Start watching the buttons.
+    """
+    global backend
+    global repeat
+
+    # Input backend: rpi (RPi.GPIO), gpiod (GPIO character device) or fake
+    backend = BACKENDS[os.environ.get("PENPI_GPIO", "rpi")]()
+
+    for gpio in gpio_buttons:
+        butt = Button(gpio, events, backend, debounce)
 
+        butt.addOnPress(onPress)
+        butt.addOnRelease(onPress)
+        buttons[gpio] = butt
 
+    repeat = AutoRepeat([buttons[U_pin], buttons[D_pin], buttons[L_pin], buttons[R_pin]],
+        repeat_delay, repeat_interval, repeat_minimum, repeat_acceleration)
 
-commands = None
-with open(str(script_dir / "config.json")) as handle:
-    commands = json.loads(handle.read())
 
+def setup():
+    """Set up display, input and menu, once. Screen.run() calls this.
+    """
+    if disp is not None:
+        return
+
+    with profile.section('setup display'):
+        setup_display()
+    with profile.section('setup input'):
+        setup_input()
+    with profile.section('setup menu'):
+        setup_menu()
+
+
+config_path = script_dir / "config.json"
+menu_cache_path = script_dir / ".config.json.cache"
+menu = None
+
+def setup_menu():
+    """Load the compiled menu and start following config.json.
+
+    Reloads are put on events, the screen redraws when the main loop takes them.
+    """
+    global menu
 
+    menu = MenuWatcher(config_path, menu_cache_path, on_change=events.put)
+    menu.start()
+
+
+# Outputs of the entries with cache settings
+results = ResultCache()
+
+# Entry index within every submenu opened, and the selection in the last one
+menu_path = []
 selection_offset = 0
 selection = 0
 
+def current_menu():
+    """Summary
+
+    Returns:
+        tuple: (MenuTree, menu node shown), the path is cut back to what
+            the tree still has
+    """
+    tree = menu.tree
+    node, depth = tree.walk(menu_path)
+    del menu_path[depth:]
+    return tree, node
+
 def render():
     """Summary
     """
     global selection_offset
     global selection
 
+    started = time.perf_counter()
+    tree, node = current_menu()
+    size = tree.size(node)
+    selection = min(selection, max(size - 1, 0))
+
     cur_index = selection
 
     draw.rectangle((0,0,width,height), outline=0, fill=0)
@@ -140,304 +257,371 @@ def render():
     for i in range(0,6):
         cmd_index = selection_offset+i
 
-        if cmd_index >= len(commands):
+        if cmd_index >= size:
             break
 
-        cmd_title = commands[cmd_index]["name"]
+        entry = tree.child(node, cmd_index)
+        cmd_title = tree.names[entry]
+        if tree.is_menu(entry):
+            cmd_title += " >"
 
+        row = rows.get("{}. {}".format(cmd_index+1,cmd_title), False)
         if cmd_index == cur_index:
-            draw.rectangle((0,y,256,y+10), outline=0, fill=255)
-            draw.text((0, y), "{}. {}".format(cmd_index+1,cmd_title),  font=font, fill=0)
+            # A full 10 px bar, dark glyphs cut out of it.
+            draw.rectangle((0,y,width,y+10), outline=0, fill=255)
+            image.paste(0, (0, y, row.size[0], y + row.size[1]), row)
         else:
-            draw.text((0, y), "{}. {}".format(cmd_index+1,cmd_title),  font=font, fill=255)
+            image.paste(row, (0, y), row)
         y += 10
-    
-
-        pos = selection_offset + i
-
-    disp.image(image)
-    disp.display()
 
+    display.push(image)
+    render_seconds.observe(time.perf_counter() - started)
 
 
 
-class Button():
 
+def onPress(button, state):
     """Summary
     
-    Attributes:
-        callbacks (list): Description
-        DOWN (TYPE): Description
-        UP (TYPE): Description
+    Args:
+        button (TYPE): Description
+        state (TYPE): Description
     """
-    
-    DOWN = GPIO.LOW
-    UP = GPIO.HIGH
+    global selection
+    global selection_offset
 
-    def __init__(self, gpio):
-        """Summary
-        
-        Args:
-            gpio (TYPE): Description
-        """
-        GPIO.add_event_detect(gpio, GPIO.BOTH, callback=lambda b: Button.edge_detected(self), bouncetime=200)
+    logging.debug('%s %s', button, state)
 
-        self.__gpio = gpio
-        self.callbacks = []
+    tree, node = current_menu()
+    size = tree.size(node)
 
-        self.__state = Button.UP
-        self.__pressed = False
-        self.__released = False
-        self.__edge = False
+    if state == Button.DOWN:
+        if button.gpio == D_pin:
+            selection += 1
+        elif button.gpio == U_pin:
+            selection -= 1
+        elif button.gpio == A_pin and size:
+            entry = tree.child(node, selection)
+            if tree.is_menu(entry):
+                menu_path.append(selection)
+                selection = 0
+                selection_offset = 0
+            else:
+                executeCommand(tree.commands[entry], tree.cache[entry])
+                if output is not None:
+                    return
+        elif button.gpio == B_pin and menu_path:
+            selection = menu_path.pop()
+        elif button.gpio == C_pin:
+            results.invalidate()
+
+    selection = selection % size if size else 0
 
-    def update(self):
-        """Summary
-        """
-        self.check_edge()
+    render()      
 
+# Buttons, created by setup_input(); their edges end up in events
+gpio_buttons = [A_pin,L_pin,R_pin,B_pin,U_pin,D_pin,C_pin]
 
-        if self.__pressed or self.__released:
-            # State changed
+events = EventQueue()
+buttons = {}
 
-            for cb_state, cb_func in self.callbacks:
-                if cb_state == self.__state:
-                    cb_func(self, self.__state)
+render_seconds = metrics.histogram('penpi_render_seconds', 'Time spent rendering the menu')
+press_to_pixel = metrics.histogram('penpi_press_to_pixel_seconds',
+    'Time from a button press to the frame showing its effect')
+metrics.gauge('penpi_event_queue_depth', 'Events waiting for the main loop', function=events.qsize)
 
-            self.clear()
+# Command output shown instead of the menu, None while the menu is shown
+output = None
 
+# Button whose release is waited for, input is dropped until it comes
+awaiting = None
 
-    def addOnPress(self, func):
-        """Summary
-        
-        Args:
-            func (TYPE): Description
-        """
-        self.callbacks.append((Button.DOWN, func))
+# Timeout source of the next auto-repeat
+repeat_source = None
 
-    def addOnRelease(self, func):
-        """Summary
-        
-        Args:
-            func (TYPE): Description
-        """
-        self.callbacks.append((Button.UP, func))
-    
-    def clear(self):
-        """Summary
-        """
-        self.__state = Button.UP
-        self.__pressed = False
-        self.__released = False
 
-    def check_edge(self):
-        """Summary
-        """
-        pass
+class CommandOutput():
 
-    def edge_detected(self):
-        """Summary
-        """
-        self.__state = Button.DOWN if self.__state else Button.UP
+    """Output of a menu command in the viewport, until A closes it.
 
-        if self.__state == Button.UP:
-            self.__released = True
-        else:
-            self.__pressed = True
+    Output streams in while the command runs, B cancels it.  A cached
+    result is shown right away while it is fresh, or while a background
+    run refreshes it.
 
-            
+    Attributes:
+        cmd (list, str or dict): Command of the menu entry, a dict for builtins
+        cache (dict): Result cache settings of the entry, None if uncached
+        runner (CommandRunner): Run whose output is shown, None for a cached result
+        cached (CachedResult): Cached result shown, None while running
+    """
 
-    @property
-    def pressed(self):
-        """Summary
-        
-        Returns:
-            TYPE: Description
-        """
-        self.check_edge()
-        return self.__pressed
-    
-    @property
-    def released(self):
+    move_step = 8
+
+    def __init__(self, cmd, cache=None):
         """Summary
-        
-        Returns:
-            TYPE: Description
+
+        Args:
+            cmd (list, str or dict): Command of the menu entry, a dict for builtins
+            cache (dict): Result cache settings of the entry, None if uncached
         """
-        self.check_edge()
-        return self.__released
-    
-    @property
-    def down(self):
+        self.cmd = cmd
+        self.cache = cache
+        self.runner = None
+        self.cached = results.get(cmd) if cache else None
+
+        self.__render = False
+        self.__shown = False
+        self.__output_pending = False
+
+        cached = self.cached
+        if isinstance(cmd, dict):
+            # Text the daemon has at hand, nothing to run.
+            builtin = BUILTINS.get(cmd["builtin"])
+            viewport.set_text(builtin() if builtin else "Unknown builtin: " + cmd["builtin"])
+        elif cached is not None and (cache["refresh"] or time.monotonic() - cached.time < cache["ttl"]):
+            if time.monotonic() - cached.time >= cache["ttl"]:
+                results.refresh(cmd, cache["max_size"], on_done=events.put)
+            viewport.set_text(cachedText(cmd, cached))
+        else:
+            self.cached = None
+            draw.rectangle((0,0,width,height), outline=0, fill=0)
+            draw.text((32, 22), "Executing...",  font=font, fill=255)
+            display.push(image)
+
+            # Output is read on the main loop, new output wakes the screen
+            # up through the event queue, once per batch.
+            self.runner = CommandRunner(cmd, on_output=self.__on_output,
+                on_exit=self.__on_exit, main_loop=True)
+            self.runner.start()
+            status.job_started()
+            viewport.set_lines(self.runner.lines)
+
+        self.directions = {
+            D_pin: (0, self.move_step),
+            U_pin: (0, -self.move_step),
+            L_pin: (-self.move_step, 0),
+            R_pin: (self.move_step, 0),
+        }
+        self.show()
+
+    def __on_output(self, runner):
+        if not self.__output_pending:
+            self.__output_pending = True
+            events.put(runner)
+
+    def __on_exit(self, runner):
+        status.job_finished(runner.process.returncode, runner.cancelled)
+        if self.cache:
+            results.store(self.cmd, runner, self.cache["max_size"])
+
+    def handle(self, event):
         """Summary
-        
-        Returns:
-            TYPE: Description
-        """
-        self.check_edge()
-        return GPIO.input(self.__gpio) == GPIO.LOW
 
-    @property
-    def up(self):
-        """Summary
-        
-        Returns:
-            TYPE: Description
-        """
-        self.check_edge()
-        return GPIO.input(self.__gpio) == GPIO.HIGH
+        Args:
+            event (object): Event from the queue, or a repeat
 
-    @property
-    def gpio(self):
-        """Summary
-        
         Returns:
-            TYPE: Description
+            bool: False once A closed the output
         """
-        self.check_edge()
-        return self.__gpio
-
-    def __repr__(self):
+        if self.runner is not None and event is self.runner:
+            self.__output_pending = False
+            self.__render |= viewport.refresh()
+        elif self.cached is not None and event is results:
+            # A background refresh finished, show its output instead.
+            latest = results.get(self.cmd)
+            if latest is not None and latest.time > self.cached.time:
+                self.cached = latest
+            x, y = viewport.x, viewport.y
+            viewport.set_text(cachedText(self.cmd, self.cached))
+            viewport.scroll(x, y)
+            self.__render = True
+        elif isinstance(event, InputEvent) and event.state == Button.DOWN:
+            if event.button.gpio == A_pin:
+                self.close()
+                return False
+            elif event.button.gpio == B_pin and self.runner is not None:
+                self.runner.cancel()
+            elif event.button.gpio in self.directions:
+                self.__render |= viewport.scroll(*self.directions[event.button.gpio])
+
+        self.show()
+        return True
+
+    def show(self):
+        """Push the viewport, keeping "Executing..." up until there is something to show.
+        """
+        runner = self.runner
+        if (self.__render or not self.__shown) and (runner is None or viewport.line_count or not runner.running):
+            self.__render = False
+            self.__shown = True
+            viewport.draw(image)
+            display.push(image)
+
+    def close(self):
         """Summary
-        
-        Returns:
-            TYPE: Description
         """
-        return "<Button {}>".format(self.__gpio)
+        if self.runner is not None:
+            self.runner.cancel()
 
-def onPress(button, state):
+
+def devicesText():
     """Summary
-    
-    Args:
-        button (TYPE): Description
-        state (TYPE): Description
+
+    Returns:
+        str: Nearby devices as the background scanner last saw them
     """
-    global selection
+    devices = scanner.read_snapshot()
+    if not devices:
+        return "No devices seen"
+    return "\n".join(scanner.format_device(device) for device in devices)
 
-    print(button,state)
 
-    if state == Button.DOWN:
-        if button.gpio == D_pin:
-            selection += 1
-        elif button.gpio == U_pin:
-            selection -= 1
-        elif button.gpio == A_pin:
-            executeCommand()
+# Menu entries with "builtin" show the text of these, see penpi.menutree
+BUILTINS = {
+    "devices": devicesText,
+}
 
-    selection %= len(commands)
 
-    render()      
+def executeCommand(cmd, cache=None):
+    """Show the output of a command until A closes it.
 
-# Create buttons
-gpio_buttons = [A_pin,L_pin,R_pin,B_pin,U_pin,D_pin,C_pin]
+    Args:
+        cmd (list, str or dict): Command of the selected menu entry
+        cache (dict): Result cache settings of the entry, None if uncached
+    """
+    global output
 
-buttons = {}
+    if not cmd:
+        return
 
-for gpio in gpio_buttons:
-    butt = Button(gpio)
+    repeat.reset()
+    output = CommandOutput(cmd, cache)
 
-    butt.addOnPress(onPress)
-    butt.addOnRelease(onPress)
-    buttons[gpio] = butt
 
+def cachedText(cmd, cached):
+    """Summary
 
+    Args:
+        cmd (list or str): Command the output is from
+        cached (CachedResult): Output to show
 
-def executeCommand():
-    """Summary
-    
     Returns:
-        TYPE: Description
+        str: The output below a line saying how old it is
     """
-    cmd = commands[selection]["command"]
-    if not cmd:
-        return
-    
-    if isinstance(cmd, str):
-        cmd = ["sh","-c", cmd]
+    age = age_label(time.monotonic() - cached.time)
+    if results.refreshing(cmd):
+        return "[{} old, refreshing]\n{}".format(age, cached.text)
+    return "[{} old]\n{}".format(age, cached.text)
 
-    draw.rectangle((0,0,width,height), outline=0, fill=0)
-    draw.text((32, 22), "Executing...",  font=font, fill=255)
-    disp.image(image)
-    disp.display()
 
-    try:
-        output = subprocess.check_output(cmd, universal_newlines=True, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        print("ERROR:", e.output)
-        output = e.output
+def handleInput(event):
+    """Pass a press, release or repeat to the output shown or the menu.
 
-    print(output)
+    Args:
+        event (InputEvent): The event
+    """
+    global output
+    global awaiting
 
-    
-    buttons[A_pin].clear()
-    buttons[D_pin].clear()
-    buttons[U_pin].clear()
-    buttons[L_pin].clear()
-    buttons[R_pin].clear()
-    
-    render_output = True
-    output_pos = (0,0)
-    move_step = 8
-    while True:
-        if buttons[A_pin].pressed:
-            buttons[A_pin].clear()
-            break
+    if output is None:
+        event.button.dispatch(event.state)
+    elif not output.handle(event):
+        # Back to the menu once A is released.
+        output = None
+        awaiting = buttons[A_pin]
+        repeat.reset()
 
-        if buttons[D_pin].down:
-            render_output = True
-            output_pos = (output_pos[0],output_pos[1]-move_step)
-        elif buttons[U_pin].down:
-            render_output = True
-            output_pos = (output_pos[0],output_pos[1]+move_step)
-    
 
-        if buttons[L_pin].down:
-            render_output = True
-            output_pos = (output_pos[0]+move_step,output_pos[1])
-        elif buttons[R_pin].down:
-            render_output = True
-            output_pos = (output_pos[0]-move_step,output_pos[1])
+def onEvent(event):
+    """Handle an event taken off the queue, on the main loop.
+
+    Args:
+        event (object): InputEvent, the menu watcher, a runner or the result cache
+    """
+    global awaiting
+
+    repeat.update(event)
+
+    if event is menu:
+        rows.clear()
+        results.invalidate()
+        if output is None:
+            render()
+    elif isinstance(event, InputEvent):
+        if awaiting is None:
+            frames = display.frames
+            handleInput(event)
+            # Old kernels stamp gpiod edges with the wall clock, those are skipped.
+            latency = time.monotonic() - event.time
+            if event.state == Button.DOWN and display.frames != frames and 0 <= latency < 60:
+                press_to_pixel.observe(latency)
+        elif event.button is awaiting and event.state == Button.UP:
+            awaiting = None
+            repeat.reset()
+            render()
+    elif output is not None:
+        output.handle(event)
+
+    scheduleRepeat()
+
+
+def scheduleRepeat():
+    """Wake up when the next held direction button is due to repeat.
+    """
+    global repeat_source
+
+    if repeat_source is not None:
+        loop.source_remove(repeat_source)
+        repeat_source = None
+
+    timeout = repeat.timeout()
+    if timeout is not None:
+        repeat_source = loop.timeout_add(timeout, onRepeat)
+
+
+def onRepeat():
+    """Summary
+
+    Returns:
+        bool: False, scheduleRepeat() adds the next timeout
+    """
+    global repeat_source
+
+    repeat_source = None
+    for repeated in repeat.due():
+        if awaiting is None:
+            handleInput(repeated)
+    scheduleRepeat()
+    return False
 
 
-        if render_output:
-            draw.rectangle((0,0,width,height), outline=0, fill=0)
-            draw.multiline_text(output_pos, output,  font=font, fill=255, spacing=-2)
-            disp.image(image)
-            disp.display()
-        
-        time.sleep(0.1)
-
-    while not buttons[A_pin].released:
-        time.sleep(0.1)
-
-    buttons[A_pin].clear()
-    buttons[D_pin].clear()
-    buttons[U_pin].clear()
-    buttons[L_pin].clear()
-    buttons[R_pin].clear()
 class Screen():
-    def run():
-        """Summary
-        """
-        try:
-            disp.image(logo)
-            disp.display()
+    def start():
+        """Show the logo, the menu follows once A was pressed and released.
 
+        Events are handled on the main loop from then on.
+        """
+        global awaiting
 
-            while not buttons[A_pin].released:
-                time.sleep(0.1)
-                
-            refreshed = False
-            start_time = time.time()
-            while 1:
-                if not refreshed:
-                    refreshed = True
-                    render()
+        setup()
 
-                for b_gpio, b in buttons.items():
-                    b.update()
+        display.push(logo)
+        profile.mark('logo')
 
+        awaiting = buttons[A_pin]
+        events.attach(onEvent)
 
-                time.sleep(.005) 
+    def stop():
+        """Summary
+        """
+        if backend is not None:
+            backend.cleanup()
 
+    def run():
+        """Summary
+        """
+        try:
+            Screen.start()
+            loop.run()
         except KeyboardInterrupt: 
-            GPIO.cleanup()
+            Screen.stop()
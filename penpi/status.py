@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""Device status broadcast in the LE advertisement.
+
+Scanners learn whether the last job finished and where to reach the
+device without connecting.  The status travels as manufacturer data under
+``COMPANY_ID``, 6 bytes so it fits next to the flags and the 128 bit
+service UUID in the 31 bytes of advertising data::
+
+    version << 4 | job state (uint8) | exit status (uint8) | IPv4 address (4 bytes)
+
+``VERSION`` changes whenever the layout does; scanners skip versions they
+do not know.  The job state is one of ``IDLE``, ``RUNNING``, ``DONE``,
+``FAILED`` and ``CANCELLED``, the exit status is that of the last job as
+the shell reports it (0 to 255, signals as 128 + number).
+
+The status is kept in module globals, updated by whoever runs jobs.
+``Broadcaster`` passes it to the advertisement whenever it changed, at
+most once every ``min_interval`` seconds so BlueZ is not flooded.
+
+Attributes:
+    COMPANY_ID (int): Manufacturer id of the data, 0xffff is for testing
+    VERSION (int): Layout of the payload
+    state (int): Job state
+    exit_status (int): Exit status of the last job
+"""
+
+import socket
+import struct
+import time
+
+# Only publishing needs the main loop, encoding the payload does not.
+try:
+  from gi.repository import GLib
+except ImportError:
+  try:
+    import glib as GLib
+  except ImportError:
+    GLib = None
+
+
+COMPANY_ID = 0xffff
+VERSION = 1
+
+IDLE = 0
+RUNNING = 1
+DONE = 2
+FAILED = 3
+CANCELLED = 4
+
+PAYLOAD = struct.Struct('<BB4s')
+
+state = IDLE
+exit_status = 0
+
+_listeners = []
+
+
+def subscribe(callback):
+    """Summary
+
+    Args:
+        callback (callable): Called without arguments whenever the job state changes
+    """
+    _listeners.append(callback)
+
+
+def _changed():
+    for callback in _listeners:
+        callback()
+
+
+def job_started():
+    """Summary
+    """
+    global state
+
+    state = RUNNING
+    _changed()
+
+
+def job_finished(returncode, cancelled=False):
+    """Summary
+
+    Args:
+        returncode (int): Exit status as Popen reports it, negative for signals
+        cancelled (bool): Whether the job was cancelled
+    """
+    global state
+    global exit_status
+
+    exit_status = 128 - returncode if returncode < 0 else returncode & 0xff
+    if cancelled:
+        state = CANCELLED
+    else:
+        state = DONE if returncode == 0 else FAILED
+    _changed()
+
+
+def ipv4():
+    """Summary
+
+    Returns:
+        bytes: Address of the interface the default route uses, 0.0.0.0 if
+            there is none
+    """
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # Connecting a UDP socket only picks the route, nothing is sent.
+        probe.connect(('10.255.255.255', 1))
+        return socket.inet_aton(probe.getsockname()[0])
+    except OSError:
+        return bytes(4)
+    finally:
+        probe.close()
+
+
+def payload(address=None):
+    """Summary
+
+    Args:
+        address (bytes): IPv4 address, looked up if None
+
+    Returns:
+        bytes: Manufacturer data of the current status
+    """
+    return PAYLOAD.pack(VERSION << 4 | state, exit_status, address if address is not None else ipv4())
+
+
+class Broadcaster():
+
+    """Passes the status on whenever it changed, rate limited.
+
+    Job state changes are picked up as they happen, the address is checked
+    every ``poll`` seconds.
+
+    Attributes:
+        publish (callable): Called with the payload, on the main loop
+        min_interval (float): Least seconds between two publishes
+        poll (int): Seconds between address checks
+        current (bytes): Payload last published
+    """
+
+    def __init__(self, publish, min_interval=5.0, poll=30):
+        """Summary
+
+        Args:
+            publish (callable): Called with the payload, on the main loop
+            min_interval (float): Least seconds between two publishes
+            poll (int): Seconds between address checks
+        """
+        self.publish = publish
+        self.min_interval = min_interval
+        self.poll = poll
+        self.current = None
+
+        self.__address = ipv4()
+        self.__published = None
+        self.__pending = None
+        self.__poll_source = None
+
+    def start(self):
+        """Publish the status and follow its changes, from the main loop.
+        """
+        subscribe(self.update)
+        self.__poll_source = GLib.timeout_add_seconds(self.poll, self.__check_address)
+        self.update()
+
+    def stop(self):
+        """Summary
+        """
+        _listeners.remove(self.update)
+        for source in (self.__poll_source, self.__pending):
+            if source is not None:
+                GLib.source_remove(source)
+        self.__poll_source = self.__pending = None
+
+    def update(self):
+        """Publish the status if it changed, now or once min_interval passed.
+        """
+        if self.__pending is not None:
+            return
+        wait = 0
+        if self.__published is not None:
+            wait = self.__published + self.min_interval - time.monotonic()
+        if wait > 0:
+            # Whatever changes until then goes out in one publish.
+            self.__pending = GLib.timeout_add(int(wait * 1000) + 1, self.__flush)
+        else:
+            self.__flush()
+
+    def __flush(self):
+        self.__pending = None
+        data = payload(self.__address)
+        if data != self.current:
+            self.current = data
+            self.__published = time.monotonic()
+            self.publish(data)
+        return False
+
+    def __check_address(self):
+        address = ipv4()
+        if address != self.__address:
+            self.__address = address
+            self.update()
+        return True
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""Cached glyph text rendering for the 1-bit display.
+
+``ImageDraw.text`` rasterizes every character through the font on every
+call.  ``GlyphAtlas`` rasterizes each glyph once, in a normal and an
+inverted style, and composes strings by pasting the cached bitmaps.
+``RowCache`` keeps complete menu rows so an unchanged row costs a single
+paste.
+
+Attributes:
+    ATLAS_CHARS (str): Characters rasterized up front into the atlas
+"""
+
+from PIL import Image
+from PIL import ImageChops
+from PIL import ImageDraw
+from PIL import ImageFont
+
+
+ATLAS_CHARS = ''.join(chr(c) for c in range(32, 127))
+
+
+# Measured in mode '1', the way ImageDraw measures and draws on the 1-bit
+# display; FreeType hints antialiased text to different advances.
+def _text_size(font, text):
+    if hasattr(font, 'getbbox'):
+        box = font.getbbox(text, mode='1')
+        return box[2], box[3]
+    return font.getsize(text)
+
+
+def _text_advance(font, text):
+    if hasattr(font, 'getlength'):
+        return font.getlength(text, mode='1')
+    return font.getsize(text)[0]
+
+
+class GlyphAtlas():
+
+    """Glyph bitmaps of one font, rasterized once and reused.
+
+    Printable ASCII is drawn into a single atlas image when the atlas is
+    created, anything else is rasterized the first time it is used.  Bitmap
+    glyphs may overhang their advance, so every glyph is cut out together
+    with its overhang.  Bitmap fonts compose glyphs by overwriting whole
+    cells, and blit() does the same, so rows come out as ImageDraw.text
+    draws them.
+
+    FreeType fonts (what ImageFont.load_default() returns from Pillow 10.1
+    on) place glyphs at fractional positions with kerning, which pasting
+    whole-pixel cells cannot reproduce; blit() draws them with
+    ImageDraw.text, and the atlas only serves their advances.  RowCache
+    still keeps their rows.
+
+    Attributes:
+        font (ImageFont): Font the glyphs are taken from
+        height (int): Height of a glyph cell in pixels
+        ascent (int): Height of a capital letter, used for line spacing
+        atlas (PIL.Image): Mode '1' image holding the ASCII glyphs side by
+            side, None for FreeType fonts
+    """
+
+    PAD = 2
+
+    def __init__(self, font):
+        """Summary
+
+        Args:
+            font (ImageFont): Font to rasterize, usually ImageFont.load_default()
+        """
+        self.font = font
+        self.ascent = _text_size(font, 'A')[1]
+        self.height = max([_text_size(font, c)[1] for c in ATLAS_CHARS] + [self.ascent])
+
+        self.__masked = not isinstance(font, ImageFont.ImageFont)
+        self.__space = _text_advance(font, ' ')
+        self.__glyphs = {}
+
+        self.atlas = None
+        if self.__masked:
+            return
+
+        cells = [self.__cell_width(c) for c in ATLAS_CHARS]
+        self.atlas = Image.new('1', (sum(cells), self.height))
+        draw = ImageDraw.Draw(self.atlas)
+
+        x = 0
+        for char, cell in zip(ATLAS_CHARS, cells):
+            draw.text((x + self.PAD - self.__space, 0), ' ' + char, font=font, fill=255)
+            self.__add(char, self.atlas.crop((x, 0, x + cell, self.height)))
+            x += cell
+
+    def __cell_width(self, char):
+        return int(max(_text_advance(self.font, char), _text_size(self.font, char)[0])) + 2 * self.PAD + 1
+
+    def __add(self, char, cell):
+        # Trim the padded cell to the advance plus whatever the glyph lights
+        # outside of it.  The leading space the glyph was drawn after keeps
+        # the part left of the origin, which fonts clip for a first character.
+        advance = _text_advance(self.font, char)
+        left, right = self.PAD, self.PAD + int(round(advance))
+        box = cell.getbbox()
+        if box:
+            left = min(left, box[0])
+            right = max(right, box[2])
+        bitmap = cell.crop((left, 0, right, self.height))
+        self.__glyphs[char] = (bitmap, ImageChops.invert(bitmap), left - self.PAD, advance)
+
+    def glyph(self, char):
+        """Summary
+
+        Args:
+            char (str): Single character
+
+        Returns:
+            tuple: (bitmap, inverted bitmap, x offset from the origin, advance)
+        """
+        try:
+            return self.__glyphs[char]
+        except KeyError:
+            cell = Image.new('1', (self.__cell_width(char), self.height))
+            ImageDraw.Draw(cell).text((self.PAD - self.__space, 0), ' ' + char, font=self.font, fill=255)
+            self.__add(char, cell)
+            return self.__glyphs[char]
+
+    def width(self, text):
+        """Summary
+
+        Args:
+            text (str): Single line of text
+
+        Returns:
+            int: Width of text in pixels
+        """
+        if self.__masked:
+            return int(round(_text_advance(self.font, text)))
+        return int(round(sum(self.glyph(c)[3] for c in text)))
+
+    def blit(self, target, xy, text, inverted=False):
+        """Draw text onto target from the cached glyphs.
+
+        With bitmap fonts the glyph cells overwrite what is below them, so
+        draw onto a cleared line and paste that with a mask to overlay.
+
+        Args:
+            target (PIL.Image): Mode '1' image to draw into
+            xy (tuple): Origin of the first glyph, like ImageDraw.text
+            text (str): Single line of text
+            inverted (bool): Dark glyphs on a lit background
+        """
+        pen, y = xy
+        if self.__masked:
+            ImageDraw.Draw(target).text((pen, y), text, font=self.font, fill=0 if inverted else 255)
+            return
+
+        limit = target.size[0]
+        for char in text:
+            x = int(round(pen))
+            if x - self.PAD >= limit:
+                break
+            bitmap, inverse, offset, advance = self.glyph(char)
+            target.paste(inverse if inverted else bitmap, (x + offset, y))
+            pen += advance
+
+    def render(self, text, width=None, inverted=False):
+        """Rasterize a single line of text into a new image.
+
+        Args:
+            text (str): Single line of text
+            width (int): Image width, defaults to the width of the text
+            inverted (bool): Dark glyphs on a lit background
+
+        Returns:
+            PIL.Image: Mode '1' image, one glyph cell high
+        """
+        if width is None:
+            width = self.width(text)
+        image = Image.new('1', (max(width, 1), self.height), 255 if inverted else 0)
+        self.blit(image, (0, 0), text, inverted)
+        return image
+
+    def line_pitch(self, spacing=4):
+        """Distance between lines, the way ImageDraw.multiline_text spaces them.
+
+        Args:
+            spacing (int): Extra pixels between lines
+
+        Returns:
+            int: Pixels from one line to the next
+        """
+        return self.ascent + spacing
+
+    def render_lines(self, lines, spacing=4):
+        """Rasterize several lines into one image.
+
+        Args:
+            lines (list): Lines of text, without newlines
+            spacing (int): Extra pixels between lines
+
+        Returns:
+            PIL.Image: Mode '1' image fitting all lines
+        """
+        pitch = self.line_pitch(spacing)
+        width = max([self.width(line) for line in lines] + [1])
+        height = max(pitch * (len(lines) - 1) + self.height, 1)
+        image = Image.new('1', (width, height))
+        for i, line in enumerate(lines):
+            row = self.render(line)
+            image.paste(row, (0, i * pitch), row)
+        return image
+
+
+class RowCache():
+
+    """Rendered menu rows keyed by their label and selection state.
+
+    Attributes:
+        glyphs (GlyphAtlas): Atlas the rows are composed from
+        width (int): Row width in pixels
+    """
+
+    def __init__(self, glyphs, width):
+        """Summary
+
+        Args:
+            glyphs (GlyphAtlas): Atlas the rows are composed from
+            width (int): Row width in pixels
+        """
+        self.glyphs = glyphs
+        self.width = width
+        self.__rows = {}
+
+    def get(self, label, selected):
+        """Summary
+
+        Args:
+            label (str): Row text
+            selected (bool): Render the row highlighted
+
+        Returns:
+            PIL.Image: Mode '1' row image
+        """
+        key = (label, selected)
+        try:
+            return self.__rows[key]
+        except KeyError:
+            row = self.glyphs.render(label, self.width, inverted=selected)
+            self.__rows[key] = row
+            return row
+
+    def clear(self):
+        """Drop all cached rows, e.g. after the menu changed.
+        """
+        self.__rows.clear()
+
+    def __len__(self):
+        return len(self.__rows)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""Scrollable view on command output that only rasterizes what is visible.
+
+Static output is split into lines once, as an index of line start offsets
+into the original string (``TextLines``); streamed output comes from a
+``penpi.runner.LineBuffer``.  Lines are rasterized in horizontal strips of
+``STRIP_WIDTH`` pixels the first time a strip becomes visible and kept in a
+small LRU cache, so scrolling is a handful of pastes no matter how long the
+output is.
+
+Attributes:
+    STRIP_WIDTH (int): Width of one cached line strip in pixels
+"""
+
+from array import array
+from collections import OrderedDict
+
+from PIL import Image
+
+
+STRIP_WIDTH = 64
+
+
+class TextLines():
+
+    """Lines of a string, found through an index of line start offsets.
+    """
+
+    def __init__(self, text):
+        """Summary
+
+        Args:
+            text (str): Lines separated by newlines
+        """
+        self.__text = text
+        self.__offsets = array('L', [0])
+        start = text.find('\n')
+        while start != -1:
+            self.__offsets.append(start + 1)
+            start = text.find('\n', start + 1)
+        self.__offsets.append(len(text) + 1)
+
+    def __len__(self):
+        return len(self.__offsets) - 1
+
+    def span(self):
+        """Summary
+
+        Returns:
+            tuple: (0, number of lines), like LineBuffer.span()
+        """
+        return 0, len(self)
+
+    def line(self, number):
+        """Summary
+
+        Args:
+            number (int): Line number, starting at 0
+
+        Returns:
+            str: Line without its newline
+        """
+        return self.__text[self.__offsets[number]:self.__offsets[number+1]-1]
+
+
+class OutputViewport():
+
+    """Window of width x height pixels onto a block of text.
+
+    Attributes:
+        glyphs (GlyphAtlas): Atlas the lines are composed from
+        width (int): Viewport width in pixels
+        height (int): Viewport height in pixels
+        pitch (int): Pixels from one line to the next
+        margin (int): Lines above and below the viewport kept rasterized
+        x (int): Horizontal scroll position in pixels
+        y (int): Vertical scroll position in pixels
+        follow (bool): Keep the last line in view as lines are added
+    """
+
+    def __init__(self, glyphs, width, height, spacing=-2, margin=4):
+        """Summary
+
+        Args:
+            glyphs (GlyphAtlas): Atlas the lines are composed from
+            width (int): Viewport width in pixels
+            height (int): Viewport height in pixels
+            spacing (int): Extra pixels between lines, as for multiline_text
+            margin (int): Lines above and below the viewport kept rasterized
+        """
+        self.glyphs = glyphs
+        self.width = width
+        self.height = height
+        self.pitch = glyphs.line_pitch(spacing)
+        self.margin = margin
+
+        visible_lines = height // self.pitch + 2
+        visible_strips = width // STRIP_WIDTH + 2
+        self.__capacity = (visible_lines + 2 * margin) * visible_strips * 2
+
+        self.set_text('')
+
+    def set_text(self, text):
+        """Show text, scrolled to the top left corner.
+
+        Args:
+            text (str): Text to show, lines separated by newlines
+        """
+        self.set_lines(TextLines(text))
+        self.follow = False
+
+    def set_lines(self, lines):
+        """Show a growing set of lines, following the last one.
+
+        Args:
+            lines (LineBuffer): Source with span() and line(number)
+        """
+        self.__lines = lines
+        self.__start, self.__count = lines.span()
+        self.__strips = OrderedDict()
+        self.x = 0
+        self.y = 0
+        self.follow = True
+        self.y = self.__bottom()
+
+    def refresh(self):
+        """Pick up lines added to or dropped from the source since the last call.
+
+        Returns:
+            bool: Whether the lines changed and the viewport needs a redraw
+        """
+        start, count = self.__lines.span()
+        if (start, count) == (self.__start, self.__count):
+            return False
+
+        # Keep showing the same lines while old ones drop out of the ring.
+        self.y = max(self.y - (start - self.__start) * self.pitch, 0)
+        self.__start, self.__count = start, count
+        if self.follow:
+            self.y = self.__bottom()
+        return True
+
+    @property
+    def line_count(self):
+        """Summary
+
+        Returns:
+            int: Number of lines shown
+        """
+        return self.__count
+
+    def line(self, index):
+        """Summary
+
+        Args:
+            index (int): Line number within the viewport, starting at 0
+
+        Returns:
+            str: Line without its newline
+        """
+        return self.__lines.line(self.__start + index)
+
+    def __bottom(self):
+        return max(self.__count * self.pitch - self.height, 0)
+
+    def scroll(self, dx, dy):
+        """Move the viewport, clamped to the top, left and bottom of the text.
+
+        Scrolling to the bottom turns following the last line on, scrolling
+        up turns it off.
+
+        Args:
+            dx (int): Pixels to move right
+            dy (int): Pixels to move down
+
+        Returns:
+            bool: Whether the position changed
+        """
+        bottom = self.__bottom()
+        x = max(self.x + dx, 0)
+        y = min(max(self.y + dy, 0), bottom)
+        moved = (x, y) != (self.x, self.y)
+        self.x, self.y = x, y
+        if dy:
+            self.follow = y == bottom
+        return moved
+
+    def __strip(self, index, strip):
+        key = (self.__start + index, strip)
+        try:
+            self.__strips.move_to_end(key)
+            return self.__strips[key]
+        except KeyError:
+            pass
+
+        # Skip the characters that end left of the strip, then draw the rest
+        # shifted left so the strip starts at pixel strip * STRIP_WIDTH.
+        left = strip * STRIP_WIDTH
+        line = self.line(index)
+        pen = 0
+        start = 0
+        for char in line:
+            advance = self.glyphs.glyph(char)[3]
+            if pen + advance + self.glyphs.PAD >= left:
+                break
+            pen += advance
+            start += 1
+
+        image = None
+        if start < len(line):
+            image = Image.new('1', (STRIP_WIDTH, self.glyphs.height))
+            self.glyphs.blit(image, (pen - left, 0), line[start:])
+            if not image.getbbox():
+                image = None
+
+        self.__strips[key] = image
+        if len(self.__strips) > self.__capacity:
+            self.__strips.popitem(last=False)
+        return image
+
+    def draw(self, target):
+        """Clear target and draw the visible part of the text into it.
+
+        Args:
+            target (PIL.Image): Mode '1' image of the viewport size
+        """
+        target.paste(0, (0, 0, self.width, self.height))
+
+        # Lines overlap by their descenders with a negative spacing, so the
+        # first line drawn is the first whose glyph cell reaches into view.
+        first = max((self.y - self.glyphs.height) // self.pitch + 1, 0)
+        last = min((self.y + self.height) // self.pitch + 1, self.line_count)
+        strips = range(self.x // STRIP_WIDTH, (self.x + self.width) // STRIP_WIDTH + 1)
+
+        for index in range(first, last):
+            top = index * self.pitch - self.y
+            for strip in strips:
+                image = self.__strip(index, strip)
+                if image is not None:
+                    target.paste(image, (strip * STRIP_WIDTH - self.x, top), image)
+
+        # Keep the lines just outside the viewport ready for the next scroll.
+        for index in range(max(first - self.margin, 0), first):
+            for strip in strips:
+                self.__strip(index, strip)
+        for index in range(last, min(last + self.margin, self.line_count)):
+            for strip in strips:
+                self.__strip(index, strip)
@@ -0,0 +1,22 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def run_until():
+    """Iterate the GLib main loop until a condition holds.
+
+    Skips the test where GLib is not installed.
+    """
+    GLib = pytest.importorskip('gi.repository.GLib')
+    context = GLib.MainContext.default()
+
+    def run(predicate, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            assert time.monotonic() < deadline, 'timed out'
+            if not context.iteration(False):
+                time.sleep(0.001)
+
+    return run
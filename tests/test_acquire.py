@@ -0,0 +1,102 @@
+import socket
+
+import pytest
+
+dbus = pytest.importorskip('dbus')
+pytest.importorskip('gi.repository.GLib')
+
+from penpi.gatt.server import CommandCharacteristic
+
+
+DEVICE = '/org/bluez/hci0/dev_00_11_22_33_44_55'
+MTU = 185
+OPTIONS = {'device': DEVICE, 'mtu': MTU}
+
+
+class Service():
+
+    path = '/org/bluez/penpi/service0'
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+
+class BlueZ():
+    """Stands in for BlueZ, holding its end of an acquired socket."""
+
+    def __init__(self, acquired):
+        fd, mtu = acquired
+        self.mtu = int(mtu)
+        self.sock = socket.socket(fileno=fd.take())
+        self.sock.setblocking(False)
+        self.packets = []
+
+    def receive(self):
+        try:
+            while True:
+                packet = self.sock.recv(self.mtu)
+                if not packet:
+                    break
+                self.packets.append(packet)
+        except BlockingIOError:
+            pass
+        return b''.join(self.packets)
+
+
+@pytest.fixture
+def characteristic():
+    # Not exported, so no bus is needed and signals go nowhere.
+    characteristic = CommandCharacteristic(None, 0, Service())
+    yield characteristic
+    characteristic.sessions.stop()
+
+
+def acquired(characteristic):
+    properties = characteristic.get_properties()['org.bluez.GattCharacteristic1']
+    return bool(properties['WriteAcquired']), bool(properties['NotifyAcquired'])
+
+
+def test_commands_and_output_bypass_dbus(characteristic, run_until):
+    write = BlueZ(characteristic.AcquireWrite(OPTIONS))
+    notify = BlueZ(characteristic.AcquireNotify(OPTIONS))
+    assert (write.mtu, notify.mtu) == (MTU, MTU)
+    assert acquired(characteristic) == (True, True)
+
+    write.sock.send(b'echo hel')
+    write.sock.send(b'lo\n')
+    run_until(lambda: b'hello\n' in notify.receive())
+
+
+def test_notifications_fit_the_mtu(characteristic, run_until):
+    write = BlueZ(characteristic.AcquireWrite(OPTIONS))
+    notify = BlueZ(characteristic.AcquireNotify(OPTIONS))
+
+    write.sock.send(b"head -c 5000 /dev/zero | tr '\\0' x; echo end\n")
+    run_until(lambda: notify.receive().endswith(b'end\n'))
+    assert notify.receive().endswith(b'x' * 5000 + b'end\n')
+    assert max(len(packet) for packet in notify.packets) == MTU - 3
+
+
+def test_closing_the_bluez_end_releases_the_socket(characteristic, run_until):
+    write = BlueZ(characteristic.AcquireWrite(OPTIONS))
+    notify = BlueZ(characteristic.AcquireNotify(OPTIONS))
+
+    write.sock.close()
+    run_until(lambda: not characteristic.write_sockets)
+    assert acquired(characteristic) == (False, True)
+
+    notify.sock.close()
+    run_until(lambda: not characteristic.notify_sockets)
+    assert acquired(characteristic) == (False, False)
+
+
+def test_acquiring_again_replaces_the_socket(characteristic, run_until):
+    first = BlueZ(characteristic.AcquireNotify(OPTIONS))
+    second = BlueZ(characteristic.AcquireNotify(OPTIONS))
+    assert len(characteristic.notify_sockets) == 1
+
+    # Our end of the first socket is closed, BlueZ reads end of file.
+    assert first.sock.recv(MTU) == b''
+
+    characteristic.WriteValue(b'echo again\n', OPTIONS)
+    run_until(lambda: b'again\n' in second.receive())
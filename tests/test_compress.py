@@ -0,0 +1,68 @@
+import os
+import zlib
+
+import pytest
+
+from penpi.bench import _sample_outputs
+from penpi.gatt.compress import Compressor, Pager, DEFLATE, RAW, read_size
+
+
+PAGE_SIZES = [20, 182, 512]
+READ_PAGES = 4
+
+
+def page_all(output, page_size):
+    pager = Pager(Compressor(), page_size)
+    size = read_size(page_size, READ_PAGES)
+    reads = [output[start:start + size] for start in range(0, len(output), size)]
+    for data in reads:
+        pager.add(data)
+    pages = []
+    while len(pager):
+        pages.append(pager.take())
+    return reads, pages
+
+
+def receive(pages):
+    inflate = zlib.decompressobj(-15)
+    return b''.join(inflate.decompress(page[1:]) if page[0] == DEFLATE else page[1:] for page in pages)
+
+
+@pytest.mark.parametrize('page_size', PAGE_SIZES)
+@pytest.mark.parametrize('name', sorted(_sample_outputs()))
+def test_round_trip(name, page_size):
+    output = _sample_outputs()[name]
+    reads, pages = page_all(output, page_size)
+    assert all(len(page) <= page_size for page in pages)
+    assert receive(pages) == output
+
+
+@pytest.mark.parametrize('page_size', PAGE_SIZES)
+@pytest.mark.parametrize('name', sorted(_sample_outputs()))
+def test_no_more_pages_than_raw(name, page_size):
+    output = _sample_outputs()[name]
+    # Whole reads, the way bulk output is read.
+    size = read_size(page_size, READ_PAGES)
+    output = output[:len(output) // size * size] or output[:size]
+    reads, pages = page_all(output, page_size)
+    raw = sum(-(-len(data) // page_size) for data in reads)
+    assert len(pages) <= raw
+
+
+@pytest.mark.parametrize('page_size', PAGE_SIZES)
+def test_incompressible_read_fills_pages(page_size):
+    data = os.urandom(read_size(page_size, READ_PAGES))
+    reads, pages = page_all(data, page_size)
+    assert len(pages) == READ_PAGES
+    assert {page[0] for page in pages} == {RAW}
+    assert all(len(page) == page_size for page in pages)
+
+
+def test_raw_output_leaves_the_stream_alone():
+    compressor = Compressor()
+    inflate = zlib.decompressobj(-15)
+    text = b'wlan0: associated with 00:11:22:33:44:55\n' * 4
+    for data in (text, os.urandom(200), text):
+        flag, payload = compressor.compress(data)
+        received = inflate.decompress(payload) if flag == DEFLATE else payload
+        assert received == data
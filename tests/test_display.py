@@ -0,0 +1,108 @@
+import random
+
+import pytest
+from PIL import Image, ImageDraw, ImageFont
+
+from penpi.display import WINDOW_COST, Display, FakeDevice, image_to_pages_np, image_to_pages_py
+
+
+WIDTH = 128
+HEIGHT = 64
+FULL_FRAME = WIDTH * HEIGHT // 8
+
+
+def menu(selected):
+    image = Image.new('1', (WIDTH, HEIGHT))
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+    for row in range(6):
+        if row == selected:
+            draw.rectangle((0, row * 10, WIDTH, row * 10 + 10), outline=0, fill=255)
+        draw.text((0, row * 10), '{}. Menu entry'.format(row + 1), font=font, fill=0 if row == selected else 255)
+    return image
+
+
+def test_unchanged_frame_sends_nothing():
+    device = FakeDevice()
+    display = Display(device)
+    display.push(menu(0))
+    device.reset_counters()
+
+    display.push(menu(0))
+    assert device.bytes_sent == 0
+    assert display.last_frame_bytes == 0
+
+
+def test_moving_the_selection_sends_only_its_rows():
+    device = FakeDevice()
+    display = Display(device)
+    display.push(menu(0))
+    device.reset_counters()
+
+    display.push(menu(1))
+    # Rows 0 and 1 span pixel rows 0 to 20, pages 0 to 2.
+    assert 0 < device.data_bytes <= 3 * WIDTH
+    assert all(page_end <= 2 for _, _, _, page_end in device.windows)
+    assert device.command_bytes == WINDOW_COST * len(device.windows)
+    assert display.last_frame_bytes == device.data_bytes
+    assert display.last_frame_time > 0
+
+
+def test_invalidate_sends_the_whole_frame():
+    device = FakeDevice()
+    display = Display(device)
+    display.push(menu(0))
+    display.invalidate()
+    device.reset_counters()
+
+    display.push(menu(0))
+    assert device.data_bytes == FULL_FRAME
+    assert device.windows == [(0, WIDTH - 1, 0, HEIGHT // 8 - 1)]
+
+
+def test_device_ends_up_with_every_frame():
+    device = FakeDevice()
+    display = Display(device)
+    rnd = random.Random(0)
+    image = Image.new('1', (WIDTH, HEIGHT))
+    draw = ImageDraw.Draw(image)
+
+    for _ in range(50):
+        x, y = rnd.randrange(WIDTH), rnd.randrange(HEIGHT)
+        draw.rectangle((x, y, x + rnd.randrange(40), y + rnd.randrange(20)), fill=rnd.randrange(2))
+        display.push(image)
+        assert device.ram == image_to_pages_py(image, WIDTH, HEIGHT // 8)
+        assert display.last_frame_bytes <= FULL_FRAME
+
+
+def test_numpy_conversion_matches_the_reference():
+    pytest.importorskip('numpy')
+    from penpi.bench import _sample_images
+    for image in _sample_images(WIDTH, HEIGHT):
+        assert image_to_pages_np(image, WIDTH, HEIGHT // 8) == image_to_pages_py(image, WIDTH, HEIGHT // 8)
+
+
+@pytest.mark.parametrize('convert', ['py', 'np'])
+def test_golden_page_layout(convert):
+    if convert == 'np':
+        pytest.importorskip('numpy')
+    image = Image.new('1', (WIDTH, HEIGHT))
+    for xy in [(0, 0), (1, 7), (2, 0), (2, 3), (127, 8), (5, 63)]:
+        image.putpixel(xy, 1)
+
+    pages = {'py': image_to_pages_py, 'np': image_to_pages_np}[convert](image, WIDTH, HEIGHT // 8)
+
+    # Byte page * width + x, least significant bit on top.
+    golden = bytearray(FULL_FRAME)
+    golden[0] = 0x01
+    golden[1] = 0x80
+    golden[2] = 0x09
+    golden[WIDTH + 127] = 0x01
+    golden[7 * WIDTH + 5] = 0x80
+    assert pages == golden
+
+
+def test_conversion_rejects_other_images():
+    for image in (Image.new('L', (WIDTH, HEIGHT)), Image.new('1', (WIDTH, 32))):
+        with pytest.raises(ValueError):
+            image_to_pages_py(image, WIDTH, HEIGHT // 8)
@@ -0,0 +1,98 @@
+import queue
+import time
+
+from penpi.input import AutoRepeat, Button, ScriptedBackend, HIGH, LOW
+
+
+PIN = 5
+
+
+def button(debounce=0.02):
+    events = queue.Queue()
+    backend = ScriptedBackend()
+    return Button(PIN, events, backend, debounce), events, backend
+
+
+def drain(events):
+    taken = []
+    while True:
+        try:
+            taken.append(events.get_nowait())
+        except queue.Empty:
+            return taken
+
+
+def test_press_reaches_the_queue_at_once():
+    pressed, events, backend = button(debounce=0.01)
+    latencies = []
+    for _ in range(20):
+        started = time.monotonic()
+        backend.press(PIN, started)
+        event = events.get(timeout=1)
+        latencies.append(time.monotonic() - started)
+        assert (event.button, event.state, event.time) == (pressed, Button.DOWN, started)
+
+        time.sleep(0.015)
+        backend.release(PIN)
+        assert events.get(timeout=1).state == Button.UP
+        time.sleep(0.015)
+
+    assert max(latencies) < 0.01
+
+
+def test_bounce_is_one_press_and_quick_presses_all_count():
+    pressed, events, backend = button(debounce=0.02)
+    backend.play([
+        (0.000, PIN, LOW), (0.002, PIN, HIGH), (0.004, PIN, LOW),
+        (0.100, PIN, HIGH),
+        (0.150, PIN, LOW),
+        (0.200, PIN, HIGH),
+    ], realtime=False)
+    time.sleep(0.05)
+
+    assert [event.state for event in drain(events)] == [Button.DOWN, Button.UP, Button.DOWN, Button.UP]
+
+
+def test_state_settles_on_the_pin_level_after_bounce():
+    pressed, events, backend = button(debounce=0.02)
+    now = time.monotonic()
+    backend.press(PIN, now)
+    backend.release(PIN, now + 0.001)
+    assert pressed.state == Button.DOWN
+
+    assert events.get(timeout=1).state == Button.DOWN
+    # The release came within the window, it is picked up once that is over.
+    assert events.get(timeout=1).state == Button.UP
+    assert pressed.state == Button.UP
+
+
+def test_lost_edge_does_not_invert_the_state():
+    pressed, events, backend = button(debounce=0)
+    backend.press(PIN, 1.0)
+    backend.press(PIN, 2.0)
+    backend.release(PIN, 3.0)
+
+    assert [event.state for event in drain(events)] == [Button.DOWN, Button.UP]
+    assert pressed.state == Button.UP
+
+
+def test_held_button_repeats_faster():
+    pressed, events, backend = button()
+    repeat = AutoRepeat([pressed], delay=0.05, interval=0.04, minimum=0.01, acceleration=0.5)
+    backend.press(PIN)
+    repeat.update(events.get(timeout=1))
+
+    repeats = []
+    deadline = time.monotonic() + 0.3
+    while time.monotonic() < deadline:
+        time.sleep(repeat.timeout(0.01))
+        repeats += [event.time for event in repeat.due()]
+
+    gaps = [later - earlier for earlier, later in zip(repeats, repeats[1:])]
+    assert len(repeats) >= 5
+    assert gaps[0] > gaps[-1]
+
+    backend.release(PIN)
+    repeat.update(events.get(timeout=1))
+    assert repeat.timeout() is None
+    assert repeat.due() == []
@@ -0,0 +1,38 @@
+import re
+import shutil
+
+import pytest
+
+pytest.importorskip('dbus')
+pytest.importorskip('gi.repository.GLib')
+if shutil.which('dbus-daemon') is None:
+    pytest.skip('dbus-daemon is not installed', allow_module_level=True)
+
+from penpi.gatt import loadgen
+
+
+def run(capsys, *argv):
+    status = loadgen.main(['--seconds', '1'] + list(argv))
+    report = capsys.readouterr().out
+    ops = re.search(r'(\d+) ops in', report)
+    errors = re.search(r'(\d+) errors', report)
+    return status, int(ops.group(1)) if ops else 0, int(errors.group(1)) if errors else None
+
+
+@pytest.mark.parametrize('mode', ['read', 'notify', 'acquire'])
+def test_commands_run_through_the_fake_bluez(capsys, mode):
+    status, ops, errors = run(capsys, '--mode', mode, '--size', '1000')
+    assert (status, errors) == (0, 0)
+    assert ops > 0
+
+
+def test_several_centrals_run_at_once(capsys):
+    status, ops, errors = run(capsys, '--mode', 'acquire', '--centrals', '3')
+    assert (status, errors) == (0, 0)
+    assert ops >= 3
+
+
+def test_too_slow_fails(capsys):
+    status, _, errors = run(capsys, '--mode', 'read', '--min-rate', '1e9')
+    assert status == 1
+    assert errors == 0
@@ -0,0 +1,26 @@
+import json
+
+import pytest
+
+from penpi.menutree import MenuWatcher, compile_menu
+
+
+@pytest.mark.parametrize('items', [None, 5, 'ls', {'name': 'a'}])
+def test_items_must_be_a_list(items):
+    with pytest.raises(ValueError):
+        compile_menu([{'name': 'Tools', 'items': items}])
+
+
+def test_bad_edit_keeps_the_old_tree(tmp_path):
+    config = tmp_path / 'config.json'
+    config.write_text(json.dumps([{'name': 'Tools', 'items': [{'name': 'Uptime', 'command': 'uptime'}]}]))
+    watcher = MenuWatcher(config)
+    tree = watcher.tree
+
+    config.write_text(json.dumps([{'name': 'Tools', 'items': None}]))
+    assert not watcher.reload()
+    assert watcher.tree is tree
+
+    config.write_text(json.dumps([{'name': 'Tools', 'items': []}, {'name': 'Reboot', 'command': 'reboot'}]))
+    assert watcher.reload()
+    assert watcher.tree.names == ['', 'Tools', 'Reboot']
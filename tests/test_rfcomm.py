@@ -0,0 +1,88 @@
+import socket
+
+import pytest
+
+pytest.importorskip('gi.repository.GLib')
+
+from penpi.gatt.rfcomm import RfcommServer, listen
+
+
+BULK = 1 << 20
+
+
+class Client():
+
+    def __init__(self, address):
+        self.sock = socket.socket(address.family, socket.SOCK_STREAM)
+        self.sock.connect(address.getsockname())
+        self.sock.setblocking(False)
+        self.received = bytearray()
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def receive(self):
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                self.received += data
+        except BlockingIOError:
+            pass
+        return bytes(self.received)
+
+
+@pytest.fixture(params=['tcp', 'unix'])
+def listener(request, tmp_path):
+    if request.param == 'tcp':
+        sock = listen('tcp:127.0.0.1:0')
+    else:
+        sock = listen('unix:{}'.format(tmp_path / 'shell.sock'))
+    yield sock
+    sock.close()
+
+
+@pytest.fixture
+def server(listener):
+    server = RfcommServer()
+    server.start()
+    server.serve(listener)
+    yield server
+    server.stop()
+
+
+def test_runs_commands(server, listener, run_until):
+    client = Client(listener)
+    client.send(b'echo hello\necho $((6 * 7))\n')
+    run_until(lambda: b'42\n' in client.receive())
+    assert client.received.endswith(b'hello\n42\n')
+
+
+def test_bulk_output_arrives_whole(server, listener, run_until):
+    client = Client(listener)
+    client.send("head -c {} /dev/zero | tr '\\0' x; echo end\n".format(BULK).encode())
+    run_until(lambda: client.receive().endswith(b'end\n'), timeout=30)
+    assert client.received == b'x' * BULK + b'end\n'
+
+
+def test_clients_get_sessions_of_their_own(server, listener, run_until):
+    first, second = Client(listener), Client(listener)
+    run_until(lambda: len(server.connections) == 2)
+    first.send(b'echo pid $$\n')
+    second.send(b'echo pid $$\n')
+    run_until(lambda: first.receive().endswith(b'\n') and second.receive().endswith(b'\n'))
+    assert first.received.startswith(b'pid ')
+    assert first.received != second.received
+
+
+def test_disconnect_closes_the_connection(server, listener, run_until):
+    client = Client(listener)
+    run_until(lambda: len(server.connections) == 1)
+    client.sock.close()
+    run_until(lambda: not server.connections)
+
+
+def test_unknown_address():
+    with pytest.raises(ValueError):
+        listen('serial:/dev/ttyS0')
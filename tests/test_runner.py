@@ -0,0 +1,37 @@
+import time
+
+import pytest
+
+from penpi.runner import MAX_LINE, CommandRunner
+
+
+# A long unterminated line, then a short terminated one.
+COMMAND = "head -c {} /dev/zero | tr '\\0' x; echo; echo done".format(3 * MAX_LINE + 10)
+
+
+def check_lines(runner):
+    lines = [runner.lines.line(number) for number in range(*runner.lines.span())]
+    assert all(len(line) <= MAX_LINE for line in lines)
+    assert ''.join(lines[:-1]) == 'x' * (3 * MAX_LINE + 10)
+    assert lines[-1] == 'done'
+    assert runner.returncode == 0
+
+
+def test_long_lines_are_cut_in_the_reader_thread():
+    runner = CommandRunner(COMMAND)
+    runner.start()
+    deadline = time.monotonic() + 10
+    while runner.running and time.monotonic() < deadline:
+        time.sleep(0.01)
+    check_lines(runner)
+
+
+def test_long_lines_are_cut_on_the_main_loop():
+    GLib = pytest.importorskip('gi.repository.GLib')
+    runner = CommandRunner(COMMAND, main_loop=True)
+    runner.start()
+    context = GLib.MainContext.default()
+    deadline = time.monotonic() + 10
+    while runner.running and time.monotonic() < deadline:
+        context.iteration(True)
+    check_lines(runner)
@@ -0,0 +1,75 @@
+import json
+
+from penpi.scanner import ADDED, CHANGED, REMOVED, ReplaySource, Scanner, read_snapshot
+
+
+def test_strongest_signal_first_unknown_last():
+    scanner = Scanner()
+    scanner.update('aa:00:00:00:00:01', rssi=-80, now=100)
+    scanner.update('aa:00:00:00:00:02', now=100)
+    scanner.update('aa:00:00:00:00:03', rssi=-40, now=100)
+    scanner.update('aa:00:00:00:00:04', rssi=-60, now=100)
+
+    assert [device.address[-2:] for device in scanner.devices()] == ['03', '04', '01', '02']
+
+
+def test_devices_unseen_for_ttl_are_evicted():
+    scanner = Scanner(ttl=30)
+    events = []
+    scanner.subscribe(lambda event, device: events.append((event, device.address)))
+    scanner.update('AA:00:00:00:00:01', rssi=-50, now=100)
+    scanner.update('AA:00:00:00:00:02', rssi=-50, now=100)
+    scanner.update('AA:00:00:00:00:02', now=120)
+
+    scanner.evict(now=130)
+    assert len(scanner) == 2
+
+    scanner.evict(now=131)
+    assert [device.address for device in scanner.devices()] == ['AA:00:00:00:00:02']
+    assert events[-1] == (REMOVED, 'AA:00:00:00:00:01')
+
+    scanner.evict(now=151)
+    assert len(scanner) == 0
+
+
+def test_updates_are_incremental():
+    scanner = Scanner(rssi_delta=5)
+    events = []
+    scanner.subscribe(lambda event, device: events.append(event))
+
+    device = scanner.update('aa:bb:cc:dd:ee:ff', rssi=-60, now=1)
+    scanner.update('AA:BB:CC:DD:EE:FF', rssi=-62, now=2)
+    scanner.update('AA:BB:CC:DD:EE:FF', name='Phone', now=3)
+    scanner.update('AA:BB:CC:DD:EE:FF', rssi=-70, data={'ManufacturerData': {'76': '0215'}}, now=4)
+
+    assert events == [ADDED, CHANGED, CHANGED]
+    assert scanner.get('aa:bb:cc:dd:ee:ff') is device
+    assert (device.name, device.rssi, device.first_seen, device.last_seen) == ('Phone', -70, 1, 4)
+    assert device.data == {'ManufacturerData': {'76': '0215'}}
+
+
+def test_replay_feeds_due_records():
+    scanner = Scanner()
+    done = []
+    records = [
+        {'time': 0, 'address': 'AA:00:00:00:00:01', 'rssi': -70},
+        {'time': 0, 'address': 'AA:00:00:00:00:02', 'rssi': -30, 'name': 'Watch'},
+    ]
+    ReplaySource(scanner, records, on_done=lambda: done.append(True)).start()
+
+    assert done == [True]
+    assert [device.name for device in scanner.devices()] == ['Watch', None]
+
+
+def test_snapshot_drops_expired_devices(tmp_path):
+    path = tmp_path / 'devices.json'
+    now = 1000.0
+    path.write_text(json.dumps({'time': now, 'ttl': 60, 'devices': [
+        {'address': 'AA:00:00:00:00:01', 'name': None, 'rssi': -50, 'first_seen': 0,
+            'last_seen': 0, 'data': {}},
+        {'address': 'AA:00:00:00:00:02', 'name': 'Phone', 'rssi': None, 'first_seen': 0,
+            'last_seen': 2e9, 'data': {}},
+    ]}))
+
+    assert [device['address'] for device in read_snapshot(path)] == ['AA:00:00:00:00:02']
+    assert read_snapshot(tmp_path / 'missing.json') == []
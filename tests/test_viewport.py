@@ -0,0 +1,52 @@
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+import pytest
+
+from penpi.text import GlyphAtlas
+from penpi.viewport import OutputViewport
+
+
+WIDTH = 128
+HEIGHT = 64
+SPACING = -2
+
+TEXT = '\n'.join('line {}: abcdefghijklmnopqrstuvwxyz ABC {{[j]}} 0123456789 {}'.format(i, 'xy' * i)
+    for i in range(30))
+
+FONTS = {
+    'freetype': ImageFont.load_default,
+    'bitmap': ImageFont.load_default_imagefont,
+}
+
+
+@pytest.fixture(params=sorted(FONTS))
+def font(request):
+    return FONTS[request.param]()
+
+
+def reference(font, x, y):
+    image = Image.new('1', (WIDTH, HEIGHT))
+    ImageDraw.Draw(image).multiline_text((-x, -y), TEXT, font=font, fill=255, spacing=SPACING)
+    return image
+
+
+@pytest.mark.parametrize('x, y', [(0, 0), (1, 3), (40, 10), (63, 5), (64, 0), (100, 37), (130, 60)])
+def test_frames_match_multiline_text(font, x, y):
+    viewport = OutputViewport(GlyphAtlas(font), WIDTH, HEIGHT, spacing=SPACING)
+    viewport.set_text(TEXT)
+    viewport.x, viewport.y = x, y
+
+    frame = Image.new('1', (WIDTH, HEIGHT))
+    viewport.draw(frame)
+
+    assert ImageChops.logical_xor(frame, reference(font, x, y)).getbbox() is None
+
+
+def test_scrolled_frames_match_multiline_text(font):
+    viewport = OutputViewport(GlyphAtlas(font), WIDTH, HEIGHT, spacing=SPACING)
+    viewport.set_text(TEXT)
+    frame = Image.new('1', (WIDTH, HEIGHT))
+
+    for step in range(12):
+        viewport.scroll(7, 5)
+        viewport.draw(frame)
+        assert ImageChops.logical_xor(frame, reference(font, viewport.x, viewport.y)).getbbox() is None